@@ -0,0 +1,256 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+
+def _iso(ts: float) -> str:
+    # Same format as repository._now (naive UTC), so lastActive values compare as strings
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def _timestamp(value) -> Optional[float]:
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class AgentPresence:
+    """Human agent liveness held in memory, written to `humanAgents` in bulk.
+
+    Status changes (the status endpoint, agent socket connect/disconnect)
+    and heartbeats (any message or pong on an agent socket) only update
+    memory; every `flush_interval` seconds the pending status changes and
+    the newest lastActive per agent go out as one bulk write. Online agents
+    not heard from for `ttl` seconds are expired to offline.
+
+    Other workers' changes arrive through Mongo: every `refresh_interval`
+    seconds the online agents are re-read and merged (local unflushed
+    changes win), so a worker's view lags others by at most
+    flush_interval + refresh_interval. Expiry writes are conditional on
+    lastActive in Mongo, so one worker can't expire an agent another
+    worker has heard from. `listeners` are called with the agent's view
+    on every status change.
+    """
+
+    def __init__(self, repos, ttl: float = 90.0, flush_interval: float = 2.0, refresh_interval: float = 10.0):
+        self.repos = repos
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.listeners: List[Callable[[dict], None]] = []
+        self.agents: Dict[str, dict] = {}
+        self._by_site: Dict[str, Set[str]] = {}
+        self._seen: Dict[str, float] = {}
+        # Agents with a socket on this worker
+        self._local: Set[str] = set()
+        # Unflushed writes: agentId -> (status, stale_before) and agents heard from since the last flush
+        self._pending: Dict[str, Tuple[str, Optional[str]]] = {}
+        self._touched: Set[str] = set()
+        # Local change counter, so a refresh doesn't undo changes made while it was reading
+        self._clock = 0
+        self._changed: Dict[str, int] = {}
+        self._task = None
+        self._last_refresh = 0.0
+
+        # Metrics
+        self.heartbeats = 0
+        self.changes = 0
+        self.expired = 0
+        self.flushes = 0
+        self.written = 0
+        self.failures = 0
+
+    # Views
+
+    def view(self, agentId: str) -> dict:
+        agent = self.agents[agentId]
+        return {**agent, "lastActive": _iso(self._seen[agentId]) if agentId in self._seen else agent.get("lastActive")}
+
+    def available(self, websiteId: str) -> List[dict]:
+        return [
+            self.view(agentId) for agentId in self._by_site.get(websiteId, ())
+            if self.agents[agentId].get("status") == "online"
+        ]
+
+    def is_online(self, agentId: str) -> bool:
+        agent = self.agents.get(agentId)
+        return agent is not None and agent.get("status") == "online"
+
+    # Updates
+
+    def _track(self, doc: dict) -> dict:
+        agentId = doc["agentId"]
+        previous = self.agents.get(agentId)
+        if previous is not None and previous["websiteId"] != doc["websiteId"]:
+            self._by_site.get(previous["websiteId"], set()).discard(agentId)
+        self.agents[agentId] = doc
+        self._by_site.setdefault(doc["websiteId"], set()).add(agentId)
+        return doc
+
+    def _set(self, agentId: str, status: str):
+        agent = self.agents[agentId]
+        if agent.get("status") == status:
+            return
+        agent["status"] = status
+        self.changes += 1
+        view = self.view(agentId)
+        for listener in self.listeners:
+            try:
+                listener(view)
+            except Exception as e:
+                print(f"Warning: presence listener failed: {e}")
+
+    def upsert(self, doc: dict):
+        """Track an agent document that was just written to Mongo (nothing is written back)."""
+        status = doc.get("status", "offline")
+        agent = self._track({**doc, "status": self.agents.get(doc["agentId"], {}).get("status")})
+        self._seen[agent["agentId"]] = time.time()
+        self._set(agent["agentId"], status)
+
+    async def set_status(self, agentId: str, status: str, connected: Optional[bool] = None) -> bool:
+        """False if no such agent exists."""
+        if agentId not in self.agents:
+            doc = await self.repos.human_agents.find_by_id(agentId)
+            if doc is None:
+                return False
+            if agentId not in self.agents:
+                self._track(doc)
+        if connected is True:
+            self._local.add(agentId)
+        elif connected is False:
+            self._local.discard(agentId)
+        now = time.time()
+        self._seen[agentId] = now
+        self._clock += 1
+        self._changed[agentId] = self._clock
+        self._pending[agentId] = (status, None)
+        self._touched.add(agentId)
+        self._set(agentId, status)
+        return True
+
+    def heartbeat(self, agentId: str):
+        if agentId in self.agents:
+            self._seen[agentId] = time.time()
+            self._touched.add(agentId)
+            self.heartbeats += 1
+
+    def expire(self, now: Optional[float] = None) -> List[str]:
+        now = now or time.time()
+        stale = [
+            agentId for agentId, agent in self.agents.items()
+            if agent.get("status") == "online" and now - self._seen.get(agentId, 0.0) > self.ttl
+        ]
+        for agentId in stale:
+            # Only written if nobody has updated lastActive in Mongo since we last heard from the agent
+            self._pending[agentId] = ("offline", _iso(self._seen.get(agentId, 0.0) + 0.001))
+            self._touched.discard(agentId)
+            self._set(agentId, "offline")
+        self.expired += len(stale)
+        return stale
+
+    # Mongo
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        touched, self._touched = self._touched, set()
+        updates = [
+            (agentId, *pending.get(agentId, (None, None)), _iso(self._seen[agentId]) if agentId in self._seen else None)
+            for agentId in touched | set(pending)
+        ]
+        if not updates:
+            return
+        try:
+            await self.repos.human_agents.write_presence(updates)
+        except Exception:
+            # Keep them for the next flush; newer local changes take precedence
+            self._pending = {**pending, **self._pending}
+            self._touched |= touched
+            raise
+        self.flushes += 1
+        self.written += len(updates)
+
+    async def refresh(self):
+        """Merge in the online agents as Mongo (and so every other worker) sees them."""
+        clock = self._clock
+        docs = await self.repos.human_agents.find_all_online()
+        online = set()
+        for doc in docs:
+            agentId = doc["agentId"]
+            online.add(agentId)
+            if self._changed.get(agentId, 0) > clock or agentId in self._pending:
+                continue
+            seen = _timestamp(doc.get("lastActive"))
+            if agentId not in self.agents:
+                self._track({**doc, "status": None})
+                seen = seen or time.time()
+            else:
+                self._track({**doc, "status": self.agents[agentId].get("status")})
+            self._seen[agentId] = max(self._seen.get(agentId, 0.0), seen or 0.0)
+            self._set(agentId, "online")
+        for agentId, agent in list(self.agents.items()):
+            if (
+                agentId not in online
+                and agent.get("status") == "online"
+                and agentId not in self._local
+                and agentId not in self._pending
+                and self._changed.get(agentId, 0) <= clock
+            ):
+                self._set(agentId, "offline")
+        self._last_refresh = time.monotonic()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                if self.refresh_interval > 0 and time.monotonic() - self._last_refresh >= self.refresh_interval:
+                    await self.refresh()
+                self.expire()
+                await self.flush()
+            except Exception as e:
+                self.failures += 1
+                print(f"Warning: agent presence update failed: {e}")
+
+    async def start(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            print(f"Warning: agent presence refresh failed: {e}")
+        self._task = asyncio.create_task(self._run(), name="agent-presence")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Warning: agent presence flush failed on shutdown: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "agents": len(self.agents),
+            "online": sum(1 for a in self.agents.values() if a.get("status") == "online"),
+            "local": len(self._local),
+            "pendingWrites": len(self._pending) + len(self._touched - set(self._pending)),
+            "heartbeats": self.heartbeats,
+            "changes": self.changes,
+            "expired": self.expired,
+            "flushes": self.flushes,
+            "written": self.written,
+            "failures": self.failures,
+        }
+
+
+def create_agent_presence(repos) -> AgentPresence:
+    return AgentPresence(
+        repos,
+        ttl=float(os.getenv("AGENT_PRESENCE_TTL_SECONDS", "90")),
+        flush_interval=float(os.getenv("AGENT_PRESENCE_FLUSH_SECONDS", "2")),
+        refresh_interval=float(os.getenv("AGENT_PRESENCE_REFRESH_SECONDS", "10")),
+    )
@@ -0,0 +1,200 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+from metrics import SIZE_BUCKETS, histogram
+from tracing import Span, Trace, copy_spans, current_span, run_with_span
+
+QUEUE_WAIT_SECONDS = histogram("batcher_queue_wait_seconds", "Time an item waited for its batch to start", ["batcher"])
+BATCH_SECONDS = histogram("batcher_batch_duration_seconds", "Time to run one batch", ["batcher"])
+BATCH_SIZE = histogram("batcher_batch_size", "Items per batch", ["batcher"], SIZE_BUCKETS)
+
+
+class MicroBatcher:
+    """Collects concurrent requests into batches for a blocking batch function.
+
+    Callers `await submit(item)`. A background worker takes up to
+    `max_batch_size` items from the queue, or whatever arrived within
+    `max_wait_ms` of the first one, runs `predict_batch(items)` on a worker
+    thread and resolves each caller's future with its slice of the output.
+    Up to `max_concurrency` batches run at once (for backends that fan out
+    to several workers); the default of 1 runs them back to back.
+    """
+
+    def __init__(
+        self,
+        predict_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+        name: str = "batcher",
+        max_concurrency: int = 1,
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be >= 1")
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be >= 1")
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.max_concurrency = max_concurrency
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._running: set = set()
+        # Items taken off the queue for the batch being collected, failed by stop() if it cancels the collect
+        self._collecting: list = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        # Metrics
+        self.batches = 0
+        self.items = 0
+        self.errors = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.run_time_total = 0.0
+
+    async def start(self):
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            # One thread per concurrent batch: with the default of 1, never concurrently on the model
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix=self.name)
+            self._worker = asyncio.create_task(self._run(), name=self.name)
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        self._fail(self._collecting, RuntimeError(f"{self.name} stopped"))
+        self._collecting = []
+        for task in list(self._running):
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+        # Fail anything still queued so callers don't hang
+        while not self._queue.empty():
+            _, future, _, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError(f"{self.name} stopped"))
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, item: Any) -> Any:
+        if self._worker is None:
+            raise RuntimeError(f"{self.name} is not running")
+        future = asyncio.get_running_loop().create_future()
+        # The caller's trace span, if it is being traced, to hang the batch spans under
+        await self._queue.put((item, future, time.perf_counter(), current_span()))
+        return await future
+
+    async def _collect(self) -> list:
+        batch = self._collecting = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Drain whatever is already queued without yielding
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            remaining = deadline - time.perf_counter()
+            if len(batch) >= self.max_batch_size or remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            # Only collect once a slot is free, so batches keep filling while all slots are busy
+            await self._slots.acquire()
+            try:
+                batch = await self._collect()
+            except BaseException:
+                self._slots.release()
+                raise
+            self._collecting = []
+            task = asyncio.create_task(self._run_batch(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, batch: list):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        for _, _, enqueued, _ in batch:
+            wait = started - enqueued
+            QUEUE_WAIT_SECONDS.observe(wait, self.name)
+            self.queue_wait_total += wait
+            self.queue_wait_max = max(self.queue_wait_max, wait)
+        items = [item for item, _, _, _ in batch]
+        traced = [(enqueued, parent) for _, _, enqueued, parent in batch if parent is not None]
+        batch_span = None
+        if traced:
+            # Runs once for the whole batch; copied into each traced caller's trace afterwards
+            shared = Trace()
+            batch_span = shared.add(Span("batch.run", shared, attributes={"batcher": self.name, "batch.size": len(batch)}))
+        try:
+            results = await loop.run_in_executor(self._executor, run_with_span, batch_span, self.predict_batch, items)
+            if len(results) != len(items):
+                raise RuntimeError(
+                    f"{self.name}: predict_batch returned {len(results)} results for {len(items)} items"
+                )
+        except asyncio.CancelledError:
+            # Stopped mid-batch; don't leave these callers hanging
+            self._fail(batch, RuntimeError(f"{self.name} stopped"))
+        except Exception as e:
+            self.errors += 1
+            self._fail(batch, e)
+        else:
+            for (_, future, _, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+            self.batches += 1
+            self.items += len(batch)
+            elapsed = time.perf_counter() - started
+            self.run_time_total += elapsed
+            BATCH_SECONDS.observe(elapsed, self.name)
+            BATCH_SIZE.observe(len(batch), self.name)
+            if batch_span is not None:
+                batch_span.end()
+                self._trace_batch(traced, started, batch_span)
+
+    @staticmethod
+    def _trace_batch(traced: list, started: float, batch_span: Span):
+        # perf_counter -> wall clock, for the queue-wait spans
+        offset = batch_span.start_ns - int(started * 1e9)
+        for enqueued, parent in traced:
+            wait = parent.child("batch.queue_wait")
+            wait.start_ns = int(enqueued * 1e9) + offset
+            wait.end(batch_span.start_ns)
+            copy_spans(batch_span.trace, parent)
+
+    @staticmethod
+    def _fail(batch: list, error: Exception):
+        for _, future, _, _ in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def stats(self) -> dict:
+        batches = self.batches or 1
+        items = self.items or 1
+        return {
+            "maxBatchSize": self.max_batch_size,
+            "maxWaitMs": self.max_wait * 1000.0,
+            "batches": self.batches,
+            "items": self.items,
+            "errors": self.errors,
+            "queueDepth": self._queue.qsize() if self._queue else 0,
+            "runningBatches": len(self._running),
+            "avgBatchSize": self.items / batches,
+            "batchFillRate": self.items / (batches * self.max_batch_size),
+            "avgQueueWaitMs": self.queue_wait_total / items * 1000.0,
+            "maxQueueWaitMs": self.queue_wait_max * 1000.0,
+            "avgBatchRunMs": self.run_time_total / batches * 1000.0,
+        }
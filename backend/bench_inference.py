@@ -0,0 +1,278 @@
+"""Micro-benchmark of the intent stack alone: tokenizers, runtimes, batch sizes, lengths, threads.
+
+Two tables, both for each model directory given (default: every distinct
+path in models.json):
+
+  tokenize    the fast tokenizer.json (FastTokenizer) vs DistilBertTokenizer
+  forward     torch vs onnx vs onnx-int8, per thread count, batch size and
+              sequence length; tokenize and postprocess are timed alongside
+
+Each runtime is measured in its own process so one runtime's thread pool
+doesn't compete with the next. Results are printed as tables and saved as
+JSON (default bench_results/inference-<time>.json).
+
+    python bench_inference.py
+    python bench_inference.py --models multi_intent_model --backends onnx,onnx-int8 --threads 1,2
+    python bench_inference.py --batch-sizes 1,8,32 --seq-lengths 16,64 --min-time 1
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from intent_backends import MAX_SEQ_LENGTH, FastTokenizer, _find_tokenizer_file, resolve_model_dir
+
+BASE_DIR = Path(__file__).resolve().parent
+RESULTS_DIR = BASE_DIR / "bench_results"
+
+BACKENDS = ["torch", "onnx", "onnx-int8"]
+TOKENIZERS = ["fast", "slow"]
+
+# Query-like vocabulary; texts are grown from it to the requested token count
+WORDS = (
+    "show me the cheapest sony headphones i want to order a new laptop where is my order "
+    "track package delivery price under hundred dollars wireless noise cancelling best rated "
+    "phone case samsung apple charger cable cannot log in to my account reset password"
+).split()
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def make_texts(tokenizer: FastTokenizer, count: int, seq_length: int, seed: int = 0) -> List[str]:
+    """`count` texts of roughly `seq_length` tokens each (special tokens included)."""
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        words: List[str] = []
+        while True:
+            words.append(rng.choice(WORDS))
+            if len(tokenizer.tokenizer.encode(" ".join(words)).ids) >= seq_length:
+                break
+        texts.append(" ".join(words))
+    return texts
+
+
+def measure(call: Callable[[], object], min_time: float, min_runs: int = 5, warmup: int = 2) -> dict:
+    for _ in range(warmup):
+        call()
+    times = []
+    started = time.perf_counter()
+    while len(times) < min_runs or time.perf_counter() - started < min_time:
+        t0 = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return {
+        "runs": len(times),
+        "p50Ms": round(statistics.median(times) * 1000.0, 3),
+        "p95Ms": round(times[min(len(times) - 1, int(0.95 * len(times)))] * 1000.0, 3),
+        "meanMs": round(statistics.fmean(times) * 1000.0, 3),
+    }
+
+
+class SlowTokenizer:
+    """DistilBertTokenizer (pure Python) producing the same arrays as FastTokenizer."""
+
+    def __init__(self, model_dir, max_length: int = MAX_SEQ_LENGTH):
+        from transformers import DistilBertTokenizer
+
+        self.tokenizer = DistilBertTokenizer.from_pretrained(str(_find_tokenizer_file(resolve_model_dir(model_dir)).parent))
+        self.max_length = max_length
+
+    def __call__(self, texts: List[str]):
+        encoded = self.tokenizer(
+            texts, padding="longest", truncation=True, max_length=self.max_length, return_tensors="np"
+        )
+        return {"input_ids": encoded["input_ids"].astype("int64"), "attention_mask": encoded["attention_mask"].astype("int64")}
+
+
+def bench_tokenizers(model: str, args) -> List[dict]:
+    fast = FastTokenizer(model)
+    tokenizers = {"fast": lambda: fast, "slow": lambda: SlowTokenizer(model)}
+    rows = []
+    for name in args.tokenizers:
+        try:
+            tokenizer = tokenizers[name]()
+        except Exception as e:
+            rows.append({"model": model, "tokenizer": name, "skipped": f"{type(e).__name__}: {e}"})
+            continue
+        for seq_length in args.seq_lengths:
+            for batch in args.batch_sizes:
+                texts = make_texts(fast, batch, seq_length)
+                timing = measure(lambda: tokenizer(texts), args.min_time)
+                rows.append({
+                    "model": model,
+                    "tokenizer": name,
+                    "batch": batch,
+                    "seqLength": seq_length,
+                    **timing,
+                    "textsPerSec": round(batch / (timing["meanMs"] / 1000.0), 1),
+                })
+    return rows
+
+
+def load_backend(model: str, backend: str, threads: int):
+    from intent_backends import OnnxIntentBackend, TorchIntentBackend
+
+    if backend == "torch":
+        return TorchIntentBackend(model, num_threads=threads)
+    return OnnxIntentBackend(model, quantize=backend == "onnx-int8", intra_op_threads=threads, inter_op_threads=1)
+
+
+def bench_backend(model: str, backend: str, args) -> List[dict]:
+    rows = []
+    for threads in args.threads:
+        try:
+            # ORT fixes its thread pool per session; torch's is per process
+            loaded = load_backend(model, backend, threads)
+        except Exception as e:
+            rows.append({"model": model, "backend": backend, "threads": threads, "skipped": f"{type(e).__name__}: {e}"})
+            break
+        if backend == "torch":
+            loaded._torch.set_num_threads(threads)
+        for seq_length in args.seq_lengths:
+            for batch in args.batch_sizes:
+                texts = make_texts(loaded.tokenizer, batch, seq_length)
+                encoded = loaded.tokenize(texts)
+                logits = loaded.forward(encoded)
+                forward = measure(lambda: loaded.forward(encoded), args.min_time)
+                tokenize = measure(lambda: loaded.tokenize(texts), args.min_time / 4)
+                postprocess = measure(lambda: loaded.postprocess(logits), args.min_time / 4)
+                rows.append({
+                    "model": model,
+                    "backend": backend,
+                    "version": loaded.version,
+                    "threads": threads,
+                    "batch": batch,
+                    "seqLength": seq_length,
+                    "paddedLength": int(encoded["input_ids"].shape[1]),
+                    **forward,
+                    "tokenizeMs": tokenize["p50Ms"],
+                    "postprocessMs": postprocess["p50Ms"],
+                    "textsPerSec": round(batch / (forward["meanMs"] / 1000.0), 1),
+                })
+    return rows
+
+
+def run_isolated(model: str, backend: str, args) -> List[dict]:
+    """bench_backend in a fresh interpreter, so thread pools and allocators start clean."""
+    command = [
+        sys.executable, str(Path(__file__).resolve()),
+        "--worker", model, backend,
+        "--threads", ",".join(map(str, args.threads)),
+        "--batch-sizes", ",".join(map(str, args.batch_sizes)),
+        "--seq-lengths", ",".join(map(str, args.seq_lengths)),
+        "--min-time", str(args.min_time),
+    ]
+    result = subprocess.run(command, cwd=BASE_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit status {result.returncode}"
+        return [{"model": model, "backend": backend, "skipped": error}]
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def default_models() -> List[str]:
+    from model_registry import read_registry
+
+    paths = []
+    for spec in read_registry()["models"].values():
+        if spec.path not in paths:
+            paths.append(spec.path)
+    return paths
+
+
+def print_table(title: str, rows: List[dict], keys: List[str], metrics: List[str]):
+    measured = [r for r in rows if "skipped" not in r]
+    print(f"\n{title}")
+    if measured:
+        widths = [max(len(k), *(len(str(r[k])) for r in measured)) for k in keys]
+        print("  ".join(k.ljust(w) for k, w in zip(keys, widths)) + "".join(f"{m:>14}" for m in metrics))
+        for row in measured:
+            print("  ".join(str(row[k]).ljust(w) for k, w in zip(keys, widths)) + "".join(f"{row[m]:>14}" for m in metrics))
+    for row in rows:
+        if "skipped" in row:
+            label = " ".join(str(row[k]) for k in keys if k in row)
+            print(f"  skipped {label}: {row['skipped']}")
+
+
+def best_settings(rows: List[dict]) -> List[dict]:
+    """Fastest backend and thread count for each model, batch size and sequence length."""
+    best: Dict[tuple, dict] = {}
+    for row in rows:
+        if "skipped" in row:
+            continue
+        key = (row["model"], row["batch"], row["seqLength"])
+        if key not in best or row["textsPerSec"] > best[key]["textsPerSec"]:
+            best[key] = {k: row[k] for k in ("model", "batch", "seqLength", "backend", "threads", "p50Ms", "textsPerSec")}
+    return list(best.values())
+
+
+def main():
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--models", type=lambda v: v.split(","), help="model directories in backend/ (default: models.json)")
+    parser.add_argument("--backends", type=lambda v: v.split(","), default=BACKENDS, help=",".join(BACKENDS))
+    parser.add_argument("--tokenizers", type=lambda v: v.split(","), default=TOKENIZERS, help=",".join(TOKENIZERS))
+    parser.add_argument("--batch-sizes", type=_int_list, default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--seq-lengths", type=_int_list, default=[16, 32, 64, 128], help="tokens per text")
+    parser.add_argument("--threads", type=_int_list, default=sorted({1, 2, 4, cpus} & set(range(1, cpus + 1))))
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds measured per cell")
+    parser.add_argument("--skip-tokenizers", action="store_true")
+    parser.add_argument("--output", help="results file (default bench_results/inference-<time>.json)")
+    parser.add_argument("--worker", nargs=2, metavar=("MODEL", "BACKEND"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # Child of run_isolated: one runtime, rows as JSON on the last stdout line
+        print(json.dumps(bench_backend(*args.worker, args)))
+        return
+
+    models = args.models or default_models()
+    results = {
+        "startedAt": datetime.utcnow().isoformat(),
+        "cpus": cpus,
+        "maxSeqLength": MAX_SEQ_LENGTH,
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "worker")},
+        "tokenize": [],
+        "forward": [],
+    }
+    for model in models:
+        if not resolve_model_dir(model).is_dir():
+            print(f"Warning: {model} is not a model directory in {BASE_DIR}; skipped")
+            continue
+        if not args.skip_tokenizers:
+            print(f"tokenizers: {model} ...", flush=True)
+            results["tokenize"] += bench_tokenizers(model, args)
+        for backend in args.backends:
+            print(f"{backend}: {model} ...", flush=True)
+            results["forward"] += run_isolated(model, backend, args)
+    results["best"] = best_settings(results["forward"])
+
+    if results["tokenize"]:
+        print_table("tokenize", results["tokenize"], ["model", "tokenizer", "batch", "seqLength"], ["p50Ms", "p95Ms", "textsPerSec"])
+    print_table(
+        "forward",
+        results["forward"],
+        ["model", "backend", "threads", "batch", "seqLength"],
+        ["p50Ms", "p95Ms", "tokenizeMs", "postprocessMs", "textsPerSec"],
+    )
+    if results["best"]:
+        print_table("best", results["best"], ["model", "batch", "seqLength", "backend", "threads"], ["p50Ms", "textsPerSec"])
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"inference-{datetime.utcnow():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"\nresults: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import WebSocket
+
+from connections import Connection, ConnectionManager
+
+
+# Delivery targets are plain strings so they can be used as broker keys
+def user_target(clientId: str, userId: str) -> str:
+    return f"user:{clientId}:{userId}"
+
+
+def agent_target(agentId: str) -> str:
+    return f"agent:{agentId}"
+
+
+class PresenceRegistry:
+    """Which node currently holds the socket for a target. Entries expire unless refreshed."""
+
+    async def claim(self, target: str, node_id: str, ttl: float):
+        raise NotImplementedError
+
+    async def release(self, target: str, node_id: str):
+        raise NotImplementedError
+
+    async def lookup(self, target: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def heartbeat(self, targets, node_id: str, ttl: float) -> List[str]:
+        """Refresh this node's entries; returns the targets another node has claimed since (left as they are)."""
+        lost = []
+        for target in targets:
+            if await self.lookup(target) in (None, node_id):
+                await self.claim(target, node_id, ttl)
+            else:
+                lost.append(target)
+        return lost
+
+    async def close(self):
+        pass
+
+
+class InMemoryPresenceRegistry(PresenceRegistry):
+    def __init__(self, entries: Optional[dict] = None):
+        # Pass the same dict to several registries to simulate a shared store in tests
+        self.entries: Dict[str, tuple] = entries if entries is not None else {}
+
+    async def claim(self, target, node_id, ttl):
+        self.entries[target] = (node_id, time.monotonic() + ttl)
+
+    async def release(self, target, node_id):
+        entry = self.entries.get(target)
+        if entry and entry[0] == node_id:
+            del self.entries[target]
+
+    async def lookup(self, target):
+        entry = self.entries.get(target)
+        if entry is None:
+            return None
+        node_id, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[target]
+            return None
+        return node_id
+
+
+class RedisPresenceRegistry(PresenceRegistry):
+    # Only delete the key if this node still owns it (the socket may have moved)
+    _RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+    # Only refresh the key if it is unclaimed or still this node's (the socket may have moved)
+    _REFRESH = (
+        "local owner = redis.call('get', KEYS[1]) "
+        "if owner == false or owner == ARGV[1] then redis.call('set', KEYS[1], ARGV[1], 'px', ARGV[2]) return 1 end return 0"
+    )
+
+    def __init__(self, redis, prefix: str = "chatwidget:presence:"):
+        self.redis = redis
+        self.prefix = prefix
+
+    async def claim(self, target, node_id, ttl):
+        await self.redis.set(self.prefix + target, node_id, px=int(ttl * 1000))
+
+    async def release(self, target, node_id):
+        await self.redis.eval(self._RELEASE, 1, self.prefix + target, node_id)
+
+    async def lookup(self, target):
+        node_id = await self.redis.get(self.prefix + target)
+        return node_id.decode() if isinstance(node_id, bytes) else node_id
+
+    async def heartbeat(self, targets, node_id, ttl):
+        targets = list(targets)
+        pipe = self.redis.pipeline(transaction=False)
+        for target in targets:
+            pipe.eval(self._REFRESH, 1, self.prefix + target, node_id, int(ttl * 1000))
+        refreshed = await pipe.execute()
+        return [target for target, ok in zip(targets, refreshed) if not ok]
+
+    async def close(self):
+        await self.redis.close()
+
+
+DeliverLocal = Callable[[str, dict], Awaitable[bool]]
+
+
+class MessageBus:
+    """Point-to-point delivery of payloads to a specific node."""
+
+    async def start(self, node_id: str, on_message: DeliverLocal):
+        raise NotImplementedError
+
+    async def publish(self, node_id: str, target: str, payload: dict) -> int:
+        """Number of nodes that received the payload (0: that node is gone)."""
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+
+class InMemoryMessageBus(MessageBus):
+    def __init__(self, hub: Optional[dict] = None):
+        # node_id -> handler; share the hub between buses to simulate several nodes
+        self.hub = hub if hub is not None else {}
+        self.node_id = None
+
+    async def start(self, node_id, on_message):
+        self.node_id = node_id
+        self.hub[node_id] = on_message
+
+    async def publish(self, node_id, target, payload):
+        handler = self.hub.get(node_id)
+        if handler is None:
+            return 0
+        await handler(target, payload)
+        return 1
+
+    async def stop(self):
+        self.hub.pop(self.node_id, None)
+
+
+class RedisMessageBus(MessageBus):
+    def __init__(self, redis, prefix: str = "chatwidget:node:"):
+        self.redis = redis
+        self.prefix = prefix
+        self.node_id = None
+        self._task = None
+
+    async def start(self, node_id, on_message):
+        self.node_id = node_id
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(self.prefix + node_id)
+        self._task = asyncio.create_task(self._listen(pubsub, on_message), name="message-bus")
+
+    async def _listen(self, pubsub, on_message):
+        backoff = 0.5
+        while True:
+            try:
+                async for message in pubsub.listen():
+                    backoff = 0.5
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        envelope = json.loads(message["data"])
+                        target, payload = envelope["target"], envelope["payload"]
+                    except (ValueError, KeyError, TypeError) as e:
+                        print(f"Warning: ignoring malformed bus message: {e}")
+                        continue
+                    try:
+                        await on_message(target, payload)
+                    except Exception as e:
+                        print(f"Warning: bus delivery to {target} failed: {e}")
+            except Exception as e:
+                print(f"Warning: message bus connection lost: {e}")
+            # Resubscribe with capped exponential backoff
+            while True:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                try:
+                    await pubsub.reset()
+                    pubsub = self.redis.pubsub()
+                    await pubsub.subscribe(self.prefix + self.node_id)
+                    break
+                except Exception as e:
+                    print(f"Warning: message bus resubscribe failed: {e}")
+
+    async def publish(self, node_id, target, payload):
+        return await self.redis.publish(self.prefix + node_id, json.dumps({"target": target, "payload": payload}, default=str))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+
+class SocketRouter:
+    """Delivers payloads to user/agent sockets on whichever node holds them.
+
+    Local sockets (owned by the ConnectionManager) are sent to directly;
+    otherwise the presence registry says which node owns the target and
+    the payload is published to that node.
+    """
+
+    def __init__(
+        self,
+        bus: MessageBus,
+        presence: PresenceRegistry,
+        manager: ConnectionManager,
+        heartbeat_interval: float = 10.0,
+        ttl: float = 30.0,
+    ):
+        self.node_id = uuid.uuid4().hex
+        self.bus = bus
+        self.presence = presence
+        self.manager = manager
+        self.heartbeat_interval = heartbeat_interval
+        self.ttl = ttl
+        self._heartbeat_task = None
+        self.local_deliveries = 0
+        self.remote_deliveries = 0
+        self.undeliverable = 0
+        self.moved = 0
+
+    async def start(self):
+        await self.manager.start()
+        await self.bus.start(self.node_id, self._deliver_local)
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+        for target in list(self.manager.connections):
+            await self.presence.release(target, self.node_id)
+        await self.manager.stop()
+        await self.bus.stop()
+        await self.presence.close()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                lost = await self.presence.heartbeat(list(self.manager.connections), self.node_id, self.ttl)
+            except Exception as e:
+                print(f"Warning: presence heartbeat failed: {e}")
+                continue
+            for target in lost:
+                # Reconnected on another node; as with a local reconnect, the new socket wins
+                connection = self.manager.get(target)
+                if connection is not None:
+                    self.moved += 1
+                    self.manager.remove(connection)
+
+    async def connect(self, target: str, websocket: WebSocket) -> Connection:
+        connection = await self.manager.connect(target, websocket)
+        await self.presence.claim(target, self.node_id, self.ttl)
+        return connection
+
+    async def disconnect(self, connection: Connection):
+        # A reconnect may already have replaced this socket; only then keep the presence entry
+        if self.manager.remove(connection):
+            await self.presence.release(connection.target, self.node_id)
+
+    def is_local(self, target: str) -> bool:
+        return target in self.manager.connections
+
+    async def _deliver_local(self, target: str, payload: dict) -> bool:
+        return self.manager.send(target, payload)
+
+    async def deliver(self, target: str, payload: dict) -> bool:
+        """True if the target is connected somewhere and the payload was handed off.
+
+        Never waits on the receiving socket: local sends are queued and
+        remote ones are a single publish.
+        """
+        if self.is_local(target):
+            if self.manager.send(target, payload):
+                self.local_deliveries += 1
+                return True
+            self.undeliverable += 1
+            return False
+        node_id = await self.presence.lookup(target)
+        if node_id is None or node_id == self.node_id:
+            self.undeliverable += 1
+            return False
+        if not await self.bus.publish(node_id, target, payload):
+            # Nobody is listening for that node any more; drop its stale claim
+            self.undeliverable += 1
+            await self.presence.release(target, node_id)
+            return False
+        self.remote_deliveries += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "nodeId": self.node_id,
+            **self.manager.stats(),
+            "localDeliveries": self.local_deliveries,
+            "remoteDeliveries": self.remote_deliveries,
+            "undeliverable": self.undeliverable,
+            "moved": self.moved,
+        }
+
+
+def create_router() -> SocketRouter:
+    url = os.getenv("BUS_URL")
+    if url:
+        import redis.asyncio as redis
+
+        client = redis.from_url(url)
+        bus, presence = RedisMessageBus(client), RedisPresenceRegistry(client)
+    else:
+        bus, presence = InMemoryMessageBus(), InMemoryPresenceRegistry()
+    manager = ConnectionManager(
+        max_queue=int(os.getenv("WS_MAX_OUTBOUND_QUEUE", "256")),
+        send_timeout=float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10")),
+        ping_interval=float(os.getenv("WS_PING_INTERVAL_SECONDS", "20")),
+        idle_timeout=float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "60")),
+    )
+    return SocketRouter(
+        bus,
+        presence,
+        manager,
+        heartbeat_interval=float(os.getenv("PRESENCE_HEARTBEAT_SECONDS", "10")),
+        ttl=float(os.getenv("PRESENCE_TTL_SECONDS", "30")),
+    )
@@ -0,0 +1,270 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from tracing import span
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache with a TTL per entry type.
+
+    Keys are tuples whose first element is the entry type ("widget",
+    "agents", ...), which selects the TTL and groups the hit/miss counters.
+    Invalidation works on key prefixes, e.g. ("agents", websiteId) drops
+    every cached intent filter for that website.
+    """
+
+    def __init__(self, maxsize: int = 1024, default_ttl: float = 60.0, ttls: Optional[Dict[str, float]] = None):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self._data: "OrderedDict[Tuple, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        # Bumped on every invalidation so loads that raced with a write are not stored
+        self._generation = 0
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Tuple, default: Any = None) -> Any:
+        value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def _lookup(self, key: Tuple) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses[key[0]] += 1
+            return _MISSING
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses[key[0]] += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        self.hits[key[0]] += 1
+        return value
+
+    def set(self, key: Tuple, value: Any, ttl: Optional[float] = None):
+        ttl = ttl if ttl is not None else self.ttls.get(key[0], self.default_ttl)
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_load(self, key: Tuple, loader: Callable[[], Awaitable[Any]], ttl: Optional[float] = None) -> Any:
+        with span("cache", kind=key[0]) as current:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                current.set("cache.result", "hit")
+                return value
+            # Single flight: concurrent misses on the same key share one load
+            inflight = self._inflight.get(key)
+            while inflight is not None:
+                current.set("cache.result", "shared")
+                try:
+                    return await asyncio.shield(inflight)
+                except asyncio.CancelledError:
+                    # Only the request that was loading got cancelled: take the load over
+                    if not inflight.cancelled():
+                        raise
+                inflight = self._inflight.get(key)
+            current.set("cache.result", "load")
+            return await self._load(key, loader, ttl)
+
+    async def _load(self, key: Tuple, loader: Callable[[], Awaitable[Any]], ttl: Optional[float]) -> Any:
+        generation = self._generation
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved so an unawaited failure doesn't log a warning
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if generation == self._generation:
+                self.set(key, value, ttl)
+            return value
+        finally:
+            del self._inflight[key]
+            # Cancelled mid-load: release the requests sharing it
+            if not future.done():
+                future.cancel()
+
+    def invalidate_local(self, prefix: Tuple[Hashable, ...]) -> int:
+        self._generation += 1
+        self.invalidations += 1
+        size = len(prefix)
+        stale = [key for key in self._data if key[:size] == prefix]
+        for key in stale:
+            del self._data[key]
+        return len(stale)
+
+    def clear(self):
+        self._generation += 1
+        self._data.clear()
+
+    def stats(self) -> dict:
+        kinds = set(self.hits) | set(self.misses)
+        by_kind = {}
+        for kind in sorted(kinds):
+            total = self.hits[kind] + self.misses[kind]
+            by_kind[kind] = {
+                "hits": self.hits[kind],
+                "misses": self.misses[kind],
+                "hitRatio": self.hits[kind] / total if total else 0.0,
+            }
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "byType": by_kind,
+        }
+
+
+class InvalidationChannel:
+    """Broadcasts invalidated key prefixes to the other workers (the empty prefix drops everything)."""
+
+    async def start(self, handler: Callable[[Tuple], None]):
+        raise NotImplementedError
+
+    async def publish(self, prefix: Tuple):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+
+class InMemoryInvalidationChannel(InvalidationChannel):
+    """Process-local pub/sub. Instances sharing a `hub` see each other's messages."""
+
+    def __init__(self, hub: Optional[list] = None):
+        self.hub = hub if hub is not None else []
+        self._handler = None
+
+    async def start(self, handler):
+        self._handler = handler
+        self.hub.append(self)
+
+    async def publish(self, prefix):
+        for channel in list(self.hub):
+            if channel is not self and channel._handler:
+                channel._handler(tuple(prefix))
+
+    async def stop(self):
+        if self in self.hub:
+            self.hub.remove(self)
+
+
+class RedisInvalidationChannel(InvalidationChannel):
+    def __init__(self, url: str, channel: str = "chatwidget:cache-invalidation"):
+        self.url = url
+        self.channel = channel
+        self.node_id = uuid.uuid4().hex
+        self._redis = None
+        self._task = None
+
+    async def start(self, handler):
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(self.url)
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(self.channel)
+        self._task = asyncio.create_task(self._listen(pubsub, handler), name="cache-invalidation")
+
+    async def _listen(self, pubsub, handler):
+        backoff = 0.5
+        while True:
+            try:
+                async for message in pubsub.listen():
+                    backoff = 0.5
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        payload = json.loads(message["data"])
+                        node, prefix = payload["node"], tuple(payload["prefix"])
+                    except (ValueError, KeyError, TypeError) as e:
+                        print(f"Warning: ignoring malformed cache invalidation: {e}")
+                        continue
+                    if node != self.node_id:
+                        handler(prefix)
+            except Exception as e:
+                print(f"Warning: cache invalidation channel lost: {e}")
+            # Resubscribe with capped exponential backoff
+            while True:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                try:
+                    await pubsub.reset()
+                    pubsub = self._redis.pubsub()
+                    await pubsub.subscribe(self.channel)
+                    break
+                except Exception as e:
+                    print(f"Warning: cache invalidation resubscribe failed: {e}")
+            # Invalidations published while disconnected were missed: drop everything cached locally
+            handler(())
+
+    async def publish(self, prefix):
+        await self._redis.publish(self.channel, json.dumps({"node": self.node_id, "prefix": list(prefix)}))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self._redis:
+            await self._redis.close()
+
+
+class CoherentCache(TTLCache):
+    """TTLCache whose invalidations are also applied on every other worker."""
+
+    def __init__(self, channel: InvalidationChannel, **kwargs):
+        super().__init__(**kwargs)
+        self.channel = channel
+        self.remote_invalidations = 0
+
+    def _on_remote(self, prefix: Tuple):
+        self.remote_invalidations += 1
+        self.invalidate_local(prefix)
+
+    async def start(self):
+        await self.channel.start(self._on_remote)
+
+    async def stop(self):
+        await self.channel.stop()
+
+    async def invalidate(self, *prefix):
+        self.invalidate_local(prefix)
+        await self.channel.publish(prefix)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["remoteInvalidations"] = self.remote_invalidations
+        return stats
+
+
+def create_cache() -> CoherentCache:
+    url = os.getenv("CACHE_INVALIDATION_URL")
+    channel = RedisInvalidationChannel(url) if url else InMemoryInvalidationChannel()
+    return CoherentCache(
+        channel,
+        maxsize=int(os.getenv("CACHE_MAX_ENTRIES", "10000")),
+        default_ttl=float(os.getenv("CACHE_DEFAULT_TTL", "60")),
+        ttls={
+            "widget": float(os.getenv("CACHE_TTL_WIDGET", "300")),
+            "agents": float(os.getenv("CACHE_TTL_AGENTS", "60")),
+            "chains": float(os.getenv("CACHE_TTL_CHAINS", "60")),
+            "chain_plans": float(os.getenv("CACHE_TTL_CHAINS", "60")),
+            "session": float(os.getenv("CACHE_TTL_SESSION", "30")),
+        },
+    )
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from intent_cache import normalize_text
+
+BASE_DIR = Path(__file__).resolve().parent
+CATALOG_PATH = BASE_DIR / "catalog.json"
+
+KINDS = {"brands": "brand", "categories": "category"}
+
+
+class Automaton:
+    """Aho-Corasick automaton over normalized terms; one pass finds every occurrence."""
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[int, dict]]] = [[]]
+
+    def add(self, term: str, value: dict):
+        node = 0
+        for ch in term:
+            child = self._goto[node].get(ch)
+            if child is None:
+                child = len(self._goto)
+                self._goto[node][ch] = child
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = child
+        self._out[node].append((len(term), value))
+
+    def build(self):
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for ch, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+                queue.append(child)
+
+    def iter(self, text: str) -> Iterator[Tuple[int, int, dict]]:
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, value in out[node]:
+                yield i + 1 - length, i + 1, value
+
+
+class CatalogNamespace:
+    """Brand and category names/synonyms of one client, compiled into a single automaton."""
+
+    def __init__(self, data: dict):
+        self.automaton = Automaton()
+        self.terms = 0
+        self.entries = {"brand": 0, "category": 0}
+        for key, kind in KINDS.items():
+            for entry in data.get(key, []):
+                value = {"kind": kind, "id": str(entry["id"]), "name": entry.get("name", entry["id"])}
+                self.entries[kind] += 1
+                for term in {normalize_text(t) for t in [value["name"], *entry.get("synonyms", [])]}:
+                    if term:
+                        self.automaton.add(term, value)
+                        self.terms += 1
+        self.automaton.build()
+
+    def lookup(self, text: str) -> Dict[str, dict]:
+        """Canonical brand/category found in normalized `text`, keyed by kind.
+
+        Only whole-word matches count; overlapping matches go to the longest
+        leftmost one, and a later mention of the same kind wins (as with the
+        noun scan in the extractor).
+        """
+        matches = []
+        for start, end, value in self.automaton.iter(text):
+            if (start == 0 or text[start - 1] == " ") and (end == len(text) or text[end] == " "):
+                matches.append((start, -end, value))
+        found = {}
+        covered = 0
+        for start, neg_end, value in sorted(matches, key=lambda m: (m[0], m[1])):
+            if start < covered:
+                continue
+            covered = -neg_end
+            found[value["kind"]] = value
+        return found
+
+
+class CatalogIndex:
+    """Per-clientId brand/category lookup built from a catalog JSON file.
+
+    The file holds a "default" namespace and optional per-client ones under
+    "clients"; clients without their own catalog use the default. The file
+    is polled and rebuilt in a worker thread when it changes, and the new
+    namespaces are swapped in at once, so lookups never see a partial index.
+    """
+
+    def __init__(self, path=None, reload_interval: float = 5.0, on_reload: Optional[Callable[[], None]] = None):
+        self.path = Path(path or CATALOG_PATH)
+        self.reload_interval = reload_interval
+        self.on_reload = on_reload
+        self.namespaces: Dict[str, CatalogNamespace] = {}
+        self.default = CatalogNamespace({})
+        self._mtime = None
+        self._task = None
+        self.version = 0
+        self.reloads = 0
+        self.last_build_ms = 0.0
+        self.lookups = 0
+        self.load()
+
+    def _build(self) -> Tuple[CatalogNamespace, Dict[str, CatalogNamespace]]:
+        with open(self.path, encoding="utf-8") as f:
+            raw = json.load(f)
+        clients = {clientId: CatalogNamespace(data) for clientId, data in raw.get("clients", {}).items()}
+        return CatalogNamespace(raw.get("default", {})), clients
+
+    def load(self) -> bool:
+        if not self.path.exists():
+            print(f"Warning: catalog {self.path} not found; brand/category lookup disabled")
+            return False
+        mtime = self.path.stat().st_mtime_ns
+        started = time.perf_counter()
+        default, clients = self._build()
+        self.default, self.namespaces = default, clients
+        self._mtime = mtime
+        self.version += 1
+        self.last_build_ms = (time.perf_counter() - started) * 1000.0
+        return True
+
+    async def reload(self, force: bool = False) -> bool:
+        if not self.path.exists():
+            return False
+        if not force and self.path.stat().st_mtime_ns == self._mtime:
+            return False
+        try:
+            loaded = await asyncio.get_running_loop().run_in_executor(None, self.load)
+        except Exception as e:
+            # Keep serving the previous index if the new file is invalid
+            print(f"Warning: catalog reload from {self.path} failed: {e}")
+            return False
+        if loaded:
+            self.reloads += 1
+            if self.on_reload:
+                self.on_reload()
+        return loaded
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            await self.reload()
+
+    async def start(self):
+        if self.reload_interval > 0:
+            self._task = asyncio.create_task(self._watch(), name="catalog-watch")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def namespace(self, clientId: Optional[str] = None) -> CatalogNamespace:
+        return self.namespaces.get(clientId, self.default) if clientId else self.default
+
+    def lookup(self, text: str, clientId: Optional[str] = None) -> Dict[str, dict]:
+        self.lookups += 1
+        return self.namespace(clientId).lookup(text)
+
+    def stats(self) -> dict:
+        return {
+            "path": str(self.path),
+            "version": self.version,
+            "reloads": self.reloads,
+            "lastBuildMs": self.last_build_ms,
+            "lookups": self.lookups,
+            "default": {"terms": self.default.terms, **self.default.entries},
+            "clients": {
+                clientId: {"terms": ns.terms, **ns.entries} for clientId, ns in self.namespaces.items()
+            },
+        }
+
+
+def create_catalog(on_reload: Optional[Callable[[], None]] = None) -> CatalogIndex:
+    return CatalogIndex(
+        os.getenv("CATALOG_PATH"),
+        reload_interval=float(os.getenv("CATALOG_RELOAD_SECONDS", "5")),
+        on_reload=on_reload,
+    )
@@ -0,0 +1,247 @@
+import asyncio
+import itertools
+import os
+import re
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from metrics import histogram
+from tracing import span
+
+CHAIN_STAGE_SECONDS = histogram("chain_stage_seconds", "One agent call within a chain run", ["intent", "status"])
+
+# How a stage builds its request from the previous stage's output: {param: path}.
+# Chains can override per intent with `paramMap`; paths may index into lists ("products.0.id")
+# and list fallbacks ("id|category": the first one present).
+DEFAULT_PARAM_MAPS = {
+    "recommend_product": {"product": "id|category"},
+    "place_order": {"product_id": "id|category"},
+    "track_order": {"order_id": "order_id"},
+}
+# Stages that need details from the user: the run stops there and hands the widget a pending order
+INPUT_STAGES = {"place_order"}
+
+FALLBACK_ERROR = "Sorry, something went wrong."
+
+
+def _lookup(params: dict, path: str):
+    if "|" in path:
+        return next((v for v in (_lookup(params, p) for p in path.split("|")) if v is not None), None)
+    value = params
+    for part in path.split("."):
+        if isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+    return value
+
+
+def bot_message(result: str, params: Optional[dict] = None) -> dict:
+    """An agent result shaped the way the widget renders it (product cards, order details, text)."""
+    params = params or {}
+    message = {"sender": "bot", "timestamp": datetime.utcnow().isoformat()}
+    if params.get("products"):
+        message.update(result=result, products=params["products"])
+    elif params.get("order_id"):
+        message["order_details"] = params
+    elif params.get("estimated_delivery"):
+        message["order_confirmation"] = params
+    else:
+        message["text"] = result
+    return message
+
+
+class Stage:
+    """One agent call, with its route picked at compile time."""
+
+    __slots__ = ("intent", "agent", "route", "method", "param_map", "error")
+
+    def __init__(self, intent: str, agent: Optional[dict], param_map: Optional[dict] = None):
+        self.intent = intent
+        self.agent = agent
+        self.param_map = param_map if param_map is not None else DEFAULT_PARAM_MAPS.get(intent)
+        self.route = self.method = self.error = None
+        if agent is None:
+            self.error = f"No agent found for intent: {intent}"
+            return
+        features = agent.get("features") or []
+        # Same choice as the widget: the feature whose route mentions the intent (minus its prefix)
+        name = re.sub(r"^[a-z]+_", "", intent).lower()
+        feature = next((f for f in features if name in f.get("route", "").lower()), features[0] if features else None)
+        if feature is None:
+            self.error = "No route found for this agent."
+            return
+        self.route = feature["route"]
+        self.method = (feature.get("method") or "GET").upper()
+
+    def request_params(self, previous: dict) -> dict:
+        if not self.param_map:
+            return dict(previous)
+        return {param: _lookup(previous, path) for param, path in self.param_map.items()}
+
+
+class ChainPlan:
+    """A chain compiled into levels: every stage in a level depends only on the level before.
+
+    `agentSequence` entries are run one after another as in the widget; an
+    entry that is a list is a group of independent stages run concurrently.
+    """
+
+    def __init__(self, chainId: Optional[str], levels: List[List[Stage]], stage_timeout: float):
+        self.chainId = chainId
+        self.levels = levels
+        self.stage_timeout = stage_timeout
+
+    @property
+    def stages(self) -> int:
+        return sum(len(level) for level in self.levels)
+
+
+def compile_plans(agents: List[dict], chains: List[dict], stage_timeout: float) -> Dict[str, ChainPlan]:
+    """Plans for one website keyed by the intent that starts them; intents with an agent but no chain run alone."""
+    by_intent = {agent["intent"]: agent for agent in agents if agent.get("intent")}
+    plans = {intent: ChainPlan(None, [[Stage(intent, agent)]], stage_timeout) for intent, agent in by_intent.items()}
+    for chain in chains:
+        param_maps = chain.get("paramMap") or {}
+        levels = []
+        for entry in chain.get("agentSequence") or []:
+            group = entry if isinstance(entry, list) else [entry]
+            levels.append([Stage(intent, by_intent.get(intent), param_maps.get(intent)) for intent in group])
+        if not levels:
+            continue
+        plan = ChainPlan(chain.get("chainId"), levels, float(chain.get("stageTimeout") or stage_timeout))
+        for stage in levels[0]:
+            plans[stage.intent] = plan
+    return plans
+
+
+class ChainExecutor:
+    """Runs a website's agent chains server-side, streaming each stage's result as it finishes.
+
+    The message is classified once by the caller; `run` then executes the
+    plan for that intent level by level. Stages in a level run concurrently,
+    each bounded by the stage timeout, and the merged output of a level is
+    the input of the next. A failed or timed-out stage ends the run after
+    its level. Compiled plans are cached per websiteId in the shared cache
+    (invalidated with agents/chains).
+    """
+
+    def __init__(self, repos, cache, base_url: str, stage_timeout: float = 5.0):
+        self.repos = repos
+        self.cache = cache
+        self.base_url = base_url
+        self.stage_timeout = stage_timeout
+        self._client = None
+        self._runs = itertools.count(1)
+        self.runs = 0
+        self.stage_counts: Dict[str, int] = {}
+
+    async def start(self):
+        import httpx
+
+        self._client = httpx.AsyncClient(base_url=self.base_url)
+
+    async def stop(self):
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def plans(self, websiteId: str) -> Dict[str, ChainPlan]:
+        async def load():
+            agents, chains = await asyncio.gather(self.repos.agents.find(websiteId), self.repos.chains.find(websiteId))
+            return compile_plans(agents, chains, self.stage_timeout)
+
+        return await self.cache.get_or_load(("chain_plans", websiteId), load)
+
+    async def call(self, stage: Stage, params: dict) -> dict:
+        """{"result", "params"} or {"error"}, as the widget's executeAgent returns them."""
+        if stage.error:
+            return {"error": stage.error}
+        route, params = stage.route, {k: v for k, v in params.items() if v is not None}
+        if params.get("category"):
+            route = f"{route.rstrip('/')}/{str(params.pop('category')).lower()}/"
+        if stage.method == "GET":
+            response = await self._client.get(route, params=params)
+        else:
+            response = await self._client.request(stage.method, route, json=params)
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        if response.is_error:
+            detail = data.get("detail") if isinstance(data, dict) else None
+            if isinstance(detail, list) and detail and isinstance(detail[0], dict) and detail[0].get("msg"):
+                return {"error": detail[0]["msg"]}
+            return {"error": FALLBACK_ERROR}
+        if isinstance(data, dict) and data.get("message"):
+            return {"result": data["message"], "params": data}
+        if isinstance(data, list) and data:
+            count = len(data)
+            return {"result": f"{count} product{'s' if count > 1 else ''} found", "params": {"products": data}}
+        return {"result": "Action completed successfully", "params": data if isinstance(data, dict) else {}}
+
+    async def _run_stage(self, run: dict, index: int, stage: Stage, params: dict, timeout: float, emit: Callable[[dict], None]) -> dict:
+        started = time.perf_counter()
+        request = stage.request_params(params)
+        info = {**run, "stage": stage.intent, "index": index}
+        if stage.intent in INPUT_STAGES and not stage.error:
+            # The widget collects name/address/quantity and places the order itself
+            emit({"chain": {**info, "status": "input_required"}, "pendingOrder": request})
+            return {"status": "input_required"}
+        with span("chain.stage", intent=stage.intent) as current:
+            try:
+                outcome = await asyncio.wait_for(self.call(stage, request), timeout)
+                status = "error" if "error" in outcome else "ok"
+            except asyncio.TimeoutError:
+                outcome, status = {"error": "That took too long to answer. Please try again."}, "timeout"
+            except Exception as e:
+                print(f"Warning: chain stage {stage.intent} failed: {e}")
+                outcome, status = {"error": FALLBACK_ERROR}, "error"
+            current.set("chain.status", status)
+        elapsed = time.perf_counter() - started
+        CHAIN_STAGE_SECONDS.observe(elapsed, stage.intent, status)
+        self.stage_counts[status] = self.stage_counts.get(status, 0) + 1
+        message = bot_message(outcome["error"]) if status != "ok" else bot_message(outcome["result"], outcome.get("params"))
+        emit({"chain": {**info, "status": status, "elapsedMs": round(elapsed * 1000.0, 1)}, "message": message})
+        return {"status": status, "params": outcome.get("params") or {}}
+
+    async def run(self, websiteId: str, intent: str, params: dict, emit: Callable[[dict], None]) -> Optional[dict]:
+        """Run the plan for `intent`, calling `emit` with each stage's result; None if there is no plan."""
+        plan = (await self.plans(websiteId)).get(intent)
+        if plan is None:
+            return None
+        started = time.perf_counter()
+        self.runs += 1
+        run = {"runId": f"{websiteId}:{next(self._runs)}", "chainId": plan.chainId, "intent": intent}
+        current, index, statuses = dict(params), 0, []
+        with span("chain", chainId=plan.chainId or "", intent=intent):
+            for level in plan.levels:
+                outcomes = await asyncio.gather(*(
+                    self._run_stage(run, index + i, stage, current, plan.stage_timeout, emit)
+                    for i, stage in enumerate(level)
+                ))
+                index += len(level)
+                statuses += [o["status"] for o in outcomes]
+                if any(o["status"] != "ok" for o in outcomes):
+                    break
+                # Later stages in a level win on conflicting keys
+                current = {}
+                for outcome in outcomes:
+                    current.update(outcome["params"])
+        summary = {**run, "done": True, "stages": statuses, "elapsedMs": round((time.perf_counter() - started) * 1000.0, 1)}
+        emit({"chain": summary})
+        return summary
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "stages": dict(self.stage_counts), "stageTimeout": self.stage_timeout}
+
+
+def create_chain_executor(repos, cache) -> ChainExecutor:
+    return ChainExecutor(
+        repos,
+        cache,
+        base_url=os.getenv("MARKETPLACE_API_URL", "http://localhost:8082"),
+        stage_timeout=float(os.getenv("CHAIN_STAGE_TIMEOUT_SECONDS", "5")),
+    )
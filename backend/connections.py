@@ -0,0 +1,158 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+from fastapi import WebSocket
+
+
+class Connection:
+    """One accepted socket with a bounded outbound queue drained by its own sender task.
+
+    `send` never awaits: it enqueues or, if the client has fallen
+    `max_queue` messages behind, reports failure so the manager can evict it.
+    """
+
+    def __init__(self, target: str, websocket: WebSocket, max_queue: int, send_timeout: float):
+        self.target = target
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.send_timeout = send_timeout
+        self.last_seen = time.monotonic()
+        self.closed = False
+        self.sent = 0
+        self._sender = asyncio.create_task(self._send_loop(), name=f"ws-sender:{target}")
+
+    def send(self, payload: dict) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    async def _send_loop(self):
+        try:
+            while True:
+                payload = await self.queue.get()
+                await asyncio.wait_for(self.websocket.send_json(payload), self.send_timeout)
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Send timed out or the socket is gone; the receive loop will see the disconnect
+            await self.close(code=1011)
+
+    async def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.closed = True
+        if self._sender is not asyncio.current_task():
+            self._sender.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
+class ConnectionManager:
+    """Owns every user and agent socket on this worker.
+
+    Sends go through per-connection queues, so a slow consumer only ever
+    backs up its own queue; once that is full the client is evicted. A
+    ping task sends {"type": "ping"} and evicts sockets that have been
+    silent (no message and no {"type": "pong"}) for `idle_timeout` seconds.
+    """
+
+    def __init__(self, max_queue: int = 256, send_timeout: float = 10.0, ping_interval: float = 20.0, idle_timeout: float = 60.0):
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.connections: Dict[str, Connection] = {}
+        self._ping_task = None
+        # Socket closes in progress, held so they aren't garbage-collected and stop() can wait for them
+        self._closing: set = set()
+        self.evicted_slow = 0
+        self.evicted_idle = 0
+        self.dropped = 0
+
+    async def start(self):
+        self._ping_task = asyncio.create_task(self._ping_loop(), name="ws-ping")
+
+    async def stop(self):
+        if self._ping_task:
+            self._ping_task.cancel()
+        for connection in list(self.connections.values()):
+            await connection.close(code=1001)
+        self.connections.clear()
+        await asyncio.gather(*self._closing, return_exceptions=True)
+
+    def _close(self, connection: Connection, code: int = 1000):
+        task = asyncio.create_task(connection.close(code=code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def connect(self, target: str, websocket: WebSocket) -> Connection:
+        await websocket.accept()
+        connection = Connection(target, websocket, self.max_queue, self.send_timeout)
+        previous = self.connections.get(target)
+        self.connections[target] = connection
+        if previous is not None:
+            # Same user/agent reconnected (new tab, network switch); the new socket wins
+            self._close(previous, code=4000)
+        return connection
+
+    def remove(self, connection: Connection) -> bool:
+        """Forget `connection`; False if it had already been replaced by a newer socket."""
+        self._close(connection)
+        if self.connections.get(connection.target) is connection:
+            del self.connections[connection.target]
+            return True
+        return False
+
+    def get(self, target: str) -> Optional[Connection]:
+        return self.connections.get(target)
+
+    def send(self, target: str, payload: dict) -> bool:
+        connection = self.connections.get(target)
+        if connection is None:
+            return False
+        return self.send_to(connection, payload)
+
+    def send_to(self, connection: Connection, payload: dict) -> bool:
+        if connection.send(payload):
+            return True
+        if not connection.closed:
+            # Outbound queue full: the client can't keep up, drop it rather than buffer forever
+            self.evicted_slow += 1
+            self.remove(connection)
+        self.dropped += 1
+        return False
+
+    async def _ping_loop(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            for connection in list(self.connections.values()):
+                if now - connection.last_seen > self.idle_timeout:
+                    self.evicted_idle += 1
+                    self.remove(connection)
+                else:
+                    self.send_to(connection, {"type": "ping"})
+
+    def stats(self) -> dict:
+        depths = [c.queue.qsize() for c in self.connections.values()]
+        return {
+            "connections": len(self.connections),
+            "users": sum(1 for t in self.connections if t.startswith("user:")),
+            "agents": sum(1 for t in self.connections if t.startswith("agent:")),
+            "maxQueueDepth": max(depths, default=0),
+            "totalQueued": sum(depths),
+            "evictedSlow": self.evicted_slow,
+            "evictedIdle": self.evicted_idle,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,115 @@
+import os
+from typing import List, Optional, Tuple
+
+from batching import MicroBatcher
+from catalog import CatalogIndex
+from metrics import counter, histogram
+from tracing import span
+
+# Only these are read (token.pos_ needs tagger + attribute_ruler, token.ent_type_ needs ner)
+SPACY_EXCLUDE = ["parser", "lemmatizer", "senter"]
+
+DEFAULT_BRAND = "Sony"
+DEFAULT_CATEGORY = "headphone"
+SORT_WORDS = ["cheapest", "expensive"]
+
+SPACY_SECONDS = histogram("entity_spacy_seconds", "spaCy nlp.pipe time per batch")
+LOOKUPS = counter("entity_lookups_total", "Entity extractions by what answered them", ["source"])
+
+
+class EntityExtractor:
+    """Brand/category/sort extraction for product queries.
+
+    The client's catalog index is consulted first; when it finds a category
+    the statistical model is skipped. Everything else goes through a
+    trimmed en_core_web_sm (no parser or lemmatizer), with concurrent
+    requests micro-batched into one `nlp.pipe` call on the batcher's worker
+    thread. Catalog matches also carry canonical brandId/categoryId.
+    """
+
+    def __init__(
+        self,
+        catalog: CatalogIndex,
+        model: str = "en_core_web_sm",
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+    ):
+        import spacy
+
+        self.nlp = spacy.load(model, exclude=SPACY_EXCLUDE)
+        self.catalog = catalog
+        self.batcher = MicroBatcher(
+            self.extract_batch,
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+            name="entity-batcher",
+        )
+        self.catalog_hits = 0
+        self.model_runs = 0
+
+    async def start(self):
+        await self.batcher.start()
+
+    async def stop(self):
+        await self.batcher.stop()
+
+    @staticmethod
+    def _params(text: str, found: dict, brand: Optional[str] = None, category: Optional[str] = None) -> dict:
+        brand_entry, category_entry = found.get("brand"), found.get("category")
+        return {
+            "brand": brand_entry["name"] if brand_entry else brand or DEFAULT_BRAND,
+            "category": category_entry["name"] if category_entry else category or DEFAULT_CATEGORY,
+            "sort": "price_asc" if "cheapest" in text else "price_desc",
+            "brandId": brand_entry["id"] if brand_entry else None,
+            "categoryId": category_entry["id"] if category_entry else None,
+        }
+
+    def _from_doc(self, doc, found: dict) -> dict:
+        brand = category = None
+        for token in doc:
+            if token.pos_ == "NOUN" and token.text not in SORT_WORDS:
+                category = token.text  # Extract last noun as category
+            if token.ent_type_ == "ORG":
+                brand = token.text  # Extract brand if recognized
+        return self._params(doc.text, found, brand, category)
+
+    def extract_batch(self, items: List[Tuple[str, Optional[str]]]) -> List[dict]:
+        results: List[Optional[dict]] = [None] * len(items)
+        pending = []
+        for i, (text, clientId) in enumerate(items):
+            found = self.catalog.lookup(text, clientId)
+            if "category" in found:
+                self.catalog_hits += 1
+                LOOKUPS.inc("catalog")
+                results[i] = self._params(text, found)
+            else:
+                pending.append((i, found))
+        if pending:
+            self.model_runs += len(pending)
+            LOOKUPS.inc("model", amount=len(pending))
+            with SPACY_SECONDS.time(), span("entities.spacy", texts=len(pending)):
+                docs = self.nlp.pipe((items[i][0] for i, _ in pending), batch_size=len(pending))
+                for (i, found), doc in zip(pending, docs):
+                    results[i] = self._from_doc(doc, found)
+        return results
+
+    async def extract(self, text: str, clientId: Optional[str] = None) -> dict:
+        return await self.batcher.submit((text, clientId))
+
+    def stats(self) -> dict:
+        return {
+            "pipeline": self.nlp.pipe_names,
+            "catalogVersion": self.catalog.version,
+            "catalogHits": self.catalog_hits,
+            "modelRuns": self.model_runs,
+            **self.batcher.stats(),
+        }
+
+
+def create_entity_extractor(catalog: CatalogIndex) -> EntityExtractor:
+    return EntityExtractor(
+        catalog,
+        model=os.getenv("SPACY_MODEL", "en_core_web_sm"),
+        max_batch_size=int(os.getenv("ENTITY_BATCH_SIZE", "32")),
+        max_wait_ms=float(os.getenv("ENTITY_BATCH_WAIT_MS", "5")),
+    )
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Dict, Iterable, Optional
+
+from fastapi import Request, Response
+
+# 0 means browsers always revalidate (cheap 304s); raise it to let them skip the request
+HTTP_CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", "0"))
+
+
+@dataclass
+class CachedResponse:
+    """A payload serialized once, with validators derived from its bytes."""
+
+    payload: Any
+    body: Optional[bytes]
+    etag: str
+    last_modified: datetime
+
+
+def _latest_update(docs: Iterable[dict]) -> Optional[datetime]:
+    latest = None
+    for doc in docs:
+        value = doc.get("updatedAt") if isinstance(doc, dict) else None
+        if not value:
+            continue
+        try:
+            parsed = datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+        except (TypeError, ValueError):
+            continue
+        if latest is None or parsed > latest:
+            latest = parsed
+    return latest
+
+
+def serialize(payload: Any) -> bytes:
+    return json.dumps(payload, separators=(",", ":"), default=str).encode()
+
+
+def build_cached_response(payload: Any, docs: Iterable[dict] = ()) -> CachedResponse:
+    body = serialize(payload)
+    # Content hash, so every worker computes the same ETag for the same document version
+    etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+    last_modified = _latest_update(docs) or datetime.now(timezone.utc)
+    return CachedResponse(payload, body, etag, last_modified.replace(microsecond=0))
+
+
+def combine_cached_responses(payload: Any, parts: Dict[str, CachedResponse]) -> CachedResponse:
+    """Bundle several cached parts; the combined ETag only depends on the part ETags.
+
+    The body is left unserialized until a 200 actually needs it.
+    """
+    validators = "|".join(f"{name}={parts[name].etag}" for name in sorted(parts))
+    etag = '"' + hashlib.sha1(validators.encode()).hexdigest()[:20] + '"'
+    last_modified = max((cached.last_modified for cached in parts.values()), default=datetime.now(timezone.utc))
+    return CachedResponse(payload, None, etag, last_modified.replace(microsecond=0))
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def _not_modified_since(if_modified_since: Optional[str], last_modified: datetime) -> bool:
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return last_modified <= since
+
+
+def cache_headers(cached: CachedResponse, max_age: int = HTTP_CACHE_MAX_AGE) -> dict:
+    return {
+        "ETag": cached.etag,
+        "Last-Modified": format_datetime(cached.last_modified, usegmt=True),
+        "Cache-Control": f"public, max-age={max_age}" if max_age > 0 else "no-cache",
+    }
+
+
+def conditional_response(request: Request, cached: CachedResponse, max_age: int = HTTP_CACHE_MAX_AGE) -> Response:
+    """200 with the pre-serialized body, or an empty 304 if the client's copy is current."""
+    headers = cache_headers(cached, max_age)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        not_modified = etag_matches(if_none_match, cached.etag)
+    else:
+        not_modified = _not_modified_since(request.headers.get("if-modified-since"), cached.last_modified)
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    body = cached.body if cached.body is not None else serialize(cached.payload)
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import sys
+from typing import Dict, List
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+# Indexes for every query shape main.py issues. Unique where an upsert filter
+# already treats the key as the document identity.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "agents": [
+        IndexModel([("websiteId", ASCENDING), ("intent", ASCENDING)], name="websiteId_intent", unique=True),
+    ],
+    "chains": [
+        IndexModel([("websiteId", ASCENDING), ("chainId", ASCENDING)], name="websiteId_chainId", unique=True),
+    ],
+    "humanAgents": [
+        IndexModel([("websiteId", ASCENDING), ("agentId", ASCENDING)], name="websiteId_agentId", unique=True),
+        IndexModel([("agentId", ASCENDING)], name="agentId"),
+        IndexModel([("websiteId", ASCENDING), ("status", ASCENDING)], name="websiteId_status"),
+        IndexModel([("status", ASCENDING)], name="status"),
+    ],
+    "widgetSettings": [
+        IndexModel([("clientId", ASCENDING)], name="clientId", unique=True),
+    ],
+    "chat_sessions": [
+        IndexModel([("sessionId", ASCENDING)], name="sessionId", unique=True),
+        IndexModel([("agentId", ASCENDING), ("clientId", ASCENDING)], name="agentId_clientId"),
+    ],
+    "chat_messages": [
+        IndexModel([("sessionId", ASCENDING), ("bucket", ASCENDING)], name="sessionId_bucket", unique=True),
+    ],
+}
+
+# Representative filters used to explain() the real query shapes
+QUERY_SHAPES = [
+    ("agents", {"websiteId": "site123", "intent": "search_product"}),
+    ("agents", {"websiteId": "site123"}),
+    ("chains", {"websiteId": "site123", "chainId": "chain1"}),
+    ("chains", {"websiteId": "site123"}),
+    ("humanAgents", {"websiteId": "site123", "status": "online"}),
+    ("humanAgents", {"agentId": "agent1"}),
+    ("humanAgents", {"status": "online"}),
+    ("widgetSettings", {"clientId": "site123"}),
+    ("chat_sessions", {"sessionId": "session1"}),
+    ("chat_sessions", {"agentId": "agent1", "clientId": "site123"}),
+    ("chat_sessions", {"agentId": {"$in": ["agent1", "agent2"]}, "status": "active"}),
+    ("chat_messages", {"sessionId": "session1", "bucket": {"$lte": 3}}),
+]
+
+
+def _key(index: dict) -> tuple:
+    return tuple((field, direction) for field, direction in index["key"].items())
+
+
+async def ensure_indexes(db) -> Dict[str, List[str]]:
+    """Create any declared index that is missing. Safe to run on every start."""
+    created = {}
+    for collection_name, models in INDEXES.items():
+        try:
+            created[collection_name] = await db[collection_name].create_indexes(models)
+        except OperationFailure as e:
+            # Typically duplicates blocking a unique index; don't take the API down for it
+            print(f"Warning: could not create indexes on {collection_name}: {e}")
+            created[collection_name] = []
+    return created
+
+
+def _plan_stages(plan: dict) -> List[str]:
+    stages = [plan.get("stage")]
+    for child_key in ("inputStage", "queryPlan"):
+        if child_key in plan:
+            stages += _plan_stages(plan[child_key])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return [stage for stage in stages if stage]
+
+
+async def check_indexes(db) -> dict:
+    """Report declared-but-missing indexes, present-but-unused ones, and query plans."""
+    report = {"missing": [], "undeclared": [], "unused": [], "plans": []}
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        existing = {}
+        async for index in collection.list_indexes():
+            existing[index["name"]] = index
+        existing_keys = {_key(index): name for name, index in existing.items()}
+        declared_keys = set()
+        for model in models:
+            spec = model.document
+            key = tuple(spec["key"].items())
+            declared_keys.add(key)
+            if key not in existing_keys:
+                report["missing"].append({"collection": collection_name, "name": spec["name"], "key": dict(key)})
+        for name, index in existing.items():
+            if name != "_id_" and _key(index) not in declared_keys:
+                report["undeclared"].append({"collection": collection_name, "name": name})
+
+        try:
+            async for stats in collection.aggregate([{"$indexStats": {}}]):
+                if stats["name"] != "_id_" and stats["accesses"]["ops"] == 0:
+                    report["unused"].append({
+                        "collection": collection_name,
+                        "name": stats["name"],
+                        "since": str(stats["accesses"]["since"]),
+                    })
+        except OperationFailure as e:
+            print(f"Warning: $indexStats unavailable on {collection_name}: {e}")
+
+    for collection_name, query in QUERY_SHAPES:
+        explain = await db[collection_name].find(query).explain()
+        stages = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        report["plans"].append({
+            "collection": collection_name,
+            "filter": sorted(query),
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+        })
+    return report
+
+
+async def _main(argv: List[str]) -> int:
+    from dotenv import load_dotenv
+    from repository import Repositories
+
+    load_dotenv()
+    mode = argv[0] if argv else "apply"
+    repos = Repositories()
+    try:
+        if mode == "apply":
+            print(json.dumps(await ensure_indexes(repos.db), indent=2))
+            return 0
+        if mode == "check":
+            report = await check_indexes(repos.db)
+            print(json.dumps(report, indent=2))
+            problems = report["missing"] or any(plan["collscan"] for plan in report["plans"])
+            return 1 if problems else 0
+        print("usage: python indexes.py [apply|check]")
+        return 2
+    finally:
+        repos.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
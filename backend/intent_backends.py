@@ -0,0 +1,283 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from metrics import histogram
+from tracing import span
+
+BASE_DIR = Path(__file__).resolve().parent
+ONNX_CACHE_DIR = Path(os.getenv("ONNX_CACHE_DIR", BASE_DIR / "onnx_cache"))
+MAX_SEQ_LENGTH = int(os.getenv("INTENT_MAX_SEQ_LENGTH", "128"))
+
+INFERENCE_SECONDS = histogram(
+    "intent_inference_stage_seconds", "Intent model time per batch and stage", ["model", "backend", "stage"]
+)
+
+
+def resolve_model_dir(model_dir) -> Path:
+    path = Path(model_dir)
+    return path if path.is_absolute() else BASE_DIR / path
+
+
+def _find_tokenizer_file(model_dir: Path) -> Path:
+    # Some exported model directories keep the tokenizer in a subdirectory
+    for candidate in (model_dir / "tokenizer.json", model_dir / "tokenizer" / "tokenizer.json"):
+        if candidate.exists():
+            return candidate
+    raise FileNotFoundError(f"tokenizer.json not found in {model_dir}")
+
+
+class FastTokenizer:
+    """Rust `tokenizers` wrapper that pads to the longest text in the batch.
+
+    The shipped tokenizer.json files pad to a fixed 512 tokens, which makes
+    every forward pass pay for 512 positions even for a three-word query.
+    """
+
+    def __init__(self, model_dir, max_length: int = MAX_SEQ_LENGTH):
+        from tokenizers import Tokenizer
+
+        tokenizer_file = _find_tokenizer_file(resolve_model_dir(model_dir))
+        self.tokenizer = Tokenizer.from_file(str(tokenizer_file))
+        padding = self.tokenizer.padding or {}
+        self.tokenizer.no_padding()
+        self.tokenizer.enable_padding(
+            pad_id=padding.get("pad_id", 0),
+            pad_type_id=padding.get("pad_type_id", 0),
+            pad_token=padding.get("pad_token", "[PAD]"),
+        )
+        self.tokenizer.enable_truncation(max_length=max_length)
+
+    def __call__(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        encodings = self.tokenizer.encode_batch(texts)
+        return {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+        }
+
+
+def _read_config(model_dir: Path) -> dict:
+    config_file = model_dir / "config.json"
+    if not config_file.exists():
+        return {}
+    with open(config_file) as f:
+        return json.load(f)
+
+
+def _postprocess(logits: np.ndarray, problem_type: Optional[str]) -> List[List[float]]:
+    logits = logits.astype(np.float32)
+    if problem_type == "multi_label_classification":
+        probs = 1.0 / (1.0 + np.exp(-logits))
+    else:
+        shifted = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        probs = shifted / shifted.sum(axis=-1, keepdims=True)
+    return probs.tolist()
+
+
+class IntentBackend:
+    """Tokenize -> forward -> postprocess, returning per-label scores ordered by label id."""
+
+    name = "base"
+
+    def __init__(self, model_dir):
+        self.model_dir = resolve_model_dir(model_dir)
+        self.config = _read_config(self.model_dir)
+        self.problem_type = self.config.get("problem_type")
+        self.tokenizer = FastTokenizer(self.model_dir)
+        # Hashed once at load: version is read on every classification
+        self.fingerprint = _fingerprint(self.model_dir)[:12]
+
+    @property
+    def version(self) -> str:
+        # Identifies the exact weights + runtime, e.g. for keying cached predictions
+        return f"{self.model_dir.name}:{self.name}:{self.fingerprint}"
+
+    def tokenize(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        return self.tokenizer(texts)
+
+    def forward(self, encoded: Dict[str, np.ndarray]) -> np.ndarray:
+        raise NotImplementedError
+
+    def postprocess(self, logits: np.ndarray) -> List[List[float]]:
+        return _postprocess(logits, self.problem_type)
+
+    def predict(self, texts: List[str]) -> List[List[float]]:
+        labels = (self.model_dir.name, self.name)
+        with INFERENCE_SECONDS.time(*labels, "tokenize"), span("intent.tokenize", texts=len(texts)):
+            encoded = self.tokenize(texts)
+        with INFERENCE_SECONDS.time(*labels, "forward"), span("intent.forward", backend=self.name) as current:
+            current.set("sequence.length", int(encoded["input_ids"].shape[1]))
+            logits = self.forward(encoded)
+        with INFERENCE_SECONDS.time(*labels, "postprocess"), span("intent.postprocess"):
+            return self.postprocess(logits)
+
+
+class TorchIntentBackend(IntentBackend):
+    name = "torch"
+
+    def __init__(self, model_dir, num_threads: Optional[int] = None):
+        super().__init__(model_dir)
+        import torch
+        from transformers import AutoModelForSequenceClassification
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self._torch = torch
+        self.model = AutoModelForSequenceClassification.from_pretrained(str(self.model_dir))
+        self.model.eval()
+
+    def forward(self, encoded):
+        torch = self._torch
+        with torch.inference_mode():
+            outputs = self.model(
+                input_ids=torch.from_numpy(encoded["input_ids"]),
+                attention_mask=torch.from_numpy(encoded["attention_mask"]),
+            )
+        return outputs.logits.numpy()
+
+
+def _fingerprint(model_dir: Path) -> str:
+    # Changes whenever the source weights or config change, so stale exports get rebuilt
+    digest = hashlib.sha256()
+    for path in sorted(model_dir.iterdir()):
+        if path.is_file():
+            stat = path.stat()
+            digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def export_onnx(model_dir, cache_dir: Path = ONNX_CACHE_DIR, quantize: bool = False) -> Path:
+    """Export a transformers model directory to ONNX (and INT8), reusing cached artifacts."""
+    model_dir = resolve_model_dir(model_dir)
+    # Directories that already ship an exported graph use it as-is (its INT8 version goes in the cache)
+    shipped = model_dir / "model.onnx"
+    if shipped.exists() and not quantize:
+        return shipped
+
+    out_dir = Path(cache_dir) / model_dir.name
+    fp32_path = out_dir / "model.onnx"
+    int8_path = out_dir / "model.int8.onnx"
+    target = int8_path if quantize else fp32_path
+    stamp_file = out_dir / "source.json"
+    fingerprint = _fingerprint(model_dir)
+
+    fresh = False
+    if stamp_file.exists():
+        with open(stamp_file) as f:
+            fresh = json.load(f).get("fingerprint") == fingerprint
+    if fresh and target.exists():
+        return target
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    source = fp32_path
+    if shipped.exists():
+        source = shipped
+        if not fresh and int8_path.exists():
+            int8_path.unlink()
+    elif not fresh or not fp32_path.exists():
+        import torch
+        from transformers import AutoModelForSequenceClassification
+
+        model = AutoModelForSequenceClassification.from_pretrained(str(model_dir))
+        model.eval()
+        dummy = FastTokenizer(model_dir)(["cheapest sony headphones"])
+        tmp_path = out_dir / "model.onnx.tmp"
+        with torch.inference_mode():
+            torch.onnx.export(
+                model,
+                (torch.from_numpy(dummy["input_ids"]), torch.from_numpy(dummy["attention_mask"])),
+                str(tmp_path),
+                input_names=["input_ids", "attention_mask"],
+                output_names=["logits"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "logits": {0: "batch"},
+                },
+                opset_version=14,
+            )
+        os.replace(tmp_path, fp32_path)
+        if int8_path.exists():
+            int8_path.unlink()
+
+    if quantize and not int8_path.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        tmp_path = out_dir / "model.int8.onnx.tmp"
+        quantize_dynamic(str(source), str(tmp_path), weight_type=QuantType.QInt8)
+        os.replace(tmp_path, int8_path)
+
+    with open(stamp_file, "w") as f:
+        json.dump({"fingerprint": fingerprint, "source": str(model_dir)}, f)
+    return target
+
+
+class OnnxIntentBackend(IntentBackend):
+    name = "onnx"
+
+    def __init__(
+        self,
+        model_dir,
+        quantize: bool = False,
+        intra_op_threads: Optional[int] = None,
+        inter_op_threads: Optional[int] = None,
+        cache_dir: Path = ONNX_CACHE_DIR,
+    ):
+        super().__init__(model_dir)
+        import onnxruntime as ort
+
+        self.model_path = export_onnx(self.model_dir, cache_dir=cache_dir, quantize=quantize)
+        if self.model_path.name.endswith(".int8.onnx"):
+            self.name = "onnx-int8"
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = intra_op_threads or min(4, os.cpu_count() or 1)
+        options.inter_op_num_threads = inter_op_threads or 1
+        self.session = ort.InferenceSession(
+            str(self.model_path), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def forward(self, encoded):
+        feeds = {name: value for name, value in encoded.items() if name in self.input_names}
+        return self.session.run(None, feeds)[0]
+
+
+def _env_int(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def _quantize(backend: str) -> bool:
+    # INT8 only when asked for: plain onnx stays fp32 unless INTENT_QUANTIZE=1
+    return backend == "onnx-int8" or os.getenv("INTENT_QUANTIZE") == "1"
+
+
+def load_intent_backend(model_dir, backend: Optional[str] = None) -> IntentBackend:
+    """Build the backend selected by INTENT_BACKEND (torch | onnx | onnx-int8)."""
+    backend = (backend or os.getenv("INTENT_BACKEND", "torch")).lower()
+    if backend == "torch":
+        return TorchIntentBackend(model_dir, num_threads=_env_int("TORCH_NUM_THREADS"))
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxIntentBackend(
+            model_dir,
+            quantize=_quantize(backend),
+            intra_op_threads=_env_int("ORT_INTRA_OP_THREADS"),
+            inter_op_threads=_env_int("ORT_INTER_OP_THREADS"),
+        )
+    raise ValueError(f"Unknown intent backend: {backend}")
+
+
+if __name__ == "__main__":
+    # Pre-build the ONNX artifacts, e.g. in a Docker build step:
+    #   python intent_backends.py multi_intent_model fine_tuned_model
+    import sys
+
+    for name in sys.argv[1:] or ["multi_intent_model", "fine_tuned_model"]:
+        print(name, "->", export_onnx(name, quantize=_quantize(os.getenv("INTENT_BACKEND", "onnx").lower())))
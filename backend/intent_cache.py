@@ -0,0 +1,44 @@
+import os
+import re
+from typing import Any, Awaitable, Callable, Optional
+
+from cache import TTLCache
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+
+
+def normalize_text(text: str) -> str:
+    """Case-, whitespace- and punctuation-insensitive form used as the cache key."""
+    return " ".join(_PUNCTUATION.sub(" ", text.lower()).split())
+
+
+class IntentResultCache(TTLCache):
+    """LRU+TTL cache for classifier scores and extracted entities.
+
+    Classifier entries are keyed on the model version as well, and
+    switching versions drops them, so a model change never serves scores
+    computed by the previous model.
+    """
+
+    def __init__(self, model_version: str = "", **kwargs):
+        super().__init__(**kwargs)
+        self.model_version = model_version
+
+    def set_model_version(self, version: str):
+        if version != self.model_version:
+            self.invalidate_local(("intent",))
+            self.model_version = version
+
+    async def intent_scores(self, text: str, classify: Callable[[str], Awaitable[Any]], version: Optional[str] = None):
+        return await self.get_or_load(("intent", version or self.model_version, text), lambda: classify(text))
+
+    async def entities(self, text: str, extract: Callable[[str], Awaitable[Any]], namespace: Optional[str] = None):
+        return await self.get_or_load(("entities", namespace, text), lambda: extract(text))
+
+
+def create_intent_cache(model_version: str) -> IntentResultCache:
+    return IntentResultCache(
+        model_version,
+        maxsize=int(os.getenv("INTENT_CACHE_MAX_ENTRIES", "50000")),
+        default_ttl=float(os.getenv("INTENT_CACHE_TTL", "3600")),
+    )
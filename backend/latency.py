@@ -0,0 +1,93 @@
+import asyncio
+import time
+from collections import deque
+from typing import Callable, List, Optional
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LatencyWindow:
+    """Latencies of the most recent `size` requests, for percentiles and throughput."""
+
+    def __init__(self, size: int = 5000, rate_window: float = 60.0):
+        self.samples: deque = deque(maxlen=size)
+        self.rate_window = rate_window
+        self.count = 0
+        self.errors = 0
+        self.started = time.monotonic()
+
+    def record(self, seconds: float):
+        self.samples.append((time.monotonic(), seconds))
+        self.count += 1
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        values = sorted(seconds for _, seconds in self.samples)
+        recent = sum(1 for at, _ in self.samples if at > now - self.rate_window)
+        elapsed = min(self.rate_window, now - self.started) or 1.0
+
+        def ms(value):
+            return round(value * 1000.0, 3) if value is not None else None
+
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "p50Ms": ms(percentile(values, 50)),
+            "p95Ms": ms(percentile(values, 95)),
+            "p99Ms": ms(percentile(values, 99)),
+            "meanMs": ms(sum(values) / len(values)) if values else None,
+            "throughputRps": round(recent / elapsed, 3),
+        }
+
+
+class LoopLagMonitor:
+    """Event-loop lag: how late a `interval`-second sleep wakes up, sampled continuously.
+
+    Anything that blocks the loop (sync I/O, CPU work outside an executor)
+    shows up here as lag for every request the worker is serving.
+    """
+
+    def __init__(self, interval: float = 0.05, size: int = 6000, on_sample: Optional[Callable[[float], None]] = None):
+        self.interval = interval
+        self.on_sample = on_sample
+        self.lags = LatencyWindow(size=size)
+        self.max_lag = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            self.lags.record(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if self.on_sample:
+                self.on_sample(lag)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run(), name="loop-lag")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def stats(self, window: Optional[float] = None) -> dict:
+        """Lag percentiles over the last `window` seconds (default: every retained sample)."""
+        now = time.monotonic()
+        values = sorted(lag for at, lag in self.lags.samples if window is None or at > now - window)
+
+        def ms(value):
+            return round(value * 1000.0, 3) if value is not None else None
+
+        return {
+            "samples": len(values),
+            "p50Ms": ms(percentile(values, 50)),
+            "p99Ms": ms(percentile(values, 99)),
+            "maxMs": ms(values[-1] if values else None),
+            "maxEverMs": ms(self.max_lag),
+        }
@@ -0,0 +1,589 @@
+"""Load test the backend end to end against a local Mongo stand-in.
+
+Starts the app under uvicorn (MONGO_MOCK=1 unless --mongo-uri is given),
+seeds a few clients, then drives:
+
+  bootstrap   widget start-up: GET /widget/{clientId}, /agents and /chains
+              together, plus the combined /widget/{clientId}/bootstrap
+  classify    POST /classify-intent at each --concurrency level
+  websocket   --sockets agent/user socket pairs on /ws/agent and /ws/chat
+              exchanging messages both ways
+
+and reports client-side throughput and tail latency plus, per worker
+process (from /runtime/stats), event-loop lag and RSS. Results are saved
+as JSON; --baseline compares them against an earlier run and exits 1 on
+a regression.
+
+    python loadtest.py
+    python loadtest.py --scenarios classify --concurrency 1,8,32,64
+    python loadtest.py --baseline bench_results/baseline.json
+
+With MONGO_MOCK every uvicorn worker has its own in-memory store, so use
+--mongo-uri for --workers > 1.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from latency import LoopLagMonitor, percentile
+
+BASE_DIR = Path(__file__).resolve().parent
+RESULTS_DIR = BASE_DIR / "bench_results"
+
+SCENARIOS = ["bootstrap", "classify", "websocket"]
+
+# Shaped like real widget traffic: ready questions (repeat, so mostly cached) and free text
+READY_QUERIES = ["Search for products", "Order a product", "Track my order", "Browse categories"]
+FREE_QUERIES = [
+    "show me the cheapest {} headphones",
+    "i want to order a {} laptop",
+    "where is my order {}",
+    "most expensive {} phone you have",
+    "cannot log in to my account {}",
+    "do you sell {} speakers",
+]
+BRANDS = ["sony", "apple", "samsung", "bose", "lenovo", "dell", "xiaomi", "lg"]
+
+# Relative change beyond --tolerance that counts as a regression; latencies
+# also have to move by at least MIN_LATENCY_DELTA_MS to rule out timer noise
+MIN_LATENCY_DELTA_MS = 1.0
+HIGHER_IS_WORSE = ["p95Ms", "p99Ms"]
+LOWER_IS_WORSE = ["throughputRps"]
+
+
+class Recorder:
+    """Latencies and errors of one request type during one scenario run."""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+
+    async def timed(self, call: Callable[[], Awaitable]):
+        started = time.perf_counter()
+        try:
+            await call()
+        except Exception:
+            self.errors += 1
+            return
+        self.latencies.append(time.perf_counter() - started)
+
+    def record(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    def summary(self) -> dict:
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        values = sorted(self.latencies)
+
+        def ms(value):
+            return round(value * 1000.0, 3) if value is not None else None
+
+        return {
+            "requests": len(values),
+            "errors": self.errors,
+            "seconds": round(elapsed, 3),
+            "throughputRps": round(len(values) / elapsed, 2) if elapsed > 0 else None,
+            "p50Ms": ms(percentile(values, 50)),
+            "p95Ms": ms(percentile(values, 95)),
+            "p99Ms": ms(percentile(values, 99)),
+            "maxMs": ms(values[-1] if values else None),
+            "meanMs": ms(sum(values) / len(values)) if values else None,
+        }
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+class Server:
+    """The app under uvicorn in a child process, on a free local port."""
+
+    def __init__(self, workers: int = 1, role: Optional[str] = None, mongo_uri: Optional[str] = None, env: Optional[dict] = None):
+        self.workers = workers
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = dict(os.environ, **(env or {}))
+        if mongo_uri:
+            self.env["MONGO_URI"] = mongo_uri
+            self.env.pop("MONGO_MOCK", None)
+        else:
+            self.env["MONGO_MOCK"] = "1"
+        if role:
+            self.env["WORKER_ROLE"] = role
+        # A run starts from its own, empty message journal
+        self.journal = RESULTS_DIR / f"messages-{self.port}.journal"
+        self.env["MESSAGE_JOURNAL_PATH"] = str(self.journal)
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "main:app",
+                "--host", "127.0.0.1",
+                "--port", str(self.port),
+                "--workers", str(self.workers),
+                "--log-level", "warning",
+                "--no-access-log",
+            ],
+            cwd=BASE_DIR,
+            env=self.env,
+        )
+
+    async def wait_ready(self, client, timeout: float):
+        # Every worker has to pass /ready; requests land on a random one, so
+        # ask until a run of consecutive answers were all ready
+        deadline = time.monotonic() + timeout
+        streak = 0
+        while streak < 4 * self.workers:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"server exited with status {self.process.returncode}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"server not ready after {timeout:.0f}s")
+            try:
+                response = await client.get("/ready")
+                streak = streak + 1 if response.status_code == 200 else 0
+            except Exception:
+                streak = 0
+            if not streak:
+                await asyncio.sleep(0.25)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=20)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        # One journal (and lock file) per server process
+        for path in self.journal.parent.glob(f"{self.journal.stem}.*"):
+            path.unlink(missing_ok=True)
+
+
+class WorkerSampler:
+    """Polls /runtime/stats during a scenario and keeps the latest report per worker pid."""
+
+    def __init__(self, client, workers: int, interval: float = 1.0):
+        self.client = client
+        self.workers = workers
+        self.interval = interval
+        self.started = time.monotonic()
+        self.peak_rss: Dict[int, float] = {}
+        self.latest: Dict[int, dict] = {}
+        self._task = None
+
+    async def sample(self, window: Optional[float] = None):
+        params = {"window": window} if window else None
+        for _ in range(2 * self.workers):
+            try:
+                response = await self.client.get("/runtime/stats", params=params)
+                report = response.json()
+            except Exception:
+                continue
+            pid = report["pid"]
+            self.latest[pid] = report
+            if report.get("rssMb") is not None:
+                self.peak_rss[pid] = max(self.peak_rss.get(pid, 0.0), report["rssMb"])
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.sample()
+
+    def start(self):
+        self.started = time.monotonic()
+        self._task = asyncio.create_task(self._run(), name="worker-sampler")
+
+    async def stop(self) -> dict:
+        self._task.cancel()
+        # Loop lag over just this scenario
+        await self.sample(window=time.monotonic() - self.started)
+        return {
+            str(pid): {
+                "role": report.get("role"),
+                "rssMb": report.get("rssMb"),
+                "peakRssMb": self.peak_rss.get(pid),
+                "loopLag": report.get("loopLag"),
+                "websockets": report.get("websockets", {}).get("connections"),
+            }
+            for pid, report in self.latest.items()
+        }
+
+
+async def closed_loop(concurrency: int, duration: float, step: Callable[[int], Awaitable]):
+    """`concurrency` virtual users, each running `step` back to back until `duration` is up."""
+    deadline = time.perf_counter() + duration
+
+    async def user(n: int):
+        while time.perf_counter() < deadline:
+            await step(n)
+
+    await asyncio.gather(*(user(n) for n in range(concurrency)))
+
+
+def _query(rng: random.Random, unique_ratio: float) -> str:
+    if rng.random() >= unique_ratio:
+        return rng.choice(READY_QUERIES)
+    return rng.choice(FREE_QUERIES).format(rng.choice(BRANDS)) + f" {rng.randrange(10**6)}"
+
+
+async def seed(client, clients: List[str]):
+    for clientId in clients:
+        await client.post(f"/widget/{clientId}", json={})
+        for intent in ["search_product", "place_order", "track_order"]:
+            await client.post("/agents", json={
+                "websiteId": clientId,
+                "intent": intent,
+                "name": f"{intent} agent",
+                "features": [{"name": intent, "route": f"/api/{intent}", "method": "GET"}],
+            })
+        await client.post("/chains", json={
+            "websiteId": clientId,
+            "chainId": "checkout",
+            "agentSequence": ["search_product", "place_order"],
+        })
+
+
+async def run_bootstrap(client, clients: List[str], concurrency: int, duration: float) -> dict:
+    routes = {name: Recorder() for name in ["widget", "agents", "chains", "bootstrap"]}
+    page_loads = Recorder()
+    rng = random.Random(1)
+
+    async def get(url: str, params=None):
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+
+    async def step(n: int):
+        clientId = rng.choice(clients)
+        started = time.perf_counter()
+        if rng.random() < 0.25:
+            # Newer widgets fetch everything in one round-trip
+            calls = [routes["bootstrap"].timed(lambda: get(f"/widget/{clientId}/bootstrap"))]
+        else:
+            calls = [
+                routes["widget"].timed(lambda: get(f"/widget/{clientId}")),
+                routes["agents"].timed(lambda: get("/agents", {"websiteId": clientId})),
+                routes["chains"].timed(lambda: get("/chains", {"websiteId": clientId})),
+            ]
+        await asyncio.gather(*calls)
+        page_loads.record(time.perf_counter() - started)
+
+    await closed_loop(concurrency, duration, step)
+    for recorder in [page_loads, *routes.values()]:
+        recorder.stop()
+    page_loads.errors = sum(r.errors for r in routes.values())
+    return {**page_loads.summary(), "routes": {name: r.summary() for name, r in routes.items()}}
+
+
+async def run_classify(client, clients: List[str], concurrency: int, duration: float, unique_ratio: float) -> dict:
+    recorder = Recorder()
+    rng = random.Random(concurrency)
+
+    async def classify():
+        response = await client.post(
+            "/classify-intent", json={"text": _query(rng, unique_ratio), "clientId": rng.choice(clients)}
+        )
+        response.raise_for_status()
+
+    await closed_loop(concurrency, duration, lambda n: recorder.timed(classify))
+    recorder.stop()
+    return recorder.summary()
+
+
+async def run_websocket(client, base_url: str, clientId: str, pairs: int, duration: float, interval: float) -> dict:
+    import websockets
+
+    ws_url = base_url.replace("http://", "ws://", 1)
+    connect, to_user, to_agent = Recorder(), Recorder(), Recorder()
+    errors: List[str] = []
+    sockets = []
+    run = f"{int(time.time())}"
+    limit = asyncio.Semaphore(50)
+
+    async def open_socket(path: str):
+        async with limit:
+            started = time.perf_counter()
+            ws = await websockets.connect(ws_url + path, max_queue=None, open_timeout=30)
+            connect.record(time.perf_counter() - started)
+            sockets.append(ws)
+            return ws
+
+    def stamped(sender: str) -> dict:
+        # Both ends live in this process, so the send time can travel in the text
+        return {"sender": sender, "text": f"bench {time.perf_counter():.6f}"}
+
+    def latency_of(payload: dict) -> Optional[float]:
+        text = (payload.get("message") or {}).get("text", "")
+        if not text.startswith("bench "):
+            return None
+        return time.perf_counter() - float(text.split()[1])
+
+    async def pair(n: int):
+        agentId, userId, sessionId = f"bench-agent-{run}-{n}", f"bench-user-{run}-{n}", f"bench-{run}-{n}"
+        response = await client.post("/chat/session", json={
+            "sessionId": sessionId, "clientId": clientId, "userId": userId, "agentId": agentId, "status": "active",
+        })
+        response.raise_for_status()
+        agent = await open_socket(f"/ws/agent/{agentId}")
+        user = await open_socket(f"/ws/chat/{clientId}/{userId}")
+        return agent, user, sessionId
+
+    async def read(ws, recorder: Recorder, reply=None):
+        async for raw in ws:
+            payload = json.loads(raw)
+            if payload.get("type") == "ping":
+                await ws.send(json.dumps({"type": "pong"}))
+            elif "error" in payload:
+                recorder.errors += 1
+                errors.append(payload["error"])
+            else:
+                seconds = latency_of(payload)
+                if seconds is not None:
+                    recorder.record(seconds)
+                    if reply:
+                        await reply()
+
+    async def talk(agent, user, sessionId: str, deadline: float):
+        async def user_reply():
+            await user.send(json.dumps({"sessionId": sessionId, "message": stamped("user")}))
+
+        readers = [
+            asyncio.create_task(read(user, to_user, user_reply)),
+            asyncio.create_task(read(agent, to_agent)),
+        ]
+        # Spread the agents' sends over the interval
+        await asyncio.sleep(random.random() * interval)
+        try:
+            while time.perf_counter() < deadline:
+                await agent.send(json.dumps({"sessionId": sessionId, "message": stamped("agent")}))
+                await asyncio.sleep(interval)
+            # Let the last round-trip finish
+            await asyncio.sleep(min(interval, 1.0))
+        finally:
+            for task in readers:
+                task.cancel()
+
+    opened = await asyncio.gather(*(pair(n) for n in range(pairs)), return_exceptions=True)
+    connect.stop()
+    ready = [p for p in opened if not isinstance(p, BaseException)]
+    connect.errors = len(opened) - len(ready)
+    to_user.started = to_agent.started = time.perf_counter()
+    deadline = time.perf_counter() + duration
+    try:
+        await asyncio.gather(*(talk(agent, user, sessionId, deadline) for agent, user, sessionId in ready), return_exceptions=True)
+    finally:
+        to_user.stop()
+        to_agent.stop()
+        await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+    return {
+        "pairs": pairs,
+        "connected": len(ready),
+        "connect": connect.summary(),
+        "agentToUser": to_user.summary(),
+        "userToAgent": to_agent.summary(),
+        "serverErrors": sorted(set(errors))[:5],
+    }
+
+
+def _metrics(result: dict, prefix: str = ""):
+    """Flatten the comparable numbers of one scenario result into {path: value}."""
+    for key, value in result.items():
+        path = f"{prefix}{key}"
+        if key in ("workers", "clientLoopLag"):
+            continue
+        if isinstance(value, dict):
+            yield from _metrics(value, path + ".")
+        elif key in HIGHER_IS_WORSE + LOWER_IS_WORSE and value is not None:
+            yield path, key, value
+    for pid, worker in (result.get("workers") or {}).items():
+        lag = (worker.get("loopLag") or {}).get("p99Ms")
+        if lag is not None:
+            yield f"{prefix}worker.loopLagP99Ms", "p99Ms", lag
+        if worker.get("peakRssMb") is not None:
+            yield f"{prefix}worker.peakRssMb", "peakRssMb", worker["peakRssMb"]
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> List[dict]:
+    """Metrics that got worse than the baseline by more than `tolerance` (a fraction)."""
+    regressions = []
+    for name, result in current["scenarios"].items():
+        if name not in baseline.get("scenarios", {}):
+            continue
+        # Worst value per path, so workers are compared by their worst one
+        before, after = {}, {}
+        for target, source in [(before, baseline["scenarios"][name]), (after, result)]:
+            for path, kind, value in _metrics(source):
+                pick = min if kind == "throughputRps" else max
+                target[path] = (kind, pick(value, target[path][1]) if path in target else value)
+        for path, (kind, value) in after.items():
+            if path not in before or not before[path][1]:
+                continue
+            old = before[path][1]
+            change = (value - old) / old
+            if kind == "throughputRps":
+                worse = change < -tolerance
+            else:
+                worse = change > tolerance and (kind == "peakRssMb" or value - old >= MIN_LATENCY_DELTA_MS)
+            if worse:
+                regressions.append({"scenario": name, "metric": path, "baseline": old, "current": value, "change": round(change, 3)})
+    return regressions
+
+
+def print_summary(results: dict):
+    print(f"{'scenario':<22}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'lag p99':>10}{'rss MB':>9}")
+    for name, result in results["scenarios"].items():
+        rows = [(name, result)]
+        if name == "websocket":
+            rows = [(f"{name}.{leg}", result[leg]) for leg in ["agentToUser", "userToAgent"]]
+        workers = result.get("workers", {}).values()
+        lag = max(((w.get("loopLag") or {}).get("p99Ms") or 0.0 for w in workers), default=0.0)
+        rss = max((w.get("peakRssMb") or 0.0 for w in workers), default=0.0)
+        for label, row in rows:
+            print(
+                f"{label:<22}{row.get('throughputRps') or 0:>10.1f}{row.get('p50Ms') or 0:>10.2f}"
+                f"{row.get('p95Ms') or 0:>10.2f}{row.get('p99Ms') or 0:>10.2f}{row.get('errors', 0):>8}"
+                f"{lag:>10.2f}{rss:>9.1f}"
+            )
+
+
+async def run(args) -> dict:
+    import httpx
+
+    clients = [f"bench-client-{i}" for i in range(args.clients)]
+    server = None
+    base_url = args.url
+    if not base_url:
+        server = Server(args.workers, args.role, args.mongo_uri)
+        server.start()
+        base_url = server.url
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    results = {
+        "startedAt": datetime.utcnow().isoformat(),
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("baseline", "output")},
+        "scenarios": {},
+    }
+    client_lag = LoopLagMonitor()
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+            if server:
+                started = time.perf_counter()
+                await server.wait_ready(client, args.startup_timeout)
+                results["startupSeconds"] = round(time.perf_counter() - started, 3)
+            await seed(client, clients)
+            await client_lag.start()
+
+            async def scenario(name: str, body: Awaitable):
+                print(f"running {name} ...", flush=True)
+                sampler = WorkerSampler(client, args.workers)
+                sampler.start()
+                result = await body
+                result["workers"] = await sampler.stop()
+                # If the load generator itself lags, its latencies are inflated too
+                result["clientLoopLag"] = client_lag.stats(window=args.duration)
+                results["scenarios"][name] = result
+
+            for name in args.scenarios:
+                if name == "bootstrap":
+                    await scenario(name, run_bootstrap(client, clients, args.bootstrap_concurrency, args.duration))
+                elif name == "classify":
+                    for concurrency in args.concurrency:
+                        await scenario(
+                            f"classify@{concurrency}",
+                            run_classify(client, clients, concurrency, args.duration, args.unique_ratio),
+                        )
+                elif name == "websocket":
+                    await scenario(
+                        name, run_websocket(client, base_url, clients[0], args.sockets, args.duration, args.message_interval)
+                    )
+    finally:
+        await client_lag.stop()
+        if server:
+            server.stop()
+    return results
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", type=lambda v: v.split(","), default=SCENARIOS, help=",".join(SCENARIOS))
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds per scenario")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--role", choices=["all", "crud"], help="WORKER_ROLE for the server")
+    parser.add_argument("--mongo-uri", help="real Mongo instead of the in-memory stand-in")
+    parser.add_argument("--url", help="test an already running server instead of starting one")
+    parser.add_argument("--clients", type=int, default=20, help="widget clients to seed")
+    parser.add_argument("--bootstrap-concurrency", type=int, default=32)
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 8, 32], help="classify-intent concurrency levels")
+    parser.add_argument("--unique-ratio", type=float, default=0.5, help="share of classify queries that miss the cache")
+    parser.add_argument("--sockets", type=int, default=200, help="agent/user socket pairs")
+    parser.add_argument("--message-interval", type=float, default=1.0, help="seconds between each agent's messages")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--startup-timeout", type=float, default=600.0)
+    parser.add_argument("--output", help="results file (default bench_results/loadtest-<time>.json)")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    if args.workers > 1 and not (args.mongo_uri or args.url):
+        print("Warning: with the in-memory Mongo stand-in each worker sees only its own writes; use --mongo-uri")
+
+    results = asyncio.run(run(args))
+    print_summary(results)
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"loadtest-{datetime.utcnow():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        changed = {
+            key: (value, results["config"].get(key))
+            for key, value in baseline.get("config", {}).items()
+            if key not in ("scenarios", "concurrency", "tolerance") and results["config"].get(key) != value
+        }
+        for key, (before, after) in changed.items():
+            print(f"Warning: baseline ran with {key}={before}, this run with {after}; results are not comparable")
+        results["regressions"] = compare(results, baseline, args.tolerance)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"results: {output}")
+
+    for regression in results.get("regressions", []):
+        print(
+            f"REGRESSION {regression['scenario']} {regression['metric']}: "
+            f"{regression['baseline']} -> {regression['current']} ({regression['change']:+.0%})"
+        )
+    if results.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
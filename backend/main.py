@@ -1,13 +1,76 @@
-from fastapi import FastAPI, HTTPException,  WebSocket, WebSocketDisconnect
+from startup import Components, max_rss_mb, rss_mb
+from fastapi import FastAPI, HTTPException,  WebSocket, WebSocketDisconnect, Request, Response, BackgroundTasks
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
 from pydantic import BaseModel
 import os
 from typing import List, Optional,Dict
 from datetime import datetime
 from pydantic import ValidationError
+import asyncio
+import hmac
+import time
+import uuid
+from contextlib import asynccontextmanager
+from model_registry import create_model_registry
+from repository import Repositories
+from indexes import ensure_indexes
+from cache import create_cache
+from write_behind import create_write_behind
+from bus import agent_target, create_router, user_target
+from routing import create_routing_engine
+from agent_presence import create_agent_presence
+from chains import create_chain_executor
+from intent_cache import create_intent_cache, normalize_text
+from latency import LoopLagMonitor
+from metrics import CONTENT_TYPE, REGISTRY, MetricsMiddleware, collected, histogram
+from tracing import PROFILER, TRACER, TracingMiddleware, activate, collapsed, span
+from catalog import create_catalog
+from entities import create_entity_extractor
+from http_cache import CachedResponse, build_cached_response, combine_cached_responses, conditional_response, etag_matches, serialize
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if os.getenv("MONGO_ENSURE_INDEXES", "1") == "1":
+        await ensure_indexes(repos.db)
+    await cache.start()
+    await message_writer.start()
+    await chain_executor.start()
+    await router.start()
+    await agent_presence.start()
+    await agent_routing.start()
+    await loop_lag.start()
+    TRACER.start()
+    if nlp_enabled:
+        await catalog.start()
+    # Models load in the background (MODEL_LOADING); CRUD endpoints serve right away
+    await components.start()
+    yield
+    await components.stop()
+    await catalog.stop()
+    await loop_lag.stop()
+    await asyncio.to_thread(TRACER.stop)
+    await agent_routing.stop()
+    await agent_presence.stop()
+    await router.stop()
+    await chain_executor.stop()
+    await message_writer.stop()
+    await cache.stop()
+    repos.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Per-route latency histograms for /metrics (METRICS_ENABLED=0 turns instrumentation off)
+if os.getenv("METRICS_ENABLED", "1") == "1":
+    app.add_middleware(MetricsMiddleware)
+
+# Spans for TRACE_SAMPLE_RATE of requests, exported per TRACE_EXPORTER (see tracing.py)
+if TRACER.enabled:
+    app.add_middleware(TracingMiddleware)
 
 # CORS
 app.add_middleware(
@@ -18,9 +81,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# MongoDB
-client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017"))
-db = client["chatwidget"]
+# MongoDB (async, see repository.py for pool sizing / timeouts)
+repos = Repositories()
+
+# Widget bootstrap data (settings, agents, chains); CACHE_INVALIDATION_URL=redis://...
+# keeps invalidations coherent across uvicorn workers
+cache = create_cache()
+
+# Agent chains run server-side (MARKETPLACE_API_URL); compiled plans are cached per websiteId
+chain_executor = create_chain_executor(repos, cache)
+
+LOOP_LAG_SECONDS = histogram("event_loop_lag_seconds", "How late a 50ms event-loop timer fires")
+NLP_STAGE_SECONDS = histogram("nlp_stage_seconds", "Intent and entity time per query, cache included", ["stage"])
+WS_MESSAGE_SECONDS = histogram("ws_message_duration_seconds", "Handling of one inbound socket message", ["endpoint", "stage"])
+
+# Sampled continuously; reported per worker by /runtime/stats and /metrics
+loop_lag = LoopLagMonitor(on_sample=LOOP_LAG_SECONDS.observe)
+
+# Chat messages are journaled locally and bulk-written to Mongo off the delivery path
+message_writer = create_write_behind(repos)
+
+# Online human agents with their load, capacity and skills; handoffs are assigned
+# from memory (AGENT_ROUTING_STRATEGY=least_loaded|weighted_round_robin)
+agent_routing = create_routing_engine(repos)
+
+# Agent liveness in memory (socket heartbeats), written to Mongo in periodic bulk writes
+agent_presence = create_agent_presence(repos)
+# Dashboard sockets subscribed to presence changes, per websiteId
+presence_watchers: Dict[str, set] = {}
+
+def on_presence_change(agent: dict):
+    if not agent_routing.set_status(agent["agentId"], agent["status"]) and agent["status"] == "online":
+        agent_routing.upsert(agent)
+    for connection in list(presence_watchers.get(agent["websiteId"], ())):
+        router.manager.send_to(connection, {"type": "presence", "agent": agent})
+
+agent_presence.listeners.append(on_presence_change)
 
 
 
@@ -61,101 +157,176 @@ db = client["chatwidget"]
 #         return {"error": f"Prediction failed: {str(e)}"}
 
 
-# WebSocket connections
-connected_clients: Dict[str, WebSocket] = {}  # userId -> WebSocket
-connected_agents: Dict[str, WebSocket] = {}  # agentId -> WebSocket
-
-# Define a POST endpoint for intent classification
-from fastapi import FastAPI
-from pydantic import BaseModel
-import spacy
-from transformers import pipeline
-import os
-from huggingface_hub import login  # For Llama access
-from dotenv import load_dotenv
+# WebSocket connections: local sockets plus a presence registry/bus so a
+# delivery reaches the socket on whichever worker holds it (BUS_URL=redis://...)
+router = create_router()
+
+# Models, pipelines and the HF login are components loaded off the import path;
+# WORKER_ROLE=crud never loads (or imports) any of them
+components = Components()
+nlp_enabled = components.role != "crud"
+
+async def hf_login():
+    # Login for gated models (e.g., Llama) - set your HF token
+    hf_token = os.getenv("HF_TOKEN")  # Set this env var with your token
+    if not hf_token:
+        print("Warning: HF_TOKEN not set; Llama fallback may fail.")
+        return False
+    from huggingface_hub import login  # For Llama access
+
+    await asyncio.to_thread(login, hf_token)
+    return True
+
+# Intent models (path, label map, threshold, backend) are described in models.json;
+# INTENT_MODEL picks the one to start with and POST /models/{name}/activate hot-swaps it
+intent_models = create_model_registry(on_swap=lambda model: intent_cache.set_model_version(model.version))
+
+async def load_intent_model():
+    model = await intent_models.activate()
+    # MODEL_CANDIDATE starts a shadow or A/B comparison against it
+    candidate = os.getenv("MODEL_CANDIDATE")
+    if candidate:
+        try:
+            await intent_models.start_experiment(
+                candidate,
+                mode=os.getenv("MODEL_EXPERIMENT_MODE", "shadow"),
+                percent=float(os.getenv("MODEL_CANDIDATE_PERCENT", "10")),
+            )
+        except Exception as e:
+            print(f"Warning: candidate model {candidate} not started: {e}")
+    return model
 
-# Load environment variables from .env file
-load_dotenv()
+async def stop_intent_model(model):
+    await intent_models.close()
 
-# Login for gated models (e.g., Llama) - set your HF token
-hf_token = os.getenv("HF_TOKEN")  # Set this env var with your token
-if hf_token:
-    login(hf_token)
-else:
-    print("Warning: HF_TOKEN not set; Llama fallback may fail.")
+async def load_entity_extractor():
+    extractor = await asyncio.to_thread(create_entity_extractor, catalog)
+    await extractor.start()
+    return extractor
 
-nlp = spacy.load("en_core_web_sm")  # Should now load without error
-classifier = pipeline("text-classification", model="multi_intent_model", tokenizer="multi_intent_model")
+async def stop_entity_extractor(extractor):
+    await extractor.stop()
 
-# Label mapping
-inverse_label_map = {0: "search_product", 1: "place_order", 2: "track_order"}
+if nlp_enabled:
+    components.add("hf_login", hf_login)
+    components.add("intent", load_intent_model, stop_intent_model)
+    components.add("entities", load_entity_extractor, stop_entity_extractor)
 
 class TextInput(BaseModel):
     text: str
+    clientId: Optional[str] = None  # selects the client's catalog namespace
+
+# Results for normalized query text; ready questions and near-duplicates skip the model
+intent_cache = create_intent_cache("")
+
+# Brand/category automaton from catalog.json, rebuilt when the file changes
+catalog = create_catalog(on_reload=lambda: intent_cache.invalidate_local(("entities",)))
+
+async def nlp_component(name: str):
+    if not nlp_enabled:
+        raise HTTPException(status_code=503, detail="NLP is not served by this worker (WORKER_ROLE=crud)")
+    try:
+        return await components[name].get()
+    except Exception:
+        raise HTTPException(status_code=503, detail=f"{name} model is unavailable: {components[name].error}")
+
+async def classify_text(text: str):
+    """(model, per-label scores) from the active intent model."""
+    with NLP_STAGE_SECONDS.time("intent"), span("classify_text"):
+        return await _classify_text(text)
+
+async def _classify_text(text: str):
+    await nlp_component("intent")
+    text = normalize_text(text)
+    # Read once: a hot swap may replace intent_models.active while this request runs
+    model = intent_models.route(text)
+    # Classify intent (cached, otherwise batched with concurrent requests)
+    scores = await intent_cache.intent_scores(text, model.predict, version=model.version)
+    experiment = intent_models.experiment
+    if experiment and experiment.mode == "shadow" and model is intent_models.active:
+        candidate = experiment.candidate
+        experiment.shadow(model, scores, lambda: intent_cache.intent_scores(text, candidate.predict, version=candidate.version))
+    return model, scores
+
+async def extract_entities(text: str, clientId: Optional[str] = None) -> dict:
+    # Tagger + NER only, batched through nlp.pipe; catalog category matches skip the model
+    entity_extractor = await nlp_component("entities")
+    # Cached per client, since each client has its own catalog
+    with NLP_STAGE_SECONDS.time("entities"), span("extract_entities", clientId=clientId or ""):
+        return await intent_cache.entities(
+            text, lambda t: entity_extractor.extract(t, clientId), namespace=clientId
+        )
+
+async def prewarm_intent_cache(queries: List[str], clientId: Optional[str] = None):
+    # Runs after a settings save so a client's ready questions are answered from cache
+    await asyncio.gather(*(
+        asyncio.gather(classify_text(query), extract_entities(normalize_text(query), clientId))
+        for query in queries
+    ), return_exceptions=True)
+
+@app.get("/classify-intent/metrics")
+async def classify_intent_metrics():
+    return {
+        **(intent_models.active.batcher.stats() if intent_models.active else {}),
+        "model": intent_models.active.version if intent_models.active else None,
+        "cache": {"modelVersion": intent_cache.model_version, **intent_cache.stats()},
+        "entities": components["entities"].value.stats() if "entities" in components and components["entities"].ready else None,
+    }
 
 @app.post("/classify-intent")
 async def classify_intent(input: TextInput):
-    # Classify intent
-    result = classifier(input.text.lower())[0]  # Returns list of scores for each label
-    intents = [
-        {"intent": inverse_label_map[i], "confidence": score["score"]}
-        for i, score in enumerate(result) if score["score"] > 0.5
-    ]
-
-    # Entity extraction
-    doc = nlp(input.text.lower())
-    is_cheapest = "cheapest" in input.text.lower()
-    brand = "Sony"  # Default brand
-    category = "headphone"  # Default category
-    for token in doc:
-        if token.pos_ == "NOUN" and token.text not in ["cheapest", "expensive"]:
-            category = token.text  # Extract last noun as category
-        if token.ent_type_ == "ORG":
-            brand = token.text  # Extract brand if recognized
+    text = normalize_text(input.text)
+    (model, result), params = await asyncio.gather(
+        classify_text(text),
+        extract_entities(text, input.clientId),
+    )
+    intents = model.intents(result)
 
     return {
         "intents": intents,  # Return list of intents with confidences
-        "params": {
-            "brand": brand,
-            "category": category,
-            "sort": "price_asc" if is_cheapest else "price_desc"
-        }
+        "model": model.name,
+        "params": dict(params)
     }
 
 # Agent Endpoints
 @app.post("/agents")
 async def create_agent(agent: dict):
-    db.agents.update_one(
-        {"websiteId": agent["websiteId"], "intent": agent["intent"]},
-        {"$set": agent},
-        upsert=True
-    )
+    await repos.agents.upsert(agent)
+    await cache.invalidate("agents", agent["websiteId"])
+    await cache.invalidate("chain_plans", agent["websiteId"])
     return {"status": "Agent created"}
 
+async def cached_agents(websiteId: str, intent: str = None):
+    async def load():
+        agents = await repos.agents.find(websiteId, intent)
+        return build_cached_response({"agents": agents}, agents)
+
+    return await cache.get_or_load(("agents", websiteId, intent), load)
+
 @app.get("/agents")
-async def get_agents(websiteId: str, intent: str = None):
-    query = {"websiteId": websiteId}
-    if intent:
-        query["intent"] = intent
-    agents = list(db.agents.find(query, {"_id": 0}))
-    return {"agents": agents}
+async def get_agents(request: Request, websiteId: str, intent: str = None):
+    return conditional_response(request, await cached_agents(websiteId, intent))
 
 # Chain Endpoints
 @app.post("/chains")
 async def create_chain(chain: dict):
     if not chain.get("websiteId") or not chain.get("chainId") or not chain.get("agentSequence"):
         raise HTTPException(status_code=400, detail="Missing required fields")
-    db.chains.update_one(
-        {"websiteId": chain["websiteId"], "chainId": chain["chainId"]},
-        {"$set": chain},
-        upsert=True
-    )
+    await repos.chains.upsert(chain)
+    await cache.invalidate("chains", chain["websiteId"])
+    await cache.invalidate("chain_plans", chain["websiteId"])
     return {"status": "Chain created"}
 
+async def cached_chains(websiteId: str):
+    async def load():
+        chains = await repos.chains.find(websiteId)
+        return build_cached_response({"chains": chains}, chains)
+
+    return await cache.get_or_load(("chains", websiteId), load)
+
 @app.get("/chains")
-async def get_chains(websiteId: str):
-    chains = list(db.chains.find({"websiteId": websiteId}, {"_id": 0}))
-    return {"chains": chains}
+async def get_chains(request: Request, websiteId: str):
+    return conditional_response(request, await cached_chains(websiteId))
 
 # Widget Settings Models
 class ReadyQuestion(BaseModel):
@@ -208,59 +379,56 @@ class HumanAgent(BaseModel):
     email: str
     status: str = "offline"
     lastActive: Optional[str] = None
+    capacity: Optional[int] = None  # concurrent sessions (AGENT_DEFAULT_CAPACITY when unset)
+    skills: List[str] = []  # intents this agent handles (as in `agents.intent`)
+    weight: float = 1.0  # share of assignments under weighted_round_robin
 
 # Human Agent Endpoints (uses `humanAgents` collection)
 @app.post("/human-agents")
 async def create_human_agent(agent: HumanAgent):
-    db.humanAgents.update_one(
-        {"websiteId": agent.websiteId, "agentId": agent.agentId},
-        {"$set": agent.dict()},
-        upsert=True
-    )
+    await repos.human_agents.upsert(agent.dict())
+    agent_routing.upsert(agent.dict())
+    agent_presence.upsert(agent.dict())
     return {"status": "Human agent created"}
 
 @app.get("/human-agents")
 async def get_human_agents(websiteId: str, agentId: str = None):
-    query = {"websiteId": websiteId}
-    if agentId:
-        query["agentId"] = agentId
-    agents = list(db.humanAgents.find(query, {"_id": 0}))
+    agents = await repos.human_agents.find(websiteId, agentId)
     return {"agents": agents}
 
 @app.post("/human-agents/status")
 async def update_human_agent_status(status: AgentStatus):
-    db.humanAgents.update_one(
-        {"agentId": status.agentId},
-        {"$set": {"status": status.status, "lastActive": datetime.utcnow().isoformat()}},
-    )
+    # Held in memory and written to Mongo with the next presence flush
+    await agent_presence.set_status(status.agentId, status.status)
     return {"status": "Human agent status updated"}
 
 @app.get("/human-agents/available")
 async def get_available_human_agents(websiteId: str):
-    agents = list(db.humanAgents.find({"websiteId": websiteId, "status": "online"}, {"_id": 0}))
-    return {"agents": agents}
+    return {"agents": agent_presence.available(websiteId)}
+
+@app.get("/human-agents/routing")
+async def get_human_agent_routing(websiteId: Optional[str] = None):
+    if websiteId:
+        return {"agents": [agent.to_dict() for agent in agent_routing.online(websiteId)]}
+    return agent_routing.stats()
 
 
 # Widget Settings Endpoints
-@app.get("/widget/{clientId}")
-async def get_widget_settings(clientId: str):
-    settings = db.widgetSettings.find_one({"clientId": clientId}, {"_id": 0})
-    
-    if not settings:
-        # Create default settings inside `widgetSettings`
-        default_settings = WidgetSettings().dict()
-        full_document = {
-            "clientId": clientId,
-            "widgetSettings": default_settings
-        }
-        db.widgetSettings.insert_one(full_document)
-        return full_document
+async def cached_widget_settings(clientId: str):
+    async def load():
+        # Creates default settings inside `widgetSettings` on first access
+        settings = await repos.widget_settings.get_or_create(clientId, WidgetSettings().dict())
+        return build_cached_response(settings, [settings])
+
+    return await cache.get_or_load(("widget", clientId), load)
 
-    return settings
+@app.get("/widget/{clientId}")
+async def get_widget_settings(request: Request, clientId: str):
+    return conditional_response(request, await cached_widget_settings(clientId))
 
 
 @app.post("/widget/{clientId}")
-async def update_widget_settings(clientId: str, settings: WidgetSettings):
+async def update_widget_settings(clientId: str, settings: WidgetSettings, background_tasks: BackgroundTasks):
     # Validate inputs to prevent XSS or invalid data
     if not all(isinstance(q.label, str) and isinstance(q.query, str) for q in settings.readyQuestions):
         raise HTTPException(status_code=400, detail="Invalid ready questions format")
@@ -269,35 +437,313 @@ async def update_widget_settings(clientId: str, settings: WidgetSettings):
 
     updated_settings = settings.dict()
 
-    db.widgetSettings.update_one(
-        {"clientId": clientId},
-        {"$set": {
-            "clientId": clientId,
-            "widgetSettings": updated_settings
-        }},
-        upsert=True
-    )
+    await repos.widget_settings.upsert(clientId, updated_settings)
+    await cache.invalidate("widget", clientId)
+    if nlp_enabled:
+        background_tasks.add_task(prewarm_intent_cache, [q.query for q in settings.readyQuestions], clientId)
 
     return {"status": "Widget settings updated"}
 
 
+@app.get("/inference/health")
+async def inference_health():
+    model = intent_models.active
+    if model is None:
+        return {"mode": None, "version": None}
+    if model.pool is None:
+        return {"mode": "in-process", "version": model.version}
+    return {"mode": "pool", **model.pool.stats()}
+
+@app.get("/models")
+async def list_models():
+    return intent_models.stats()
+
+@app.post("/models/{name}/activate")
+async def activate_model(name: str):
+    # Loads and warms the model first; traffic moves over only once it is ready
+    if not nlp_enabled:
+        raise HTTPException(status_code=503, detail="NLP is not served by this worker (WORKER_ROLE=crud)")
+    try:
+        model = await intent_models.activate(name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown model {name}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Activating {name} failed: {e}")
+    return {"status": "Model activated", **intent_models.last_swap, "warmupMs": model.warmup_ms}
+
+class ExperimentRequest(BaseModel):
+    candidate: str
+    mode: str = "shadow"  # "shadow" (compare only) or "ab" (candidate answers `percent` of queries)
+    percent: float = 10.0
+
+@app.get("/models/experiment")
+async def get_experiment():
+    if not intent_models.experiment:
+        raise HTTPException(status_code=404, detail="No experiment running")
+    return intent_models.experiment.stats(intent_models.active)
+
+@app.post("/models/experiment")
+async def start_experiment(request: ExperimentRequest):
+    await nlp_component("intent")
+    try:
+        experiment = await intent_models.start_experiment(request.candidate, request.mode, request.percent)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown model {request.candidate}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "Experiment started", **experiment.stats(intent_models.active)}
+
+@app.delete("/models/experiment")
+async def stop_experiment():
+    experiment = await intent_models.stop_experiment()
+    if not experiment:
+        raise HTTPException(status_code=404, detail="No experiment running")
+    return {"status": "Experiment stopped", **experiment.stats(intent_models.active)}
+
+@app.post("/models/experiment/promote")
+async def promote_candidate():
+    # The candidate is already loaded and warm, so this is just the cut-over
+    try:
+        model = await intent_models.promote()
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"status": "Candidate promoted", **intent_models.last_swap, "model": model.name}
+
+@app.get("/ready")
+async def ready():
+    # 503 until every model component for this worker's role has loaded
+    status = components.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/startup/report")
+async def startup_report():
+    return components.report()
+
+@app.get("/runtime/stats")
+async def runtime_stats(window: Optional[float] = None):
+    # Per worker process; `window` limits the loop-lag percentiles to the last N seconds
+    return {
+        "pid": os.getpid(),
+        "role": components.role,
+        "rssMb": rss_mb(),
+        "maxRssMb": max_rss_mb(),
+        "loopLag": loop_lag.stats(window),
+        "websockets": router.stats(),
+        "agentPresence": agent_presence.stats(),
+        "chains": chain_executor.stats(),
+    }
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text format, for this worker process only
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+def _batcher_depths():
+    batchers = []
+    if intent_models.active:
+        batchers.append(intent_models.active.batcher)
+    if "entities" in components and components["entities"].ready:
+        batchers.append(components["entities"].value.batcher)
+    return [((b.name,), b.stats()["queueDepth"]) for b in batchers]
+
+def _cache_counts(field: str):
+    for name, stats in (("bootstrap", cache.stats()), ("intent", intent_cache.stats())):
+        for kind, counts in stats.get("byType", {}).items():
+            yield (name, kind), counts[field]
+
+def _socket_stats(**fields):
+    stats = router.manager.stats()
+    return [((label,), stats[field]) for label, field in fields.items()]
+
+collected("ws_connections", "Open WebSocket connections on this worker", ["kind"],
+          lambda: _socket_stats(user="users", agent="agents"))
+collected("ws_outbound_queue_depth", "Messages queued for slow sockets", ["stat"],
+          lambda: _socket_stats(max="maxQueueDepth", total="totalQueued"))
+collected("ws_evictions_total", "Sockets closed for being slow or idle", ["reason"],
+          lambda: _socket_stats(slow="evictedSlow", idle="evictedIdle"), kind="counter")
+collected("human_agents_online", "Online human agents as this worker sees them", [], lambda: [((), agent_presence.stats()["online"])])
+collected("batcher_queue_depth", "Items waiting for a batch", ["batcher"], _batcher_depths)
+collected("message_writer_pending", "Chat messages journaled but not yet in Mongo", [], lambda: [((), message_writer.stats()["pending"])])
+collected("cache_hits_total", "Cache hits", ["cache", "kind"], lambda: _cache_counts("hits"), kind="counter")
+collected("cache_misses_total", "Cache misses", ["cache", "kind"], lambda: _cache_counts("misses"), kind="counter")
+collected("process_resident_memory_bytes", "Resident set size", [], lambda: [((), int((rss_mb() or 0) * 1024 * 1024))])
+
+# Admin endpoints need ADMIN_TOKEN set and sent back as X-Admin-Token; otherwise they don't exist
+def check_admin(request: Request):
+    token = os.getenv("ADMIN_TOKEN")
+    if not token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("x-admin-token", ""), token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.post("/admin/profile")
+async def profile_worker(request: Request, seconds: float = 10.0, hz: float = 100.0, idle: bool = False):
+    # Samples this worker's threads; the collapsed stacks feed flamegraph.pl or speedscope
+    check_admin(request)
+    if not 0 < seconds <= 120 or not 1 <= hz <= 1000:
+        raise HTTPException(status_code=400, detail="seconds must be in (0, 120] and hz in [1, 1000]")
+    if PROFILER.running:
+        raise HTTPException(status_code=409, detail="A profile is already running on this worker")
+    try:
+        stacks = await asyncio.to_thread(PROFILER.run, seconds, hz, idle)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Response(collapsed(stacks), media_type="text/plain", headers={"X-Worker-Pid": str(os.getpid())})
+
+class TracingSettings(BaseModel):
+    sampleRate: float
+
+@app.get("/admin/tracing")
+async def tracing_stats(request: Request):
+    check_admin(request)
+    return TRACER.stats()
+
+@app.post("/admin/tracing")
+async def update_tracing(request: Request, settings: TracingSettings):
+    # This worker only; TRACE_SAMPLE_RATE sets the starting rate of every worker
+    check_admin(request)
+    if not TRACER.enabled:
+        raise HTTPException(status_code=400, detail="Tracing is off (TRACE_EXPORTER=none)")
+    if not 0 <= settings.sampleRate <= 1:
+        raise HTTPException(status_code=400, detail="sampleRate must be between 0 and 1")
+    TRACER.sample_rate = settings.sampleRate
+    return TRACER.stats()
+
+@app.get("/catalog/stats")
+async def catalog_stats():
+    return catalog.stats()
+
+@app.post("/catalog/reload")
+async def reload_catalog():
+    reloaded = await catalog.reload(force=True)
+    return {"reloaded": reloaded, **catalog.stats()}
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return cache.stats()
+
+@app.get("/ws/stats")
+async def websocket_stats():
+    return router.stats()
+
+@app.get("/chat/write-behind/stats")
+async def message_writer_stats():
+    return message_writer.stats()
+
+
 # Chat Session Endpoints
 @app.post("/chat/session")
 async def create_chat_session(session: ChatSession):
-    session_dict = session.dict()
-    session_dict["createdAt"] = datetime.utcnow().isoformat()
-    session_dict["updatedAt"] = session_dict["createdAt"]
-    db.chat_sessions.insert_one(session_dict)
+    await repos.chat_sessions.create(session.dict())
     return {"sessionId": session.sessionId}
 
+# Widget Bootstrap: settings + agents + chains (+ session) in one round-trip
+BOOTSTRAP_STATIC_FIELDS = ("settings", "agents", "chains")
+
+def _parse_fields(fields: Optional[List[str]], allowed) -> List[str]:
+    if not fields:
+        return list(allowed)
+    selected = [f.strip() for f in fields if f.strip()]
+    unknown = [f for f in selected if f not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown bootstrap fields: {', '.join(unknown)}")
+    return selected
+
+async def load_bootstrap_parts(clientId: str, websiteId: str, fields: List[str]) -> Dict[str, CachedResponse]:
+    loaders = {
+        "settings": lambda: cached_widget_settings(clientId),
+        "agents": lambda: cached_agents(websiteId),
+        "chains": lambda: cached_chains(websiteId),
+    }
+    static_fields = [f for f in fields if f in loaders]
+    results = await asyncio.gather(*(loaders[f]() for f in static_fields))
+    return dict(zip(static_fields, results))
+
+def _bootstrap_part(name: str, cached: CachedResponse):
+    # Same shapes as GET /widget/{clientId}, /agents and /chains
+    return cached.payload if name == "settings" else cached.payload[name]
+
+@app.get("/widget/{clientId}/bootstrap")
+async def get_widget_bootstrap(request: Request, clientId: str, websiteId: str = None, fields: str = None):
+    # Cacheable variant: only the parts that don't change per user
+    selected = _parse_fields(fields.split(",") if fields else None, BOOTSTRAP_STATIC_FIELDS)
+    parts = await load_bootstrap_parts(clientId, websiteId or clientId, selected)
+    combined = combine_cached_responses(
+        {name: _bootstrap_part(name, cached) for name, cached in parts.items()},
+        parts,
+    )
+    return conditional_response(request, combined)
+
+class BootstrapRequest(BaseModel):
+    userId: str
+    sessionId: Optional[str] = None
+    websiteId: Optional[str] = None
+    fields: Optional[List[str]] = None
+    # Part name -> ETag the client already holds; those parts are not resent
+    etags: Dict[str, str] = {}
+
+@app.post("/widget/{clientId}/bootstrap")
+async def widget_bootstrap(clientId: str, request: BootstrapRequest):
+    selected = _parse_fields(request.fields, BOOTSTRAP_STATIC_FIELDS + ("session",))
+    session = None
+    if "session" in selected:
+        session = ChatSession(
+            sessionId=request.sessionId or uuid.uuid4().hex, clientId=clientId, userId=request.userId
+        )
+    parts, _ = await asyncio.gather(
+        load_bootstrap_parts(clientId, request.websiteId or clientId, selected),
+        repos.chat_sessions.create(session.dict()) if session else asyncio.sleep(0),
+    )
+
+    payload = {"etags": {}, "notModified": []}
+    for name, cached in parts.items():
+        payload["etags"][name] = cached.etag
+        if etag_matches(request.etags.get(name), cached.etag):
+            payload["notModified"].append(name)
+        else:
+            payload[name] = _bootstrap_part(name, cached)
+    if session:
+        payload["session"] = {"sessionId": session.sessionId, "status": session.status}
+    return Response(
+        content=serialize(payload),
+        media_type="application/json",
+        headers={"Cache-Control": "no-store"},
+    )
+
 @app.get("/chat/session")
-async def list_chat_sessions(agentId: str, clientId: str):
-    sessions = list(db.chat_sessions.find(
-        {"agentId": agentId, "clientId": clientId},
-        {"_id": 0}
-    ))
+async def list_chat_sessions(agentId: str, clientId: str, recentMessages: int = 0):
+    # Summaries only (messageCount, lastMessage, timestamps); recentMessages embeds
+    # the latest N messages per session for clients that render them directly
+    sessions = await repos.chat_sessions.list_for_agent(agentId, clientId)
+    if recentMessages > 0:
+        histories = await asyncio.gather(*(
+            repos.chat_messages.history(session["sessionId"], limit=min(recentMessages, 200))
+            for session in sessions
+        ))
+        for session, history in zip(sessions, histories):
+            session["messages"] = history["messages"]
     return {"sessions": sessions}
 
+@app.get("/chat/session/{sessionId}/messages")
+async def get_chat_messages(sessionId: str, before: Optional[int] = None, limit: int = 50):
+    # Cursor pagination: pass the returned nextCursor as `before` to page backwards
+    if limit < 1 or limit > 200:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 200")
+    return await repos.chat_messages.history(sessionId, before=before, limit=limit)
+
+
+# Who a session belongs to never changes; agentId and status change on handoff/close,
+# so they are read from Mongo where needed rather than cached
+SESSION_IDENTITY_FIELDS = ("sessionId", "clientId", "userId")
+
+async def cached_session(session_id: str) -> Optional[dict]:
+    session = cache.get(("session", session_id))
+    if session is None:
+        found = await repos.chat_sessions.find(session_id)
+        if found:
+            session = {field: found.get(field) for field in SESSION_IDENTITY_FIELDS}
+            cache.set(("session", session_id), session)
+    return session
 
 class CloseSessionRequest(BaseModel):
     session_id: str
@@ -305,155 +751,198 @@ class CloseSessionRequest(BaseModel):
 @app.post("/chat/session/close")
 async def close_session(request: CloseSessionRequest):
     session_id = request.session_id
-    session = db.chat_sessions.find_one({"sessionId": session_id})
+    session = await repos.chat_sessions.find(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    db.chat_sessions.update_one(
-        {"sessionId": session_id},
-        {"$set": {"status": "closed", "agentId": None, "updatedAt": datetime.utcnow().isoformat()}}
-    )
+    await repos.chat_sessions.close(session_id)
+    agent_routing.release(session_id)
 
-    user_ws = connected_clients.get((session["clientId"], session["userId"]))
-    if user_ws:
-        await user_ws.send_json({
-            "message": {
-                "sender": "bot",
-                "text": "Live chat ended.",
-                "timestamp": datetime.utcnow().isoformat()
-            }
-        })
+    await router.deliver(user_target(session["clientId"], session["userId"]), {
+        "message": {
+            "sender": "bot",
+            "text": "Live chat ended.",
+            "timestamp": datetime.utcnow().isoformat()
+        }
+    })
 
     return {"message": "Session closed"}
 
 
-# @app.websocket("/ws/chat/{clientId}/{userId}")
-# async def websocket_user_endpoint(websocket: WebSocket, clientId: str, userId: str):
-#     await websocket.accept()
-#     connected_clients[(clientId, userId)] = websocket
-#     try:
-#         while True:
-#             data = await websocket.receive_json()
-#             try:
-#                 if not isinstance(data, dict) or "sessionId" not in data or "message" not in data:
-#                     await websocket.send_json({"error": "Invalid message format: sessionId and message required"})
-#                     continue
-#                 session_id = data["sessionId"]
-#                 message = ChatMessage(**data["message"])
-#             except ValidationError as e:
-#                 await websocket.send_json({"error": f"Invalid message format: {str(e)}"})
-#                 continue
-#             except KeyError as e:
-#                 await websocket.send_json({"error": f"Missing field: {str(e)}"})
-#                 continue
-
-#             session = db.chat_sessions.find_one({"sessionId": session_id})
-#             if not session:
-#                 await websocket.send_json({"error": "Session not found"})
-#                 continue
-
-#             # Save message to session
-#             new_message = message.dict()
-#             db.chat_sessions.update_one(
-#                 {"sessionId": session_id},
-#                 {"$push": {"messages": new_message}, "$set": {"updatedAt": datetime.utcnow().isoformat()}}
-#             )
-
-#             # Handle human assistance request
-#             if message.text == "human_assistance":
-#                 print("clientId", clientId)
-#                 agents = list(db.humanAgents.find({"websiteId": clientId, "status": "online"}, {"_id": 0}))
-#                 if not agents:
-#                     print("no agents found")
-#                     await websocket.send_json({"message": {"sender": "bot", "text": "No specialists available. Please try again later.", "timestamp": datetime.utcnow().isoformat()}})
-#                     continue
-#                 agent = agents[0]  # Simple routing: pick first available
-#                 db.chat_sessions.update_one(
-#                     {"sessionId": session_id},
-#                     {"$set": {"agentId": agent["agentId"], "status": "active", "updatedAt": datetime.utcnow().isoformat()}}
-#                 )
-#                 # Notify client of agent assignment
-#                 await websocket.send_json({"agentAssigned": True, "message": {"sender": "bot", "text": "Connecting you to a specialist...", "timestamp": datetime.utcnow().isoformat()}})
-#                 # Notify agent
-#                 agent_ws = connected_agents.get(agent["agentId"])
-#                 if agent_ws:
-#                     await agent_ws.send_json({"sessionId": session_id, "message": {"sender": "user", "text": "User requested assistance", "timestamp": datetime.utcnow().isoformat()}})
-#             else:
-#                 # Forward message to assigned agent
-#                 print("agentId", session.get("agentId"))
-#                 if session.get("agentId"):
-#                     agent_ws = connected_agents.get(session["agentId"])
-#                     print("connected agents", connected_agents.get(session["agentId"]), connected_agents)
-#                     if agent_ws:
-#                         await agent_ws.send_json({"sessionId": session_id, "message": new_message})
-#                     else:
-#                         await websocket.send_json({"message": {"sender": "bot", "text": "Specialist is unavailable.", "timestamp": datetime.utcnow().isoformat()}})
-#                 else:
-                    # Handle with bot using intent classifier
-                    # intent_result = classifier(message.text)
-                    # if intent_result[0]["label"] == "human_assistance" or intent_result[0]["score"] < 0.7:
-                    #     agents = list(db.humanAgents.find({"websiteId": clientId, "status": "online"}, {"_id": 0}))
-                    #     if agents:
-                    #         agent = agents[0]
-                    #         db.chat_sessions.update_one(
-                    #             {"sessionId": session_id},
-                    #             {"$set": {"agentId": agent["agentId"], "status": "active", "updatedAt": datetime.utcnow().isoformat()}}
-                    #         )
-                    #         await websocket.send_json({"agentAssigned": True, "message": {"sender": "bot", "text": "Connecting you to a specialist...", "timestamp": datetime.utcnow().isoformat()}})
-                    #         agent_ws = connected_agents.get(agent["agentId"])
-                    #         if agent_ws:
-                    #             await agent_ws.send_json({"sessionId": session_id, "message": new_message})
-                    #     else:
-                    #         await websocket.send_json({"message": {"sender": "bot", "text": "No specialists available. Please try again later.", "timestamp": datetime.utcnow().isoformat()}})
-                    # else:
-                    #     await websocket.send_json({"message": {"sender": "bot", "text": f"Bot response for intent: {intent_result[0]['label']}", "timestamp": datetime.utcnow().isoformat()}})
-    # except WebSocketDisconnect:
-    #     del connected_clients[(clientId, userId)]
+def bot_message(text: str) -> dict:
+    return {"message": {"sender": "bot", "text": text, "timestamp": datetime.utcnow().isoformat()}}
 
-@app.websocket("/ws/agent/{agentId}")
-async def websocket_agent_endpoint(websocket: WebSocket, agentId: str):
-    await websocket.accept()
-    connected_agents[agentId] = websocket
+def parse_socket_message(data):
+    # Returns (session_id, ChatMessage) or an error payload for the sender
+    try:
+        if not isinstance(data, dict) or "sessionId" not in data or "message" not in data:
+            return None, {"error": "Invalid message format: sessionId and message required"}
+        return (data["sessionId"], ChatMessage(**data["message"])), None
+    except ValidationError as e:
+        return None, {"error": f"Invalid message format: {str(e)}"}
+    except (KeyError, TypeError) as e:
+        return None, {"error": f"Missing field: {str(e)}"}
+
+async def assign_human_agent(connection, clientId: str, session_id: str, forward: dict, skill: Optional[str] = None) -> bool:
+    # Least-loaded (or weighted round-robin) online agent, preferring ones with `skill`
+    agent = agent_routing.assign(clientId, session_id, skill)
+    if agent is None:
+        router.manager.send_to(connection, bot_message("No specialists available. Please try again later."))
+        return False
+    await repos.chat_sessions.assign_agent(session_id, agent.agentId)
+    # Notify client of agent assignment
+    router.manager.send_to(connection, {"agentAssigned": True, **bot_message("Connecting you to a specialist...")})
+    # Notify agent
+    await router.deliver(agent_target(agent.agentId), {"sessionId": session_id, "message": forward})
+    return True
+
+# Below this confidence the bot hands the conversation to a human specialist
+HANDOFF_CONFIDENCE = float(os.getenv("HANDOFF_CONFIDENCE", "0.7"))
+
+async def handle_user_message(connection, clientId: str, session_id: str, session: dict, message: ChatMessage):
+    new_message = message.dict()
+    # Save message to session; the assigned agent is read fresh (another worker may have handed off)
+    _, agentId = await asyncio.gather(
+        message_writer.enqueue(session_id, new_message), repos.chat_sessions.assigned_agent(session_id)
+    )
+
+    # Handle human assistance request
+    if message.text == "human_assistance":
+        await assign_human_agent(connection, clientId, session_id, {
+            "sender": "user", "text": "User requested assistance", "timestamp": datetime.utcnow().isoformat()
+        })
+    elif agentId:
+        # Forward message to assigned agent
+        delivered = await router.deliver(agent_target(agentId), {"sessionId": session_id, "message": new_message})
+        if not delivered:
+            router.manager.send_to(connection, bot_message("Specialist is unavailable."))
+    else:
+        # Handle with bot using intent classifier
+        if not nlp_enabled:
+            await assign_human_agent(connection, clientId, session_id, new_message)
+            return
+        text = normalize_text(message.text)
+        (model, scores), params = await asyncio.gather(classify_text(text), extract_entities(text, clientId))
+        best = max(range(len(scores)), key=scores.__getitem__)
+        intent = model.spec.labels.get(best, best)
+        if scores[best] < HANDOFF_CONFIDENCE:
+            await assign_human_agent(connection, clientId, session_id, new_message, skill=model.spec.labels.get(best))
+            return
+        # The intent's agent chain runs beside the receive loop, so pongs and further messages aren't held up
+        start_chain(connection, clientId, intent, dict(params))
+
+# Chain runs per user socket, cancelled when it disconnects
+chain_runs: Dict[object, set] = {}
+
+async def run_chain(connection, clientId: str, intent: str, params: dict):
+    # Its own trace: the message's trace has usually been exported by the time stages finish
+    with activate(None), TRACER.trace("ws chain run", clientId=clientId, intent=intent):
+        # Each stage's result is streamed to the user as it finishes
+        ran = await chain_executor.run(clientId, intent, params, lambda event: router.manager.send_to(connection, event))
+    if ran is None:
+        router.manager.send_to(connection, bot_message(f"Bot response for intent: {intent}"))
+
+def start_chain(connection, clientId: str, intent: str, params: dict):
+    runs = chain_runs.setdefault(connection, set())
+    task = asyncio.create_task(run_chain(connection, clientId, intent, params), name=f"chain:{connection.target}")
+    runs.add(task)
+    task.add_done_callback(runs.discard)
+
+@app.websocket("/ws/chat/{clientId}/{userId}")
+async def websocket_user_endpoint(websocket: WebSocket, clientId: str, userId: str):
+    connection = await router.connect(user_target(clientId, userId), websocket)
     try:
         while True:
             data = await websocket.receive_json()
-            try:
-                if not isinstance(data, dict) or "sessionId" not in data or "message" not in data:
-                    await websocket.send_json({"error": "Invalid message format: sessionId and message required"})
-                    continue
-                session_id = data["sessionId"]
-                message = ChatMessage(**data["message"])
-            except ValidationError as e:
-                await websocket.send_json({"error": f"Invalid message format: {str(e)}"})
+            connection.touch()
+            if isinstance(data, dict) and data.get("type") == "pong":
                 continue
-            except KeyError as e:
-                await websocket.send_json({"error": f"Missing field: {str(e)}"})
+            parsed, error = parse_socket_message(data)
+            if error:
+                router.manager.send_to(connection, error)
                 continue
+            session_id, message = parsed
 
-            session = db.chat_sessions.find_one({"sessionId": session_id})
-            if not session:
-                await websocket.send_json({"error": "Session not found"})
-                continue
+            with WS_MESSAGE_SECONDS.time("user", "total"), TRACER.trace("ws user message", clientId=clientId, sessionId=session_id):
+                session = await cached_session(session_id)
+                if not session:
+                    router.manager.send_to(connection, {"error": "Session not found"})
+                    continue
+                await handle_user_message(connection, clientId, session_id, session, message)
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: the socket was closed server-side (slow-client or idle eviction)
+        pass
+    finally:
+        for task in chain_runs.pop(connection, ()):
+            task.cancel()
+        await router.disconnect(connection)
+
+async def handle_agent_message(connection, session_id: str, message: ChatMessage):
+    started = time.perf_counter()
+    with WS_MESSAGE_SECONDS.time("agent", "session"), span("session"):
+        session = await cached_session(session_id)
+    if not session:
+        router.manager.send_to(connection, {"error": "Session not found"})
+        return
+
+    # Send to user first; persistence happens behind the delivery path
+    new_message = message.dict()
+    with WS_MESSAGE_SECONDS.time("agent", "deliver"), span("deliver"):
+        delivered = await router.deliver(
+            user_target(session["clientId"], session["userId"]), {"message": new_message}
+        )
+    if not delivered:
+        router.manager.send_to(connection, {"error": "User not connected"})
 
-            # Save message
-            new_message = message.dict()
-            db.chat_sessions.update_one(
-                {"sessionId": session_id},
-                {"$push": {"messages": new_message}, "$set": {"updatedAt": datetime.utcnow().isoformat()}}
-            )
+    # Save message (journaled, bulk-written to Mongo by the write-behind buffer)
+    with WS_MESSAGE_SECONDS.time("agent", "persist"), span("persist"):
+        await message_writer.enqueue(session_id, new_message)
+    WS_MESSAGE_SECONDS.observe(time.perf_counter() - started, "agent", "total")
 
-            # Send to user
-            user_ws = connected_clients.get((session["clientId"], session["userId"]))
-            if user_ws:
-                await user_ws.send_json({"message": new_message})
-            else:
-                await websocket.send_json({"error": "User not connected"})
-    except WebSocketDisconnect:
-        del connected_agents[agentId]
-        db.humanAgents.update_one(
-            {"agentId": agentId},
-            {"$set": {"status": "offline", "lastActive": datetime.utcnow().isoformat()}}
-        )
+@app.websocket("/ws/agent/{agentId}")
+async def websocket_agent_endpoint(websocket: WebSocket, agentId: str):
+    connection = await router.connect(agent_target(agentId), websocket)
+    await agent_presence.set_status(agentId, "online", connected=True)
+    try:
+        while True:
+            data = await websocket.receive_json()
+            connection.touch()
+            agent_presence.heartbeat(agentId)
+            if isinstance(data, dict) and data.get("type") == "pong":
+                continue
+            parsed, error = parse_socket_message(data)
+            if error:
+                router.manager.send_to(connection, error)
+                continue
+            session_id, message = parsed
+            with TRACER.trace("ws agent message", agentId=agentId, sessionId=session_id):
+                await handle_agent_message(connection, session_id, message)
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: the socket was closed server-side (slow-client or idle eviction)
+        pass
+    finally:
+        await router.disconnect(connection)
+        # Only mark offline if no newer socket for this agent replaced this one
+        if not router.is_local(agent_target(agentId)):
+            await agent_presence.set_status(agentId, "offline", connected=False)
+
+@app.websocket("/ws/presence/{websiteId}")
+async def websocket_presence_endpoint(websocket: WebSocket, websiteId: str):
+    # Dashboard feed: the online agents, then {"type": "presence", "agent": {...}} on every change
+    connection = await router.manager.connect(f"presence:{websiteId}:{uuid.uuid4().hex}", websocket)
+    presence_watchers.setdefault(websiteId, set()).add(connection)
+    router.manager.send_to(connection, {"type": "presence", "agents": agent_presence.available(websiteId)})
+    try:
+        while True:
+            await websocket.receive_json()
+            connection.touch()
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        presence_watchers.get(websiteId, set()).discard(connection)
+        router.manager.remove(connection)
+
+components.mark("app imported")
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,241 @@
+"""Prometheus text-format metrics, kept cheap enough to leave on in production.
+
+Metrics are plain objects updated in place (a lock, a bisect and an add per
+observation); values that already live elsewhere (socket counts, queue
+depths, cache hit counts) are read by callbacks only when /metrics is
+scraped. Every uvicorn worker has its own registry, so scrape each worker
+process (or run one worker per container).
+"""
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Seconds; from sub-millisecond cache hits to multi-second model loads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in values]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, *labels: str) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(k, list(counts), total) for k, (counts, total) in self._values.items()]
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = ("le", _number(bound) if bound == float("inf") else repr(float(bound)))
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total!r}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Collected(_Metric):
+    """Values read from a callback at scrape time: `collect()` yields (label values, value)."""
+
+    def __init__(self, name, help, labelnames, collect: Callable[[], Iterable[Tuple[tuple, float]]], kind: str = "gauge"):
+        super().__init__(name, help, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        try:
+            values = list(self.collect())
+        except Exception as e:
+            return [f"# {self.name} collection failed: {type(e).__name__}"]
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in values if v is not None]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+
+    def _add(self, metric: _Metric) -> _Metric:
+        # Registering the same name again (e.g. a second app instance in one process) reuses it
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def collected(self, name: str, help: str, labelnames: Sequence[str], collect, kind: str = "gauge") -> Collected:
+        # Replaced rather than reused: the callback closes over the current app's objects
+        metric = Collected(name, help, labelnames, collect, kind)
+        self.metrics[name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            body = metric.render()
+            if body:
+                lines += metric.header() + body
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+collected = REGISTRY.collected
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+HTTP_REQUEST_SECONDS = histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ["method", "route", "status"]
+)
+MONGO_COMMAND_SECONDS = histogram(
+    "mongo_command_duration_seconds", "Mongo command round-trip time", ["collection", "command"]
+)
+MONGO_COMMAND_FAILURES = counter("mongo_command_failures_total", "Failed Mongo commands", ["collection", "command"])
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request under its route template (not the raw path)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            # Unmatched paths share one label so scanners can't blow up the series count
+            path = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, scope["method"], path, str(status[0]))
+
+
+def mongo_listener():
+    """pymongo CommandListener recording per collection/command timings."""
+    from pymongo import monitoring
+
+    class CommandTimer(monitoring.CommandListener):
+        def __init__(self):
+            # Collection names are only in the started event
+            self._pending: Dict[tuple, str] = {}
+
+        def started(self, event):
+            collection = event.command.get(event.command_name)
+            self._pending[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+        def _finish(self, event) -> str:
+            return self._pending.pop((event.connection_id, event.request_id), "")
+
+        def succeeded(self, event):
+            MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, self._finish(event), event.command_name)
+
+        def failed(self, event):
+            collection = self._finish(event)
+            MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, collection, event.command_name)
+            MONGO_COMMAND_FAILURES.inc(collection, event.command_name)
+
+    return CommandTimer()
@@ -0,0 +1,80 @@
+"""Move embedded chat_sessions.messages arrays into chat_messages buckets.
+
+    python migrate_messages.py [--dry-run] [--batch-size 100]
+
+Idempotent: buckets are written with upserts keyed on (sessionId, bucket) and
+the embedded array is only removed after its buckets are stored, so an
+interrupted run can simply be restarted. Run it before the bucketed code
+takes traffic: a session that already received bucketed appends would have
+its seq numbers collide with the migrated history.
+"""
+import argparse
+import asyncio
+
+from pymongo import UpdateOne
+
+
+async def migrate(repos, batch_size: int = 100, dry_run: bool = False) -> dict:
+    sessions = repos.db["chat_sessions"]
+    buckets = repos.db["chat_messages"]
+    stats = {"sessions": 0, "messages": 0, "buckets": 0}
+    cursor = sessions.find({"messages": {"$exists": True}}, {"_id": 1, "sessionId": 1, "messages": 1})
+    cursor = cursor.batch_size(batch_size)
+    async for session in cursor:
+        messages = session.get("messages") or []
+        session_id = session["sessionId"]
+        ops = []
+        for seq in range(0, len(messages), repos.chat_messages.bucket_size):
+            chunk = messages[seq:seq + repos.chat_messages.bucket_size]
+            bucket = seq // repos.chat_messages.bucket_size
+            numbered = [{**message, "seq": seq + offset} for offset, message in enumerate(chunk)]
+            ops.append(UpdateOne(
+                {"sessionId": session_id, "bucket": bucket},
+                {"$setOnInsert": {
+                    "messages": numbered,
+                    "count": len(numbered),
+                    "firstSeq": numbered[0]["seq"],
+                    "lastSeq": numbered[-1]["seq"],
+                }},
+                upsert=True,
+            ))
+        stats["sessions"] += 1
+        stats["messages"] += len(messages)
+        stats["buckets"] += len(ops)
+        if dry_run:
+            continue
+        if ops:
+            await buckets.bulk_write(ops, ordered=False)
+        await sessions.update_one(
+            {"_id": session["_id"]},
+            {
+                "$set": {"messageCount": len(messages), "lastMessage": messages[-1] if messages else None},
+                "$unset": {"messages": ""},
+            },
+        )
+    return stats
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="count what would be migrated")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    from indexes import ensure_indexes
+    from repository import Repositories
+
+    load_dotenv()
+    repos = Repositories()
+    try:
+        if not args.dry_run:
+            await ensure_indexes(repos.db)
+        stats = await migrate(repos, batch_size=args.batch_size, dry_run=args.dry_run)
+        print(("Would migrate" if args.dry_run else "Migrated"), stats)
+    finally:
+        repos.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
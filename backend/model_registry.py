@@ -0,0 +1,379 @@
+import asyncio
+import json
+import os
+import time
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from batching import MicroBatcher
+from latency import LatencyWindow
+from metrics import counter, histogram
+from intent_backends import load_intent_backend, resolve_model_dir
+from model_server import create_inference_pool
+
+BASE_DIR = Path(__file__).resolve().parent
+REGISTRY_PATH = BASE_DIR / "models.json"
+
+DEFAULT_WARMUP = ["cheapest sony headphones", "where is my order"]
+
+MODEL_REQUEST_SECONDS = histogram("intent_model_request_seconds", "Queue wait plus batch run per query", ["model"])
+MODEL_REQUEST_ERRORS = counter("intent_model_request_errors_total", "Queries the model failed to answer", ["model"])
+
+
+@dataclass
+class ModelSpec:
+    name: str
+    path: str
+    labels: Dict[int, str]
+    threshold: float = 0.5
+    backend: Optional[str] = None  # None = INTENT_BACKEND
+
+
+def read_registry(path=None) -> dict:
+    path = Path(path or os.getenv("MODEL_REGISTRY_PATH") or REGISTRY_PATH)
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    specs = {}
+    for name, entry in raw.get("models", {}).items():
+        model_dir = resolve_model_dir(entry.get("path", name))
+        # A transformers checkpoint (exported on first use) or a shipped ONNX graph; a tokenizer alone can't serve
+        if not (model_dir / "config.json").exists() and not (model_dir / "model.onnx").exists():
+            print(f"Warning: skipping model {name}: no config.json or model.onnx in {model_dir}")
+            continue
+        specs[name] = ModelSpec(
+            name=name,
+            path=entry.get("path", name),
+            labels={int(i): label for i, label in entry["labels"].items()},
+            threshold=float(entry.get("threshold", 0.5)),
+            backend=entry.get("backend"),
+        )
+    return {"active": raw.get("active"), "models": specs, "warmup": raw.get("warmup") or DEFAULT_WARMUP}
+
+
+class ServedModel:
+    """A loaded model with its own batcher; counts requests in flight so it can be retired cleanly."""
+
+    def __init__(self, spec: ModelSpec, backend, pool=None, max_batch_size: int = 16, max_wait_ms: float = 5.0):
+        self.spec = spec
+        self.backend = backend
+        self.pool = pool
+        self.batcher = MicroBatcher(
+            backend.predict,
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+            name=f"intent:{spec.name}",
+            # One batch in flight per inference worker
+            max_concurrency=pool.workers_per_variant if pool else 1,
+        )
+        self.latency = LatencyWindow()
+        self.in_flight = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self.loaded_at = time.time()
+        self.warmup_ms = 0.0
+
+    @property
+    def name(self) -> str:
+        return self.spec.name
+
+    @property
+    def version(self) -> str:
+        return self.backend.version
+
+    async def predict(self, text: str) -> List[float]:
+        self.in_flight += 1
+        self._drained.clear()
+        started = time.perf_counter()
+        try:
+            scores = await self.batcher.submit(text)
+        except Exception:
+            self.latency.errors += 1
+            MODEL_REQUEST_ERRORS.inc(self.name)
+            raise
+        else:
+            # Queue wait + batch run: what a caller of this model actually waits for
+            elapsed = time.perf_counter() - started
+            self.latency.record(elapsed)
+            MODEL_REQUEST_SECONDS.observe(elapsed, self.name)
+            return scores
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self._drained.set()
+
+    def top_intent(self, scores: List[float]) -> str:
+        best = max(range(len(scores)), key=scores.__getitem__)
+        return self.spec.labels.get(best, f"label_{best}")
+
+    def intents(self, scores: List[float]) -> List[dict]:
+        return [
+            {"intent": self.spec.labels.get(i, f"label_{i}"), "confidence": score}
+            for i, score in enumerate(scores) if score > self.spec.threshold
+        ]
+
+    def warm_up(self, texts: List[str]):
+        # First calls pay for allocator growth / graph setup; do that before taking traffic
+        started = time.perf_counter()
+        self.backend.predict(texts[:1])
+        self.backend.predict(texts)
+        self.warmup_ms = (time.perf_counter() - started) * 1000.0
+
+    async def drain(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def close(self):
+        await self.batcher.stop()
+        if self.pool:
+            await self.pool.stop()
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "version": self.version,
+            "path": self.spec.path,
+            "backend": self.backend.name,
+            "threshold": self.spec.threshold,
+            "labels": self.spec.labels,
+            "inFlight": self.in_flight,
+            "latency": self.latency.stats(),
+            "warmupMs": self.warmup_ms,
+            "loadedAt": self.loaded_at,
+            "batcher": self.batcher.stats(),
+        }
+
+
+class Experiment:
+    """A candidate model measured against the active one on live traffic.
+
+    In "ab" mode `percent` of queries (picked by a stable hash of the query
+    text, so a repeated query always gets the same model) are answered by
+    the candidate. In "shadow" mode every query is answered by the active
+    model and also sent to the candidate in the background; the candidate's
+    answer is only compared, never returned.
+    """
+
+    MODES = ("ab", "shadow")
+
+    def __init__(self, candidate: ServedModel, mode: str = "shadow", percent: float = 100.0, max_shadow_in_flight: int = 64):
+        if mode not in self.MODES:
+            raise ValueError(f"mode must be one of {self.MODES}")
+        self.candidate = candidate
+        self.mode = mode
+        self.percent = max(0.0, min(100.0, percent))
+        self.max_shadow_in_flight = max_shadow_in_flight
+        self.started_at = time.time()
+        self.shadow_in_flight = 0
+        self.shadow_dropped = 0
+        self.shadow_errors = 0
+        self.compared = 0
+        self.top_agree = 0
+        self.set_agree = 0
+        self._tasks: set = set()
+
+    def routes_to_candidate(self, key: str) -> bool:
+        return self.mode == "ab" and zlib.crc32(key.encode()) % 10000 < self.percent * 100
+
+    def compare(self, primary: ServedModel, primary_scores: List[float], candidate_scores: List[float]):
+        # By label name, since the two models may order their labels differently
+        self.compared += 1
+        if primary.top_intent(primary_scores) == self.candidate.top_intent(candidate_scores):
+            self.top_agree += 1
+        primary_set = {i["intent"] for i in primary.intents(primary_scores)}
+        candidate_set = {i["intent"] for i in self.candidate.intents(candidate_scores)}
+        if primary_set == candidate_set:
+            self.set_agree += 1
+
+    def shadow(self, primary: ServedModel, primary_scores: List[float], run: Callable[[], Awaitable[List[float]]]):
+        """Run the candidate off the request path; shed shadow load rather than queue it up."""
+        if self.shadow_in_flight >= self.max_shadow_in_flight:
+            self.shadow_dropped += 1
+            return
+
+        async def compare_later():
+            self.shadow_in_flight += 1
+            try:
+                self.compare(primary, primary_scores, await run())
+            except Exception:
+                self.shadow_errors += 1
+            finally:
+                self.shadow_in_flight -= 1
+
+        task = asyncio.create_task(compare_later())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def wait(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self, active: Optional[ServedModel] = None) -> dict:
+        compared = self.compared or 1
+        return {
+            "mode": self.mode,
+            "percent": self.percent if self.mode == "ab" else None,
+            "startedAt": self.started_at,
+            "candidate": self.candidate.stats(),
+            "activeLatency": active.latency.stats() if active else None,
+            "compared": self.compared,
+            "topIntentAgreement": self.top_agree / compared if self.compared else None,
+            "intentSetAgreement": self.set_agree / compared if self.compared else None,
+            "shadowInFlight": self.shadow_in_flight,
+            "shadowDropped": self.shadow_dropped,
+            "shadowErrors": self.shadow_errors,
+        }
+
+
+class ModelRegistry:
+    """Versioned intent models described by models.json, with atomic hot swap.
+
+    `activate(name)` loads and warms the model while the current one keeps
+    serving, then switches `active` in one assignment. The previous model
+    stays up until requests already submitted to it have finished (or
+    `drain_timeout` passes), so a swap drops no requests or sockets.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+        drain_timeout: float = 30.0,
+        on_swap: Optional[Callable[[ServedModel], None]] = None,
+    ):
+        self.path = path
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.drain_timeout = drain_timeout
+        self.on_swap = on_swap
+        self.active: Optional[ServedModel] = None
+        self.experiment: Optional[Experiment] = None
+        self._retiring: set = set()
+        self._swap_lock = asyncio.Lock()
+        self.swaps = 0
+        self.last_swap: Optional[dict] = None
+
+    def specs(self) -> dict:
+        # Re-read on every use so models added to the file can be activated without a restart
+        return read_registry(self.path)
+
+    async def load(self, name: str) -> ServedModel:
+        registry = self.specs()
+        if name not in registry["models"]:
+            raise KeyError(f"Unknown model {name!r}")
+        spec = registry["models"][name]
+        # INFERENCE_WORKERS > 0 runs forward passes in pinned worker processes instead of this one
+        pool = create_inference_pool(spec.path, spec.backend)
+        if pool:
+            await pool.start()
+            backend = pool.backend_for(spec.path)
+        else:
+            backend = await asyncio.to_thread(load_intent_backend, spec.path, spec.backend)
+        model = ServedModel(spec, backend, pool, self.max_batch_size, self.max_wait_ms)
+        try:
+            await asyncio.to_thread(model.warm_up, registry["warmup"])
+            await model.batcher.start()
+        except Exception:
+            await model.close()
+            raise
+        return model
+
+    async def activate(self, name: Optional[str] = None) -> ServedModel:
+        """Load `name` (default: INTENT_MODEL, then models.json "active") and cut traffic over to it."""
+        name = name or os.getenv("INTENT_MODEL") or self.specs()["active"]
+        async with self._swap_lock:
+            started = time.perf_counter()
+            model = await self.load(name)
+            self._cut_over(model, started)
+        return model
+
+    def _cut_over(self, model: ServedModel, started: float):
+        previous, self.active = self.active, model
+        if self.on_swap:
+            self.on_swap(model)
+        self.swaps += 1
+        self.last_swap = {
+            "from": previous.version if previous else None,
+            "to": model.version,
+            "seconds": round(time.perf_counter() - started, 3),
+            "at": time.time(),
+        }
+        if previous:
+            self._retire_later(previous)
+
+    def _retire_later(self, model: ServedModel):
+        task = asyncio.create_task(self._retire(model), name=f"retire:{model.name}")
+        self._retiring.add(task)
+        task.add_done_callback(self._retiring.discard)
+
+    async def _retire(self, model: ServedModel):
+        if not await model.drain(self.drain_timeout):
+            print(f"Warning: {model.in_flight} requests still on {model.version} after {self.drain_timeout:.0f}s; closing it")
+        await model.close()
+
+    def route(self, key: str) -> ServedModel:
+        """The model that answers query `key`: the active one, or the A/B candidate for its share."""
+        experiment = self.experiment
+        if experiment and experiment.routes_to_candidate(key):
+            return experiment.candidate
+        return self.active
+
+    async def start_experiment(self, name: str, mode: str = "shadow", percent: float = 100.0) -> Experiment:
+        if mode not in Experiment.MODES:
+            raise ValueError(f"mode must be one of {Experiment.MODES}")
+        async with self._swap_lock:
+            candidate = await self.load(name)
+            previous, self.experiment = self.experiment, Experiment(candidate, mode, percent)
+        if previous:
+            self._retire_later(previous.candidate)
+        return self.experiment
+
+    async def stop_experiment(self) -> Optional[Experiment]:
+        experiment, self.experiment = self.experiment, None
+        if experiment:
+            self._retire_later(experiment.candidate)
+        return experiment
+
+    async def promote(self) -> ServedModel:
+        """Make the experiment's candidate the active model; it is already loaded and warm."""
+        async with self._swap_lock:
+            experiment, self.experiment = self.experiment, None
+            if experiment is None:
+                raise LookupError("No experiment running")
+            self._cut_over(experiment.candidate, time.perf_counter())
+        return experiment.candidate
+
+    async def close(self):
+        await asyncio.gather(*self._retiring, return_exceptions=True)
+        if self.experiment:
+            await self.experiment.wait()
+            await self.experiment.candidate.close()
+        if self.active:
+            await self.active.close()
+
+    def stats(self) -> dict:
+        registry = self.specs()
+        return {
+            "active": self.active.stats() if self.active else None,
+            "available": {
+                name: {"path": spec.path, "backend": spec.backend, "threshold": spec.threshold, "labels": spec.labels}
+                for name, spec in registry["models"].items()
+            },
+            "experiment": self.experiment.stats(self.active) if self.experiment else None,
+            "retiring": len(self._retiring),
+            "swaps": self.swaps,
+            "lastSwap": self.last_swap,
+        }
+
+
+def create_model_registry(on_swap: Optional[Callable[[ServedModel], None]] = None) -> ModelRegistry:
+    return ModelRegistry(
+        max_batch_size=int(os.getenv("INTENT_BATCH_SIZE", "16")),
+        max_wait_ms=float(os.getenv("INTENT_BATCH_WAIT_MS", "5")),
+        drain_timeout=float(os.getenv("MODEL_DRAIN_SECONDS", "30")),
+        on_swap=on_swap,
+    )
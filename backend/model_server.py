@@ -0,0 +1,452 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Connection, Pipe
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from intent_backends import IntentBackend, resolve_model_dir
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+class WorkerUnavailable(RuntimeError):
+    pass
+
+
+class InferenceWorker:
+    """One model process, pinned to its own CPUs, driven over a pipe.
+
+    The process runs only `forward`: the web process tokenizes and sends
+    the int64 input arrays, and gets the logits back. Started as a fresh
+    interpreter (not forked) so it never inherits the web worker's
+    threads, event loop or Mongo client.
+    """
+
+    def __init__(self, variant: str, model_dir: Path, backend: str, index: int, cpus: List[int], threads: int):
+        self.variant = variant
+        self.model_dir = model_dir
+        self.backend = backend
+        self.index = index
+        self.cpus = cpus
+        self.threads = threads
+        self.process: Optional[subprocess.Popen] = None
+        self.conn: Optional[Connection] = None
+        self.version: Optional[str] = None
+        self.healthy = False
+        self.restarts = 0
+        self.requests = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        # Checked out by one request thread (or the health check) at a time
+        self.in_use = False
+
+    @property
+    def name(self) -> str:
+        return f"{self.variant}#{self.index}"
+
+    def spawn(self):
+        parent, child = Pipe()
+        env = dict(os.environ)
+        threads = str(self.threads)
+        env.update(OMP_NUM_THREADS=threads, TORCH_NUM_THREADS=threads, ORT_INTRA_OP_THREADS=threads, ORT_INTER_OP_THREADS="1")
+        self.process = subprocess.Popen(
+            [
+                sys.executable, str(Path(__file__).resolve()),
+                "--fd", str(child.fileno()),
+                "--model", str(self.model_dir),
+                "--backend", self.backend,
+                "--cpus", ",".join(map(str, self.cpus)),
+            ],
+            pass_fds=(child.fileno(),),
+            env=env,
+        )
+        child.close()
+        self.conn = parent
+
+    def wait_ready(self, timeout: float):
+        if not self.conn.poll(timeout):
+            self.kill()
+            raise WorkerUnavailable(f"{self.name} did not load within {timeout:.0f}s")
+        status, payload = self.conn.recv()
+        if status != "ready":
+            self.kill()
+            raise WorkerUnavailable(f"{self.name} failed to load: {payload}")
+        self.version = payload
+        self.healthy = True
+
+    def kill(self):
+        self.healthy = False
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def alive(self) -> bool:
+        return self.healthy and self.process is not None and self.process.poll() is None
+
+    def call(self, op: str, payload=None, timeout: float = 30.0):
+        if not self.alive():
+            raise WorkerUnavailable(f"{self.name} is down")
+        started = time.perf_counter()
+        try:
+            self.conn.send((op, payload))
+            if not self.conn.poll(timeout):
+                raise TimeoutError(f"{self.name} did not answer {op} within {timeout:.0f}s")
+            status, result = self.conn.recv()
+        except (EOFError, OSError, TimeoutError) as e:
+            # Crashed or hung; the health check restarts it
+            self.failures += 1
+            self.kill()
+            raise WorkerUnavailable(str(e)) from e
+        finally:
+            self.busy_seconds += time.perf_counter() - started
+        self.requests += 1
+        if status != "ok":
+            raise RuntimeError(f"{self.name}: {result}")
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "pid": self.process.pid if self.process else None,
+            "healthy": self.alive(),
+            "cpus": self.cpus,
+            "threads": self.threads,
+            "version": self.version,
+            "requests": self.requests,
+            "failures": self.failures,
+            "restarts": self.restarts,
+            "busySeconds": round(self.busy_seconds, 3),
+        }
+
+
+class PooledIntentBackend(IntentBackend):
+    """IntentBackend whose forward pass runs on a group of worker processes.
+
+    Tokenization and postprocessing stay in the web process (both are
+    cheap and release the GIL or are numpy); each batch goes to whichever
+    worker is idle, so `workers` batches can run in parallel.
+    """
+
+    def __init__(self, model_dir, backend: str, workers: List[InferenceWorker], request_timeout: float = 30.0):
+        super().__init__(model_dir)
+        self.name = backend
+        self.workers = workers
+        self.request_timeout = request_timeout
+        self._available = threading.Condition()
+
+    @property
+    def version(self) -> str:
+        # Reported by the workers once loaded (the runtime may differ from the requested one)
+        loaded = next((w.version for w in self.workers if w.version), None)
+        return loaded or super().version
+
+    def acquire(self, timeout: Optional[float] = None) -> Optional[InferenceWorker]:
+        """Check out the least-used healthy idle worker, waiting up to `timeout` (None = don't wait)."""
+        deadline = time.monotonic() + (timeout or 0.0)
+        with self._available:
+            while True:
+                idle = [w for w in self.workers if w.alive() and not w.in_use]
+                if idle:
+                    worker = min(idle, key=lambda w: w.requests)
+                    worker.in_use = True
+                    return worker
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._available.wait(remaining)
+
+    def release(self, worker: InferenceWorker):
+        with self._available:
+            worker.in_use = False
+            self._available.notify()
+
+    def forward(self, encoded):
+        for attempt in range(2):
+            worker = self.acquire(self.request_timeout)
+            if worker is None:
+                raise WorkerUnavailable(f"no healthy {self.model_dir.name} worker available")
+            try:
+                return worker.call("forward", encoded, timeout=self.request_timeout)
+            except WorkerUnavailable:
+                # That worker died under us; retry once on another
+                if attempt:
+                    raise
+            finally:
+                self.release(worker)
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "idle": sum(1 for w in self.workers if w.alive() and not w.in_use),
+            "workers": {w.name: w.stats() for w in self.workers},
+        }
+
+
+CPU_CLAIMS_PATH = Path(os.getenv("INFERENCE_CPU_CLAIMS_PATH", os.path.join(tempfile.gettempdir(), "inference-cpus.json")))
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _update_cpu_claims(update: Callable[[Dict[str, List[int]]], None]):
+    """Apply `update` to the cores claimed per pid, under a lock shared by every process on the host."""
+    import fcntl
+
+    with open(CPU_CLAIMS_PATH, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            claims = json.loads(f.read() or "{}")
+        except ValueError:
+            claims = {}
+        # Claims of exited processes are free again
+        claims = {pid: cpus for pid, cpus in claims.items() if _pid_alive(int(pid))}
+        update(claims)
+        f.seek(0)
+        f.truncate()
+        json.dump(claims, f)
+
+
+def _claim_cpus(count: int, threads: Optional[int]) -> Tuple[int, List[List[int]]]:
+    """Disjoint core sets for `count` workers, none shared with another pool on this host.
+
+    Every pool (one per served model, in every web worker) claims its cores
+    from the same file, so pools never pin onto each other's cores. Without
+    a thread count the workers split the cores still free. When too few are
+    free the workers run unpinned: empty sets.
+    """
+    available = sorted(os.sched_getaffinity(0))
+    result: Tuple[int, List[List[int]]] = (threads or max(1, len(available) // count), [[] for _ in range(count)])
+
+    def claim(claims: Dict[str, List[int]]):
+        nonlocal result
+        taken = {cpu for cpus in claims.values() for cpu in cpus}
+        free = [cpu for cpu in available if cpu not in taken]
+        per_worker = threads or len(free) // count
+        if per_worker < 1 or per_worker * count > len(free):
+            return
+        sets = [free[i * per_worker:(i + 1) * per_worker] for i in range(count)]
+        mine = str(os.getpid())
+        claims[mine] = claims.get(mine, []) + [cpu for cpus in sets for cpu in cpus]
+        result = (per_worker, sets)
+
+    _update_cpu_claims(claim)
+    return result
+
+
+def _release_cpus(cpus: List[int]):
+    def release(claims: Dict[str, List[int]]):
+        mine = str(os.getpid())
+        left = [cpu for cpu in claims.get(mine, []) if cpu not in cpus]
+        if left:
+            claims[mine] = left
+        else:
+            claims.pop(mine, None)
+
+    _update_cpu_claims(release)
+
+
+class InferencePool:
+    """Worker processes for one or more model variants, served side by side.
+
+    Each variant gets `workers_per_variant` processes. A health check
+    pings idle workers and respawns any that exited, hung or stopped
+    answering.
+    """
+
+    def __init__(
+        self,
+        variants: List[str],
+        backend: str = "torch",
+        workers_per_variant: int = 1,
+        threads_per_worker: Optional[int] = None,
+        pin_cpus: bool = True,
+        health_interval: float = 10.0,
+        load_timeout: float = 300.0,
+        request_timeout: float = 30.0,
+    ):
+        self.backend = backend
+        self.workers_per_variant = workers_per_variant
+        self.health_interval = health_interval
+        self.load_timeout = load_timeout
+        total = workers_per_variant * len(variants)
+        self.pinned: List[int] = []
+        if pin_cpus and hasattr(os, "sched_getaffinity"):
+            self.threads_per_worker, sets = _claim_cpus(total, threads_per_worker)
+            self.pinned = [cpu for cpus in sets for cpu in cpus]
+            if not self.pinned:
+                print("Warning: not enough free cores to pin inference workers; running them unpinned")
+        else:
+            cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+            self.threads_per_worker = threads_per_worker or max(1, cpu_count // total)
+            sets = [[] for _ in range(total)]
+        cpu_sets = iter(sets)
+        self.variants: Dict[str, PooledIntentBackend] = {}
+        for variant in variants:
+            model_dir = resolve_model_dir(variant)
+            workers = [
+                InferenceWorker(variant, model_dir, backend, i, next(cpu_sets), self.threads_per_worker)
+                for i in range(workers_per_variant)
+            ]
+            self.variants[variant] = PooledIntentBackend(model_dir, backend, workers, request_timeout)
+        self._health_task = None
+
+    def backend_for(self, variant: str) -> PooledIntentBackend:
+        return self.variants[variant]
+
+    def _all_workers(self):
+        for pooled in self.variants.values():
+            for worker in pooled.workers:
+                yield pooled, worker
+
+    def start_sync(self):
+        # Spawn everything first so the models load in parallel
+        for _, worker in self._all_workers():
+            worker.spawn()
+        for pooled, worker in self._all_workers():
+            try:
+                worker.wait_ready(self.load_timeout)
+            except WorkerUnavailable as e:
+                # The health check keeps retrying it
+                print(f"Warning: {e}")
+                continue
+            pooled.release(worker)
+
+    def _check_worker(self, pooled: PooledIntentBackend, worker: InferenceWorker):
+        with pooled._available:
+            if worker.in_use:
+                return  # serving a batch right now; a failure there marks it down
+            worker.in_use = True
+        try:
+            if worker.alive():
+                try:
+                    worker.call("ping", timeout=5.0)
+                    return
+                except WorkerUnavailable:
+                    pass
+            print(f"Warning: inference worker {worker.name} is down; restarting")
+            worker.kill()
+            worker.restarts += 1
+            worker.spawn()
+            worker.wait_ready(self.load_timeout)
+        except WorkerUnavailable as e:
+            print(f"Warning: {e}")
+        finally:
+            pooled.release(worker)
+
+    def check_health(self):
+        for pooled, worker in self._all_workers():
+            self._check_worker(pooled, worker)
+
+    async def _health_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                await loop.run_in_executor(None, self.check_health)
+            except Exception as e:
+                print(f"Warning: inference health check failed: {e}")
+
+    async def start(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.start_sync)
+        self._health_task = asyncio.create_task(self._health_loop(), name="inference-health")
+
+    async def stop(self):
+        if self._health_task:
+            self._health_task.cancel()
+        for _, worker in self._all_workers():
+            worker.kill()
+        if self.pinned:
+            _release_cpus(self.pinned)
+            self.pinned = []
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "workersPerVariant": self.workers_per_variant,
+            "threadsPerWorker": self.threads_per_worker,
+            "pinnedCpus": self.pinned,
+            "variants": {name: pooled.stats() for name, pooled in self.variants.items()},
+        }
+
+
+def create_inference_pool(model_dir: str, backend: Optional[str] = None) -> Optional[InferencePool]:
+    """Pool configured by INFERENCE_WORKERS (0 = run the model in-process)."""
+    workers = int(os.getenv("INFERENCE_WORKERS", "0"))
+    if workers <= 0:
+        return None
+    if not hasattr(os, "fork"):
+        print("Warning: INFERENCE_WORKERS needs a POSIX host; running the model in-process")
+        return None
+    threads = os.getenv("INFERENCE_THREADS_PER_WORKER")
+    return InferencePool(
+        [model_dir],
+        backend=(backend or os.getenv("INTENT_BACKEND", "torch")).lower(),
+        workers_per_variant=workers,
+        threads_per_worker=int(threads) if threads else None,
+        pin_cpus=os.getenv("INFERENCE_PIN_CPUS", "1") == "1",
+        health_interval=float(os.getenv("INFERENCE_HEALTH_SECONDS", "10")),
+        request_timeout=float(os.getenv("INFERENCE_TIMEOUT_SECONDS", "30")),
+    )
+
+
+def serve(conn: Connection, model_dir: str, backend: str, cpus: List[int]):
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    from intent_backends import load_intent_backend
+
+    try:
+        model = load_intent_backend(model_dir, backend)
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", model.version))
+    while True:
+        try:
+            op, payload = conn.recv()
+        except EOFError:
+            return  # the web process went away
+        try:
+            if op == "forward":
+                result = model.forward(payload)
+            elif op == "ping":
+                result = "pong"
+            else:
+                raise ValueError(f"unknown op {op!r}")
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+        else:
+            conn.send(("ok", result))
+
+
+if __name__ == "__main__":
+    # Started by InferenceWorker.spawn; not meant to be run by hand
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fd", type=int, required=True)
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--backend", default="torch")
+    parser.add_argument("--cpus", default="")
+    args = parser.parse_args()
+    sys.path.insert(0, str(BASE_DIR))
+    serve(
+        Connection(args.fd),
+        args.model,
+        args.backend,
+        [int(c) for c in args.cpus.split(",") if c],
+    )
@@ -6,10 +6,9 @@ import os
 from typing import List, Optional,Dict
 from datetime import datetime
 from pydantic import ValidationError
-import onnxruntime as ort
-from transformers import DistilBertTokenizer
 import numpy as np
-from pathlib import Path
+from intent_backends import load_intent_backend
+from model_registry import read_registry
 
 
 app = FastAPI()
@@ -27,8 +26,6 @@ app.add_middleware(
 client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017"))
 db = client["chatwidget"]
 
-# Load the fine-tuned model and tokenizer
-from transformers import pipeline
 # # Define paths using absolute paths to avoid resolution issues
 # BASE_DIR = Path(__file__).resolve().parent
 # MODEL_PATH = BASE_DIR / "onnx_intent_model" / "model.onnx"
@@ -52,7 +49,9 @@ from transformers import pipeline
 # except Exception as e:
 #     raise RuntimeError(f"Failed to load tokenizer from {TOKENIZER_PATH}: {str(e)}")
 
-intent_map = {0: "search_product", 1: "order_item", 2: "access_issue"}
+# Label map and path come from models.json, shared with main.py
+intent_spec = read_registry()["models"]["fine_tuned_model"]
+intent_map = intent_spec.labels
 
 # Define request body model
 class TextInput(BaseModel):
@@ -75,11 +74,8 @@ class TextInput(BaseModel):
 #         return {"intent": predicted_intent}
 #     except Exception as e:
 #         return {"error": f"Prediction failed: {str(e)}"}
-classifier = pipeline(
-    "text-classification",
-    model="./fine_tuned_model",
-    tokenizer="distilbert-base-uncased"
-)
+# INTENT_BACKEND=onnx exports fine_tuned_model to onnx_cache/ (fp32; INT8 with INTENT_BACKEND=onnx-int8 or INTENT_QUANTIZE=1)
+intent_backend = load_intent_backend(intent_spec.path, os.getenv("INTENT_BACKEND") or intent_spec.backend)
 
 # Define a request model for the input text
 class TextInput(BaseModel):
@@ -92,9 +88,10 @@ connected_agents: Dict[str, WebSocket] = {}  # agentId -> WebSocket
 # Define a POST endpoint for intent classification
 @app.post("/classify-intent")
 async def classify_intent(input: TextInput):
-    result = classifier(input.text)
-    intent = result[0]["label"]  # Extract the predicted intent label
-    confidence = result[0]["score"]  # Extract the confidence score
+    scores = intent_backend.predict([input.text])[0]
+    best = int(np.argmax(scores))
+    intent = intent_map[best]  # Extract the predicted intent label
+    confidence = scores[best]  # Extract the confidence score
     return {"intent": intent, "confidence": confidence}
 
 # Agent Endpoints
@@ -0,0 +1,343 @@
+import os
+from datetime import datetime
+from typing import List, Optional
+
+from pymongo import ReadPreference, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+
+def create_client(uri: Optional[str] = None):
+    """Async Mongo client with explicit pool sizing and timeouts.
+
+    MONGO_MOCK=1 swaps in mongomock_motor so the app can run without a mongod.
+    """
+    if os.getenv("MONGO_MOCK") == "1":
+        from mongomock_motor import AsyncMongoMockClient
+
+        return AsyncMongoMockClient()
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    listeners = []
+    if os.getenv("METRICS_ENABLED", "1") == "1":
+        from metrics import mongo_listener
+
+        listeners.append(mongo_listener())
+    if os.getenv("TRACE_EXPORTER", "none") != "none":
+        from tracing import mongo_listener as mongo_trace_listener
+
+        listeners.append(mongo_trace_listener())
+    return AsyncIOMotorClient(
+        uri or os.getenv("MONGO_URI", "mongodb://localhost:27017"),
+        maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+        minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", "5")),
+        maxIdleTimeMS=int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000")),
+        waitQueueTimeoutMS=int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000")),
+        serverSelectionTimeoutMS=int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "3000")),
+        connectTimeoutMS=int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "3000")),
+        socketTimeoutMS=int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "5000")),
+        retryWrites=True,
+        event_listeners=listeners,
+    )
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+def _collection(db, name: str, read_preference: Optional[str] = None):
+    if read_preference:
+        return db.get_collection(name, read_preference=READ_PREFERENCES[read_preference])
+    return db[name]
+
+
+class AgentRepository:
+    def __init__(self, db, read_preference: Optional[str] = None):
+        self.collection = _collection(db, "agents", read_preference)
+
+    async def upsert(self, agent: dict):
+        await self.collection.update_one(
+            {"websiteId": agent["websiteId"], "intent": agent["intent"]},
+            {"$set": {**agent, "updatedAt": _now()}},
+            upsert=True,
+        )
+
+    async def find(self, websiteId: str, intent: Optional[str] = None) -> List[dict]:
+        query = {"websiteId": websiteId}
+        if intent:
+            query["intent"] = intent
+        return await self.collection.find(query, {"_id": 0}).to_list(length=None)
+
+
+class ChainRepository:
+    def __init__(self, db, read_preference: Optional[str] = None):
+        self.collection = _collection(db, "chains", read_preference)
+
+    async def upsert(self, chain: dict):
+        await self.collection.update_one(
+            {"websiteId": chain["websiteId"], "chainId": chain["chainId"]},
+            {"$set": {**chain, "updatedAt": _now()}},
+            upsert=True,
+        )
+
+    async def find(self, websiteId: str) -> List[dict]:
+        return await self.collection.find({"websiteId": websiteId}, {"_id": 0}).to_list(length=None)
+
+
+class HumanAgentRepository:
+    def __init__(self, db, read_preference: Optional[str] = None):
+        self.collection = _collection(db, "humanAgents", read_preference)
+
+    async def upsert(self, agent: dict):
+        await self.collection.update_one(
+            {"websiteId": agent["websiteId"], "agentId": agent["agentId"]},
+            {"$set": agent},
+            upsert=True,
+        )
+
+    async def find(self, websiteId: str, agentId: Optional[str] = None) -> List[dict]:
+        query = {"websiteId": websiteId}
+        if agentId:
+            query["agentId"] = agentId
+        return await self.collection.find(query, {"_id": 0}).to_list(length=None)
+
+    async def find_online(self, websiteId: str) -> List[dict]:
+        return await self.collection.find(
+            {"websiteId": websiteId, "status": "online"}, {"_id": 0}
+        ).to_list(length=None)
+
+    async def find_by_id(self, agentId: str) -> Optional[dict]:
+        return await self.collection.find_one({"agentId": agentId}, {"_id": 0})
+
+    async def find_all_online(self) -> List[dict]:
+        return await self.collection.find({"status": "online"}, {"_id": 0}).to_list(length=None)
+
+    async def set_status(self, agentId: str, status: str):
+        await self.collection.update_one(
+            {"agentId": agentId},
+            {"$set": {"status": status, "lastActive": _now()}},
+        )
+
+    async def write_presence(self, updates: List[tuple]):
+        """Bulk presence writes: [(agentId, status or None, stale_before or None, lastActive or None), ...].
+
+        With `stale_before` the update is only applied if lastActive is older
+        than that (nobody has seen the agent since).
+        """
+        ops = []
+        for agentId, status, stale_before, last_active in updates:
+            query = {"agentId": agentId}
+            update = {}
+            if stale_before:
+                query["lastActive"] = {"$not": {"$gte": stale_before}}
+            if status:
+                update["status"] = status
+            if last_active:
+                update["lastActive"] = last_active
+            if update:
+                ops.append(UpdateOne(query, {"$set": update}))
+        if ops:
+            await self.collection.bulk_write(ops, ordered=False)
+
+
+class WidgetSettingsRepository:
+    def __init__(self, db, read_preference: Optional[str] = None):
+        self.collection = _collection(db, "widgetSettings", read_preference)
+
+    async def get_or_create(self, clientId: str, default_settings: dict) -> dict:
+        # Single round-trip: insert the defaults only if no document exists yet
+        return await self.collection.find_one_and_update(
+            {"clientId": clientId},
+            {"$setOnInsert": {"clientId": clientId, "widgetSettings": default_settings, "updatedAt": _now()}},
+            projection={"_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def upsert(self, clientId: str, settings: dict):
+        await self.collection.update_one(
+            {"clientId": clientId},
+            {"$set": {"clientId": clientId, "widgetSettings": settings, "updatedAt": _now()}},
+            upsert=True,
+        )
+
+
+# Messages live in fixed-size buckets in `chat_messages`, one document per
+# (sessionId, bucket), so appends never rewrite an ever-growing session document.
+MESSAGE_BUCKET_SIZE = int(os.getenv("CHAT_MESSAGE_BUCKET_SIZE", "100"))
+
+
+class ChatMessageRepository:
+    def __init__(self, db, bucket_size: int = MESSAGE_BUCKET_SIZE):
+        self.collection = db["chat_messages"]
+        self.bucket_size = bucket_size
+
+    def bucket_ops(self, sessionId: str, first_seq: int, messages: List[dict]) -> List[tuple]:
+        """(filter, update) pairs that push `messages`, numbered from `first_seq`, into their buckets.
+
+        Each pair only applies if its first seq isn't in the bucket yet, so
+        replaying a write is a no-op (the upsert then hits the unique
+        sessionId/bucket index; callers treat a repeated duplicate key as done).
+        """
+        by_bucket = {}
+        for offset, message in enumerate(messages):
+            seq = first_seq + offset
+            by_bucket.setdefault(seq // self.bucket_size, []).append({**message, "seq": seq})
+        ops = []
+        for bucket, items in by_bucket.items():
+            ops.append((
+                {"sessionId": sessionId, "bucket": bucket, "messages.seq": {"$ne": items[0]["seq"]}},
+                {
+                    "$push": {"messages": {"$each": items}},
+                    "$inc": {"count": len(items)},
+                    "$min": {"firstSeq": items[0]["seq"]},
+                    "$max": {"lastSeq": items[-1]["seq"]},
+                },
+            ))
+        return ops
+
+    async def append(self, sessionId: str, first_seq: int, messages: List[dict]):
+        for query, update in self.bucket_ops(sessionId, first_seq, messages):
+            try:
+                await self.collection.update_one(query, update, upsert=True)
+            except DuplicateKeyError:
+                # Either a concurrent upsert created the bucket (retry pushes into it) or it's already there
+                try:
+                    await self.collection.update_one(query, update, upsert=True)
+                except DuplicateKeyError:
+                    pass
+
+    async def append_many(self, writes: List[tuple]):
+        """Bulk-append several sessions' messages: [(sessionId, first_seq, messages), ...]."""
+        ops = [
+            UpdateOne(query, update, upsert=True)
+            for sessionId, first_seq, messages in writes
+            for query, update in self.bucket_ops(sessionId, first_seq, messages)
+        ]
+        for attempt in range(2):
+            if not ops:
+                return
+            try:
+                await self.collection.bulk_write(ops, ordered=False)
+                return
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                if any(error.get("code") != 11000 for error in errors) or e.details.get("writeConcernErrors"):
+                    raise
+                # Duplicate keys: retry once (a concurrent upsert created the bucket); a second one means already written
+                ops = [ops[error["index"]] for error in errors]
+
+    async def history(self, sessionId: str, before: Optional[int] = None, limit: int = 50) -> dict:
+        """Newest `limit` messages with seq < `before`, oldest first, plus the cursor for the previous page."""
+        query = {"sessionId": sessionId}
+        if before is not None:
+            if before <= 0:
+                return {"messages": [], "nextCursor": None}
+            query["bucket"] = {"$lte": (before - 1) // self.bucket_size}
+        collected = []
+        cursor = self.collection.find(query, {"_id": 0, "messages": 1}).sort("bucket", -1)
+        async for bucket in cursor:
+            for message in reversed(bucket["messages"]):
+                if before is None or message["seq"] < before:
+                    collected.append(message)
+                    if len(collected) >= limit:
+                        break
+            if len(collected) >= limit:
+                break
+        collected.reverse()
+        next_cursor = collected[0]["seq"] if collected and collected[0]["seq"] > 0 else None
+        return {"messages": collected, "nextCursor": next_cursor}
+
+
+SESSION_SUMMARY_PROJECTION = {"_id": 0, "messages": 0}
+
+
+class ChatSessionRepository:
+    def __init__(self, db, messages: ChatMessageRepository, read_preference: Optional[str] = None):
+        self.collection = _collection(db, "chat_sessions", read_preference)
+        self.messages = messages
+
+    async def create(self, session: dict):
+        initial_messages = session.pop("messages", None) or []
+        session["createdAt"] = _now()
+        session["updatedAt"] = session["createdAt"]
+        session["messageCount"] = len(initial_messages)
+        session["lastMessage"] = initial_messages[-1] if initial_messages else None
+        await self.collection.insert_one(session)
+        if initial_messages:
+            await self.messages.append(session["sessionId"], 0, initial_messages)
+
+    async def find(self, sessionId: str) -> Optional[dict]:
+        return await self.collection.find_one({"sessionId": sessionId}, SESSION_SUMMARY_PROJECTION)
+
+    async def assigned_agent(self, sessionId: str) -> Optional[str]:
+        session = await self.collection.find_one({"sessionId": sessionId}, {"_id": 0, "agentId": 1})
+        return session.get("agentId") if session else None
+
+    async def list_for_agent(self, agentId: str, clientId: str) -> List[dict]:
+        return await self.collection.find(
+            {"agentId": agentId, "clientId": clientId}, SESSION_SUMMARY_PROJECTION
+        ).to_list(length=None)
+
+    async def reserve_seq(self, sessionId: str, count: int, last_message: dict) -> Optional[int]:
+        """Bump the session's summary fields and return the first seq reserved for `count` new messages."""
+        session = await self.collection.find_one_and_update(
+            {"sessionId": sessionId},
+            {"$inc": {"messageCount": count}, "$set": {"lastMessage": last_message, "updatedAt": _now()}},
+            projection={"_id": 0, "messageCount": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        if session is None:
+            return None
+        return session["messageCount"] - count
+
+    async def append_message(self, sessionId: str, message: dict):
+        first_seq = await self.reserve_seq(sessionId, 1, message)
+        if first_seq is not None:
+            await self.messages.append(sessionId, first_seq, [message])
+
+    async def open_assignments(self, agentIds: List[str]) -> List[dict]:
+        """sessionId/agentId of every active session held by one of `agentIds`."""
+        return await self.collection.find(
+            {"agentId": {"$in": agentIds}, "status": "active"}, {"_id": 0, "sessionId": 1, "agentId": 1}
+        ).to_list(length=None)
+
+    async def assign_agent(self, sessionId: str, agentId: str):
+        await self.collection.update_one(
+            {"sessionId": sessionId},
+            {"$set": {"agentId": agentId, "status": "active", "updatedAt": _now()}},
+        )
+
+    async def close(self, sessionId: str):
+        await self.collection.update_one(
+            {"sessionId": sessionId},
+            {"$set": {"status": "closed", "agentId": None, "updatedAt": _now()}},
+        )
+
+
+class Repositories:
+    """All collection repositories over one shared client/pool."""
+
+    def __init__(self, client=None, db_name: Optional[str] = None):
+        self.client = client or create_client()
+        self.db = self.client[db_name or os.getenv("MONGO_DB", "chatwidget")]
+        # Widget configuration is read-mostly and tolerates slightly stale reads;
+        # MONGO_CONFIG_READ_PREFERENCE=secondaryPreferred offloads it from the primary
+        config_reads = os.getenv("MONGO_CONFIG_READ_PREFERENCE")
+        self.agents = AgentRepository(self.db, config_reads)
+        self.chains = ChainRepository(self.db, config_reads)
+        self.widget_settings = WidgetSettingsRepository(self.db, config_reads)
+        self.human_agents = HumanAgentRepository(self.db)
+        self.chat_messages = ChatMessageRepository(self.db)
+        self.chat_sessions = ChatSessionRepository(self.db, self.chat_messages)
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,276 @@
+import asyncio
+import heapq
+import itertools
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+STRATEGIES = ("least_loaded", "weighted_round_robin")
+
+
+class RoutedAgent:
+    """Routing view of one human agent: who they are, what they handle and how busy they are."""
+
+    __slots__ = ("agentId", "websiteId", "name", "capacity", "skills", "weight", "online", "sessions", "version", "vpass")
+
+    def __init__(self, agentId: str, websiteId: str):
+        self.agentId = agentId
+        self.websiteId = websiteId
+        self.name = agentId
+        self.capacity = 1
+        self.skills: Set[str] = set()
+        self.weight = 1.0
+        self.online = False
+        self.sessions: Set[str] = set()
+        # Bumped on every change; heap entries carrying an older version are stale
+        self.version = 0
+        # Weighted round-robin: virtual time of this agent's next turn
+        self.vpass = 0.0
+
+    @property
+    def load(self) -> int:
+        return len(self.sessions)
+
+    @property
+    def available(self) -> bool:
+        return self.online and self.load < self.capacity
+
+    def to_dict(self) -> dict:
+        return {
+            "agentId": self.agentId,
+            "websiteId": self.websiteId,
+            "name": self.name,
+            "online": self.online,
+            "load": self.load,
+            "capacity": self.capacity,
+            "skills": sorted(self.skills),
+            "weight": self.weight,
+        }
+
+
+class RoutingEngine:
+    """In-memory assignment of chat sessions to online human agents.
+
+    Available agents of a websiteId sit in a heap per skill (plus one for
+    "any skill"), keyed by load/capacity for "least_loaded" or by virtual
+    time for "weighted_round_robin" (stride scheduling: an agent with
+    weight 2 gets every other turn), so picking one is O(log n). Changes
+    push a fresh entry and leave the old one to be skipped when it surfaces.
+
+    The engine is kept current by presence changes (see agent_presence.py)
+    and session assign/close, and reconciled from Mongo
+    every `sync_interval` seconds (which also converges several uvicorn
+    workers); assignment itself never queries Mongo.
+    """
+
+    def __init__(self, repos, strategy: str = "least_loaded", default_capacity: int = 5, sync_interval: float = 30.0):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown routing strategy {strategy!r}; expected one of {', '.join(STRATEGIES)}")
+        self.repos = repos
+        self.strategy = strategy
+        self.default_capacity = default_capacity
+        self.sync_interval = sync_interval
+        self.agents: Dict[str, RoutedAgent] = {}
+        self._heaps: Dict[Tuple[str, Optional[str]], list] = {}
+        self._session_agents: Dict[str, str] = {}
+        # While a sync awaits Mongo: sessions assigned (agentId) or released (None) since it started
+        self._changed_during_sync: Optional[Dict[str, Optional[str]]] = None
+        # Per websiteId, the virtual time of the last weighted round-robin turn
+        self._vtime: Dict[str, float] = {}
+        self._seq = itertools.count()
+        self._task = None
+        self.assigned = 0
+        self.unassigned = 0
+        self.syncs = 0
+
+    # Heaps
+
+    def _key(self, agent: RoutedAgent) -> tuple:
+        # The sequence number breaks ties in favour of whoever has waited longest
+        if self.strategy == "least_loaded":
+            return (agent.load / agent.capacity, agent.load, next(self._seq))
+        return (agent.vpass, next(self._seq))
+
+    def _push(self, agent: RoutedAgent):
+        agent.version += 1
+        if not agent.available:
+            return  # old entries are now stale; a later change pushes it back
+        entry = (*self._key(agent), agent.version, agent.agentId)
+        for skill in (None, *agent.skills):
+            heap = self._heaps.setdefault((agent.websiteId, skill), [])
+            heapq.heappush(heap, entry)
+            if len(heap) > 4 * len(self.agents) + 64:
+                self._compact(heap)
+
+    def _compact(self, heap: list):
+        heap[:] = [entry for entry in heap if self._current(entry)]
+        heapq.heapify(heap)
+
+    def _current(self, entry: tuple) -> Optional[RoutedAgent]:
+        agent = self.agents.get(entry[-1])
+        if agent is None or agent.version != entry[-2] or not agent.available:
+            return None
+        return agent
+
+    def _peek(self, websiteId: str, skill: Optional[str]) -> Optional[RoutedAgent]:
+        heap = self._heaps.get((websiteId, skill))
+        while heap:
+            agent = self._current(heap[0])
+            if agent is not None:
+                return agent
+            heapq.heappop(heap)
+        return None
+
+    # Updates
+
+    def upsert(self, doc: dict) -> RoutedAgent:
+        """Add or refresh an agent from its humanAgents document."""
+        agent = self.agents.get(doc["agentId"])
+        if agent is None or agent.websiteId != doc["websiteId"]:
+            if agent is not None:
+                agent.version += 1  # drop its entries under the old websiteId
+            sessions = agent.sessions if agent else set()
+            agent = self.agents[doc["agentId"]] = RoutedAgent(doc["agentId"], doc["websiteId"])
+            agent.sessions = sessions
+        agent.name = doc.get("name") or agent.agentId
+        agent.capacity = max(1, int(doc.get("capacity") or self.default_capacity))
+        agent.skills = set(doc.get("skills") or [])
+        agent.weight = max(0.01, float(doc.get("weight") or 1.0))
+        self._set_online(agent, doc.get("status") == "online")
+        return agent
+
+    def _set_online(self, agent: RoutedAgent, online: bool):
+        if online and not agent.online:
+            # Rejoin at the current turn rather than catching up on missed ones
+            agent.vpass = max(agent.vpass, self._vtime.get(agent.websiteId, 0.0))
+        agent.online = online
+        self._push(agent)
+
+    def set_status(self, agentId: str, status: str) -> bool:
+        """False if the agent is unknown here (load its document and upsert it instead)."""
+        agent = self.agents.get(agentId)
+        if agent is None:
+            return False
+        self._set_online(agent, status == "online")
+        return True
+
+    def assign(self, websiteId: str, session_id: str, skill: Optional[str] = None) -> Optional[RoutedAgent]:
+        """Pick an agent for the session (preferring `skill`) and count it against their capacity."""
+        current = self._session_agents.get(session_id)
+        if current in self.agents and self.agents[current].online:
+            return self.agents[current]
+        if current is not None:
+            # Their agent went offline: route the session again
+            self.release(session_id)
+        agent = (self._peek(websiteId, skill) if skill else None) or self._peek(websiteId, None)
+        if agent is None:
+            self.unassigned += 1
+            return None
+        self._session_agents[session_id] = agent.agentId
+        agent.sessions.add(session_id)
+        if self._changed_during_sync is not None:
+            self._changed_during_sync[session_id] = agent.agentId
+        if self.strategy == "weighted_round_robin":
+            self._vtime[websiteId] = agent.vpass
+            agent.vpass += 1.0 / agent.weight
+        self.assigned += 1
+        self._push(agent)
+        return agent
+
+    def release(self, session_id: str) -> Optional[RoutedAgent]:
+        agent = self.agents.get(self._session_agents.pop(session_id, None))
+        if self._changed_during_sync is not None:
+            self._changed_during_sync[session_id] = None
+        if agent is not None:
+            agent.sessions.discard(session_id)
+            self._push(agent)
+        return agent
+
+    # Views
+
+    def online(self, websiteId: str) -> List[RoutedAgent]:
+        return [a for a in self.agents.values() if a.websiteId == websiteId and a.online]
+
+    def stats(self) -> dict:
+        websites: Dict[str, dict] = {}
+        for agent in self.agents.values():
+            site = websites.setdefault(agent.websiteId, {"online": 0, "available": 0, "sessions": 0, "capacity": 0})
+            if agent.online:
+                site["online"] += 1
+                site["available"] += int(agent.available)
+                site["sessions"] += agent.load
+                site["capacity"] += agent.capacity
+        return {
+            "strategy": self.strategy,
+            "agents": len(self.agents),
+            "assigned": self.assigned,
+            "unassigned": self.unassigned,
+            "syncs": self.syncs,
+            "heapEntries": sum(len(h) for h in self._heaps.values()),
+            "websites": websites,
+        }
+
+    # Reconciliation
+
+    async def sync(self):
+        """Rebuild from Mongo: online agents and the active sessions they hold."""
+        # Assignments made while Mongo is read may not be written yet; they are reapplied below
+        self._changed_during_sync = changed = {}
+        try:
+            docs = await self.repos.human_agents.find_all_online()
+            assignments = await self.repos.chat_sessions.open_assignments([d["agentId"] for d in docs])
+        finally:
+            self._changed_during_sync = None
+        online = {d["agentId"] for d in docs}
+        for agent in self.agents.values():
+            if agent.agentId not in online:
+                agent.online = False
+            agent.sessions = set()
+        self._session_agents = {}
+        for doc in docs:
+            self.upsert(doc)
+        for assignment in assignments:
+            agent = self.agents.get(assignment["agentId"])
+            if agent is not None:
+                agent.sessions.add(assignment["sessionId"])
+                self._session_agents[assignment["sessionId"]] = agent.agentId
+        for session_id, agentId in changed.items():
+            previous = self.agents.get(self._session_agents.pop(session_id, None))
+            if previous is not None:
+                previous.sessions.discard(session_id)
+            if agentId in self.agents:
+                self._session_agents[session_id] = agentId
+                self.agents[agentId].sessions.add(session_id)
+        # Fresh heaps: every entry so far is stale
+        self._heaps = {}
+        for agent in self.agents.values():
+            self._push(agent)
+        self.syncs += 1
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"Warning: agent routing sync failed: {e}")
+
+    async def start(self):
+        try:
+            await self.sync()
+        except Exception as e:
+            print(f"Warning: agent routing sync failed: {e}")
+        if self.sync_interval > 0:
+            self._task = asyncio.create_task(self._sync_loop(), name="routing-sync")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+
+def create_routing_engine(repos) -> RoutingEngine:
+    return RoutingEngine(
+        repos,
+        strategy=os.getenv("AGENT_ROUTING_STRATEGY", "least_loaded"),
+        default_capacity=int(os.getenv("AGENT_DEFAULT_CAPACITY", "5")),
+        sync_interval=float(os.getenv("AGENT_ROUTING_SYNC_SECONDS", "30")),
+    )
@@ -0,0 +1,205 @@
+import asyncio
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Imported first by main.py, so this is roughly when the app module started importing
+IMPORT_STARTED = time.perf_counter()
+
+# Modules a CRUD-only worker must never pull in
+HEAVY_MODULES = ["torch", "transformers", "spacy", "onnxruntime", "huggingface_hub"]
+
+
+def worker_role() -> str:
+    """WORKER_ROLE=all (default) serves everything; crud skips every model component."""
+    return os.getenv("WORKER_ROLE", "all").lower()
+
+
+def max_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def rss_mb() -> Optional[float]:
+    """Current resident set size (Linux only; elsewhere the peak is the best we have)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return max_rss_mb()
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+
+
+class Component:
+    """Something expensive to build (a model, a pipeline) that is loaded once, off the request path.
+
+    `get()` returns the loaded value, loading it first if needed; concurrent
+    callers share one load. A failed load is reported and retried on the
+    next `get()`.
+    """
+
+    def __init__(self, name: str, loader: Callable[[], Awaitable[Any]], stop: Optional[Callable[[Any], Awaitable]] = None):
+        self.name = name
+        self.loader = loader
+        self._stop = stop
+        self.value: Any = None
+        self.state = "pending"
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    async def _load(self):
+        self.state = "loading"
+        started = time.perf_counter()
+        try:
+            self.value = await self.loader()
+        except Exception as e:
+            self.state, self.error = "failed", f"{type(e).__name__}: {e}"
+            print(f"Warning: loading {self.name} failed: {self.error}")
+            raise
+        finally:
+            self.load_seconds = round(time.perf_counter() - started, 3)
+        self.state, self.error = "ready", None
+        return self.value
+
+    def load(self) -> asyncio.Task:
+        if self._task is None or (self._task.done() and not self.ready):
+            self._task = asyncio.create_task(self._load(), name=f"load:{self.name}")
+        return self._task
+
+    async def get(self) -> Any:
+        if self.ready:
+            return self.value
+        return await asyncio.shield(self.load())
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+        if self.ready and self._stop:
+            await self._stop(self.value)
+        self.state = "stopped"
+
+    def status(self) -> dict:
+        return {"state": self.state, "loadSeconds": self.load_seconds, "error": self.error}
+
+
+class Components:
+    """The worker's model components plus a startup timing report.
+
+    MODEL_LOADING picks when they load: "background" (default) starts
+    loading in the lifespan without holding up the server, "eager" waits
+    for them before serving, "lazy" loads each on first use.
+    """
+
+    def __init__(self):
+        self.components: Dict[str, Component] = {}
+        self.mode = os.getenv("MODEL_LOADING", "background").lower()
+        self.role = worker_role()
+        self.marks: Dict[str, float] = {}
+
+    def add(self, name: str, loader: Callable[[], Awaitable[Any]], stop: Optional[Callable[[Any], Awaitable]] = None) -> Component:
+        component = Component(name, loader, stop)
+        self.components[name] = component
+        return component
+
+    def __getitem__(self, name: str) -> Component:
+        return self.components[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.components
+
+    def mark(self, event: str):
+        self.marks[event] = round(time.perf_counter() - IMPORT_STARTED, 3)
+
+    async def start(self):
+        self.mark("lifespan started")
+        if self.mode == "lazy":
+            return
+        loads = [component.load() for component in self.components.values()]
+        if self.mode == "eager":
+            await asyncio.gather(*loads, return_exceptions=True)
+            self.mark("components loaded")
+        else:
+            async def wait_all():
+                await asyncio.gather(*loads, return_exceptions=True)
+                self.mark("components loaded")
+
+            asyncio.create_task(wait_all(), name="load:components")
+
+    async def stop(self):
+        for component in reversed(list(self.components.values())):
+            try:
+                await component.stop()
+            except Exception as e:
+                print(f"Warning: stopping {component.name} failed: {e}")
+
+    @property
+    def ready(self) -> bool:
+        return all(c.ready for c in self.components.values())
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "role": self.role,
+            "loading": self.mode,
+            "components": {name: c.status() for name, c in self.components.items()},
+        }
+
+    def report(self) -> dict:
+        return {
+            **self.status(),
+            "secondsSinceImport": round(time.perf_counter() - IMPORT_STARTED, 3),
+            "marks": self.marks,
+            "maxRssMb": max_rss_mb(),
+            "modules": len(sys.modules),
+            "heavyModulesImported": [m for m in HEAVY_MODULES if m in sys.modules],
+        }
+
+
+def import_profile(module: str = "main", role: Optional[str] = None) -> List[dict]:
+    """Import time per top-level package, from `python -X importtime` in a fresh interpreter."""
+    env = dict(os.environ)
+    if role:
+        env["WORKER_ROLE"] = role
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"import {module} failed")
+    line_re = re.compile(r"import time:\s+(\d+) \|\s+\d+ \|\s*(\S+)")
+    packages: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        match = line_re.match(line)
+        if match:
+            # Self time, so nested imports aren't counted twice
+            package = match.group(2).split(".")[0]
+            packages[package] = packages.get(package, 0) + int(match.group(1))
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return [{"module": name, "ms": round(us / 1000.0, 1)} for name, us in ranked]
+
+
+if __name__ == "__main__":
+    # Import cost of the app, e.g. `WORKER_ROLE=crud python startup.py`
+    import json
+
+    module = sys.argv[1] if len(sys.argv) > 1 else "main"
+    profile = import_profile(module)
+    for row in profile[:20]:
+        print(f"{row['ms']:>10.1f} ms  {row['module']}")
+    print(json.dumps({"module": module, "role": worker_role(), "totalMs": round(sum(r["ms"] for r in profile), 1)}))
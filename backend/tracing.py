@@ -0,0 +1,448 @@
+"""Request-scoped trace spans and an on-demand sampling profiler.
+
+A sampled request gets a root span from TracingMiddleware; code on its path
+opens child spans with `span(name)`, which costs one contextvar read when
+the request isn't sampled. Finished traces are exported off the event loop
+by a background thread, as JSON lines (TRACE_EXPORTER=file) or OTLP/HTTP
+JSON (TRACE_EXPORTER=otlp, to any collector on OTLP_ENDPOINT).
+
+Batched work runs once for many requests: MicroBatcher records its queue
+wait and batch run against each traced caller and copies the spans opened
+inside the batch (tokenize, forward, ...) under every one of them.
+"""
+import contextvars
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Span:
+    __slots__ = ("name", "trace", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "status")
+
+    def __init__(self, name: str, trace: "Trace", parent_id: Optional[str] = None, attributes: Optional[dict] = None, start_ns: Optional[int] = None):
+        self.name = name
+        self.trace = trace
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes or {}
+        self.status = "ok"
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def child(self, name: str, **attributes) -> "Span":
+        return self.trace.add(Span(name, self.trace, self.span_id, attributes))
+
+    def end(self, end_ns: Optional[int] = None):
+        self.end_ns = end_ns or time.time_ns()
+
+    def to_dict(self) -> dict:
+        return {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "start": self.start_ns,
+            "durationMs": round(((self.end_ns or time.time_ns()) - self.start_ns) / 1e6, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """Stands in for a span when nothing is being traced, so callers never need to check."""
+
+    def set(self, key: str, value):
+        pass
+
+    def child(self, name: str, **attributes) -> "_NoopSpan":
+        return self
+
+    def end(self, end_ns: Optional[int] = None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    # Past this many spans a trace stops recording (a runaway loop shouldn't eat memory)
+    MAX_SPANS = 1000
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or _new_id(128)
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> Span:
+        with self._lock:
+            if len(self.spans) < self.MAX_SPANS:
+                self.spans.append(span)
+        return span
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+@contextmanager
+def activate(current: Optional[Span]) -> Iterator[None]:
+    token = _current.set(current)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator:
+    """Child of the current span; yields NOOP_SPAN when the current request isn't traced."""
+    parent = _current.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+    current = parent.child(name, **attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.set("error", f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        current.end()
+        _current.reset(token)
+
+
+def run_with_span(current: Optional[Span], fn, *args):
+    """fn(*args) with `current` as the current span; for work handed to another thread."""
+    if current is None:
+        return fn(*args)
+    with activate(current):
+        return fn(*args)
+
+
+def copy_spans(source: Trace, parent: Span):
+    """Re-create the spans of a shared (batch) trace under `parent`, with fresh ids."""
+    ids = {}
+    for original in source.spans:
+        ids[original.span_id] = _new_id(64)
+    for original in source.spans:
+        copy = Span(original.name, parent.trace, ids.get(original.parent_id, parent.span_id), dict(original.attributes), original.start_ns)
+        copy.span_id = ids[original.span_id]
+        copy.end_ns = original.end_ns
+        copy.status = original.status
+        parent.trace.add(copy)
+
+
+class FileExporter:
+    """One JSON line per trace."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, traces: List[Trace]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for trace in traces:
+                f.write(json.dumps({"traceId": trace.trace_id, "spans": [s.to_dict() for s in trace.spans]}) + "\n")
+
+
+class OtlpExporter:
+    """OTLP/HTTP with the JSON encoding, POSTed to {endpoint}/v1/traces."""
+
+    def __init__(self, endpoint: str, service: str = "marketplace-chat-backend", timeout: float = 5.0):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.service = service
+        self.timeout = timeout
+
+    @staticmethod
+    def _value(value) -> dict:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def _span(self, s: Span) -> dict:
+        encoded = {
+            "traceId": s.trace.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": 2 if s is s.trace.spans[0] else 1,  # SERVER for the root, INTERNAL otherwise
+            "startTimeUnixNano": str(s.start_ns),
+            "endTimeUnixNano": str(s.end_ns or s.start_ns),
+            "attributes": [{"key": k, "value": self._value(v)} for k, v in s.attributes.items()],
+            "status": {"code": 2 if s.status == "error" else 1},
+        }
+        if s.parent_id:
+            encoded["parentSpanId"] = s.parent_id
+        return encoded
+
+    def export(self, traces: List[Trace]):
+        import urllib.request
+
+        body = {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": self.service}},
+                    {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+                ]},
+                "scopeSpans": [{
+                    "scope": {"name": "tracing"},
+                    "spans": [self._span(s) for trace in traces for s in trace.spans],
+                }],
+            }]
+        }
+        request = urllib.request.Request(
+            self.url, data=json.dumps(body).encode(), headers={"Content-Type": "application/json"}, method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+class Tracer:
+    """Sampling decision plus a bounded queue drained by one exporter thread."""
+
+    def __init__(self, exporter=None, sample_rate: float = 0.0, max_queue: int = 1000, batch_size: int = 50):
+        self.exporter = exporter
+        self.sample_rate = sample_rate if exporter else 0.0
+        self.batch_size = batch_size
+        self._queue: "queue.Queue[Optional[Trace]]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self.exported = 0
+        self.dropped = 0
+        self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def should_sample(self, traceparent: Optional[str] = None) -> bool:
+        if not self.enabled:
+            return False
+        # W3C traceparent "00-<trace>-<parent>-<flags>": follow the caller's decision
+        if traceparent and len(traceparent) >= 55:
+            return traceparent[-2:] == "01"
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @contextmanager
+    def trace(self, name: str, traceparent: Optional[str] = None, force: bool = False, **attributes) -> Iterator:
+        """Root span for one request or message; NOOP_SPAN when not sampled."""
+        if not (force and self.enabled) and not self.should_sample(traceparent):
+            yield NOOP_SPAN
+            return
+        parts = traceparent.split("-") if traceparent else []
+        trace = Trace(parts[1] if len(parts) == 4 else None)
+        root = trace.add(Span(name, trace, parts[2] if len(parts) == 4 else None, attributes))
+        token = _current.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.status = "error"
+            root.set("error", f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            root.end()
+            _current.reset(token)
+            self.submit(trace)
+
+    def submit(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _export_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            traces = [t for t in batch if t is not None]
+            if traces:
+                try:
+                    self.exporter.export(traces)
+                    self.exported += len(traces)
+                except Exception as e:
+                    self.failures += 1
+                    print(f"Warning: exporting {len(traces)} traces failed: {e}")
+            if stop:
+                return
+
+    def start(self):
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._export_loop, name="trace-export", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "exporter": type(self.exporter).__name__ if self.exporter else None,
+            "sampleRate": self.sample_rate,
+            "queued": self._queue.qsize(),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "failures": self.failures,
+        }
+
+
+def create_tracer() -> Tracer:
+    """TRACE_EXPORTER=file (TRACE_FILE) | otlp (OTLP_ENDPOINT) | none, sampling TRACE_SAMPLE_RATE of requests."""
+    kind = os.getenv("TRACE_EXPORTER", "none").lower()
+    exporter = None
+    if kind == "file":
+        exporter = FileExporter(os.getenv("TRACE_FILE", "traces.jsonl"))
+    elif kind == "otlp":
+        exporter = OtlpExporter(os.getenv("OTLP_ENDPOINT", "http://localhost:4318"))
+    elif kind != "none":
+        print(f"Warning: unknown TRACE_EXPORTER {kind!r}; tracing disabled")
+    return Tracer(exporter, sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "0.01")))
+
+
+TRACER = create_tracer()
+
+
+class TracingMiddleware:
+    """ASGI middleware opening the root span of every sampled HTTP request."""
+
+    def __init__(self, app, tracer: Tracer = TRACER):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.tracer.enabled:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        traceparent = headers.get(b"traceparent", b"").decode() or None
+        with self.tracer.trace(f"{scope['method']} {scope['path']}", traceparent, **{"http.method": scope["method"], "http.target": scope["path"]}) as root:
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    root.set("http.status_code", message["status"])
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = getattr(scope.get("route"), "path", None)
+                if route and isinstance(root, Span):
+                    root.name = f"{scope['method']} {route}"
+                    root.set("http.route", route)
+
+
+def mongo_listener():
+    """pymongo CommandListener adding a span per Mongo command to the calling request's trace.
+
+    Motor runs pymongo on a thread pool with the caller's context copied,
+    so `started` sees the request's current span.
+    """
+    from pymongo import monitoring
+
+    class CommandTracer(monitoring.CommandListener):
+        def __init__(self):
+            self._pending: Dict[tuple, Span] = {}
+
+        def started(self, event):
+            parent = _current.get()
+            if parent is None:
+                return
+            collection = event.command.get(event.command_name)
+            self._pending[(event.connection_id, event.request_id)] = parent.child(
+                f"mongo.{event.command_name}",
+                **{"db.operation": event.command_name, "db.collection": collection if isinstance(collection, str) else ""},
+            )
+
+        def succeeded(self, event):
+            current = self._pending.pop((event.connection_id, event.request_id), None)
+            if current:
+                current.end()
+
+        def failed(self, event):
+            current = self._pending.pop((event.connection_id, event.request_id), None)
+            if current:
+                current.status = "error"
+                current.set("error", str(event.failure))
+                current.end()
+
+    return CommandTracer()
+
+
+# Leaf functions of threads parked waiting for work; left out of profiles unless asked for
+IDLE_FUNCTIONS = {"select", "poll", "wait", "_wait_for_tstate_lock", "_worker", "accept", "get", "sleep", "_export_loop"}
+
+
+class SamplingProfiler:
+    """Samples every thread's Python stack at `hz` for `seconds`; one profile at a time.
+
+    The output is collapsed stacks ("thread;outer;...;inner count" lines),
+    the input format of flamegraph.pl, speedscope and most flame graph tools.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def run(self, seconds: float, hz: float = 100.0, include_idle: bool = False) -> Counter:
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("a profile is already running")
+        try:
+            me = threading.get_ident()
+            names = {}
+            stacks: Counter = Counter()
+            interval = 1.0 / hz
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for thread in threading.enumerate():
+                    names[thread.ident] = thread.name
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    if not include_idle and frame.f_code.co_name in IDLE_FUNCTIONS:
+                        continue
+                    frames = []
+                    while frame is not None:
+                        code = frame.f_code
+                        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    frames.append(names.get(ident, f"thread-{ident}"))
+                    stacks[";".join(reversed(frames))] += 1
+                time.sleep(interval)
+            return stacks
+        finally:
+            self._lock.release()
+
+
+def collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+PROFILER = SamplingProfiler()
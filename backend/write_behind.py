@@ -0,0 +1,305 @@
+import asyncio
+import fcntl
+import json
+import os
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import Dict, List
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+class MessageWriteBehind:
+    """Write-behind buffer for chat messages.
+
+    `enqueue` appends the message to a local journal and returns; a background
+    task flushes buffered messages to Mongo in bulk once `flush_size` are
+    pending or `flush_interval_ms` has passed. Delivery is at-least-once:
+    journal entries are only dropped after their bulk write succeeded, and
+    whatever is left in the journal is replayed on the next start. The seqs
+    reserved for a record are journaled before its write and reused on every
+    retry, and appends skip seqs already stored, so a retried or replayed
+    write neither leaves gaps nor duplicates a message.
+    When `max_pending` messages are unflushed, `enqueue` waits (backpressure).
+
+    Each process journals to its own file (`<name>.<pid>.journal`, held with
+    a lock file); on start, journals whose lock is free (left by a process
+    that exited) are claimed and replayed by exactly one process.
+    """
+
+    def __init__(
+        self,
+        repos,
+        journal_path=None,
+        max_pending: int = 10000,
+        flush_size: int = 500,
+        flush_interval_ms: float = 50.0,
+        fsync: bool = False,
+        max_journal_bytes: int = 16 * 1024 * 1024,
+    ):
+        self.repos = repos
+        base = Path(journal_path or BASE_DIR / "journal" / "messages.journal")
+        self.journal_pattern = f"{base.stem}.*{base.suffix}"
+        self.journal_path = base.with_name(f"{base.stem}.{os.getpid()}{base.suffix}")
+        self._lock = None
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.fsync = fsync
+        self.max_journal_bytes = max_journal_bytes
+        self._pending: deque = deque()
+        self._slots = asyncio.Semaphore(max_pending)
+        self._wakeup = asyncio.Event()
+        self._journal = None
+        self._task = None
+        self._unslotted = 0
+        # Held for the duration of a flush so shutdown never cancels one halfway
+        self._flush_lock = asyncio.Lock()
+        self.max_pending = max_pending
+
+        # Metrics
+        self.enqueued = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.replayed = 0
+        self.backpressure_waits = 0
+        self.last_flush_ms = 0.0
+
+    async def start(self):
+        self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = self._try_lock(self.journal_path)
+        if self._lock is None:
+            raise RuntimeError(f"{self.journal_path} is locked by another process")
+        # A previous process with the same pid (e.g. a container restart) left this one behind
+        replay = self._read_journal(self.journal_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        for path in sorted(self.journal_path.parent.glob(self.journal_pattern)):
+            if path != self.journal_path:
+                replay += self._claim(path)
+        # Replayed records don't hold a backpressure slot (there may be more than max_pending)
+        self._pending.extend(replay)
+        self._unslotted = len(replay)
+        self.replayed = len(replay)
+        if replay:
+            self._compact_journal()
+        self._task = asyncio.create_task(self._run(), name="message-write-behind")
+
+    @staticmethod
+    def _try_lock(journal: Path):
+        lock = open(journal.with_name(journal.name + ".lock"), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return None
+        # The owner may have unlinked the lock file after we opened it (journal already claimed)
+        if not os.path.exists(lock.name) or os.stat(lock.name).st_ino != os.fstat(lock.fileno()).st_ino:
+            lock.close()
+            return None
+        return lock
+
+    def _claim(self, path: Path) -> List[dict]:
+        """Take over another process's journal if that process is gone (its lock is free)."""
+        lock = self._try_lock(path)
+        if lock is None:
+            return []
+        try:
+            records = self._read_journal(path) if path.exists() else []
+            # Ours first, durably, so the records survive a crash during the takeover
+            for record in records:
+                self._journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            path.unlink(missing_ok=True)
+            os.unlink(lock.name)
+        finally:
+            lock.close()
+        return records
+
+    @staticmethod
+    def _read_journal(path: Path) -> List[dict]:
+        if not path.exists():
+            return []
+        records, seqs = [], {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn last line from a crash mid-append
+                    break
+                if "seqs" in entry:
+                    seqs.update(entry["seqs"])
+                else:
+                    records.append(entry)
+        for record in records:
+            if record["id"] in seqs:
+                record["seq"] = seqs[record["id"]]
+        return records
+
+    def _append_journal(self, record: dict):
+        self._journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _compact_journal(self):
+        # Rewrite the journal with only the still-unflushed records
+        tmp_path = self.journal_path.with_name(self.journal_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self._pending:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal.close()
+        os.replace(tmp_path, self.journal_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    async def enqueue(self, sessionId: str, message: dict):
+        if self._slots.locked():
+            self.backpressure_waits += 1
+        await self._slots.acquire()
+        record = {"id": uuid.uuid4().hex, "sessionId": sessionId, "message": message}
+        self._append_journal(record)
+        self._pending.append(record)
+        self.enqueued += 1
+        if len(self._pending) >= self.flush_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        backoff = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._pending:
+                try:
+                    await self.flush_once()
+                    backoff = self.flush_interval
+                except Exception as e:
+                    self.failures += 1
+                    print(f"Warning: message write-behind flush failed: {e}")
+                    # Keep the records; retry with capped exponential backoff
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 5.0)
+                if len(self._pending) < self.flush_size:
+                    break
+
+    async def flush_once(self):
+        async with self._flush_lock:
+            await self._flush_batch()
+
+    async def _flush_batch(self):
+        batch = [self._pending[i] for i in range(min(self.flush_size, len(self._pending)))]
+        if not batch:
+            return
+        started = time.perf_counter()
+        # Seqs are reserved once per record; a retry of a failed write reuses them
+        unreserved: Dict[str, List[dict]] = {}
+        for record in batch:
+            if "seq" not in record:
+                unreserved.setdefault(record["sessionId"], []).append(record)
+        sessions = list(unreserved)
+        first_seqs = await asyncio.gather(*(
+            self.repos.chat_sessions.reserve_seq(sid, len(unreserved[sid]), unreserved[sid][-1]["message"])
+            for sid in sessions
+        ), return_exceptions=True)
+        reserved = {}
+        for sid, first_seq in zip(sessions, first_seqs):
+            if isinstance(first_seq, Exception):
+                continue
+            if first_seq is None:
+                self.dropped += len(unreserved[sid])
+            for offset, record in enumerate(unreserved[sid]):
+                # None: the session was deleted; nothing to attach the messages to
+                record["seq"] = reserved[record["id"]] = None if first_seq is None else first_seq + offset
+        if reserved:
+            self._append_journal({"seqs": reserved})
+        failed = next((e for e in first_seqs if isinstance(e, Exception)), None)
+        if failed is not None:
+            raise failed
+
+        by_session: Dict[str, List[dict]] = {}
+        for record in batch:
+            if record["seq"] is not None:
+                by_session.setdefault(record["sessionId"], []).append(record)
+        writes = []
+        for sid, records in by_session.items():
+            # One write per run of consecutive seqs
+            records.sort(key=lambda r: r["seq"])
+            run = [records[0]]
+            for record in records[1:]:
+                if record["seq"] != run[-1]["seq"] + 1:
+                    writes.append((sid, run[0]["seq"], [r["message"] for r in run]))
+                    run = []
+                run.append(record)
+            writes.append((sid, run[0]["seq"], [r["message"] for r in run]))
+        await self.repos.chat_messages.append_many(writes)
+
+        for _ in batch:
+            self._pending.popleft()
+            if self._unslotted:
+                self._unslotted -= 1
+            else:
+                self._slots.release()
+        self.flushed += len(batch)
+        self.flushes += 1
+        self.last_flush_ms = (time.perf_counter() - started) * 1000.0
+        if not self._pending:
+            self._journal.truncate(0)
+        elif self.journal_path.stat().st_size > self.max_journal_bytes:
+            self._compact_journal()
+
+    async def stop(self):
+        # Flush everything that is buffered before shutting down
+        if self._task:
+            async with self._flush_lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        try:
+            while self._pending:
+                await self.flush_once()
+        except Exception as e:
+            print(f"Warning: {len(self._pending)} messages left in {self.journal_path} for replay: {e}")
+        if self._journal:
+            self._journal.close()
+            if not self._pending:
+                # Nothing left to replay; don't leave a journal per past process behind
+                self.journal_path.unlink(missing_ok=True)
+                os.unlink(self._lock.name)
+        if self._lock:
+            self._lock.close()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "maxPending": self.max_pending,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "replayed": self.replayed,
+            "backpressureWaits": self.backpressure_waits,
+            "lastFlushMs": self.last_flush_ms,
+            "journalBytes": self.journal_path.stat().st_size if self.journal_path.exists() else 0,
+        }
+
+
+def create_write_behind(repos) -> MessageWriteBehind:
+    return MessageWriteBehind(
+        repos,
+        journal_path=os.getenv("MESSAGE_JOURNAL_PATH"),
+        max_pending=int(os.getenv("MESSAGE_WRITE_MAX_PENDING", "10000")),
+        flush_size=int(os.getenv("MESSAGE_WRITE_FLUSH_SIZE", "500")),
+        flush_interval_ms=float(os.getenv("MESSAGE_WRITE_FLUSH_MS", "50")),
+        fsync=os.getenv("MESSAGE_JOURNAL_FSYNC", "0") == "1",
+    )
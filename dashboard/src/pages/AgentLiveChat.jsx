@@ -30,6 +30,7 @@ const AgentDashboard = ({ agentId = 'agent_001', clientId = 'client_123' }) => {
     const [error, setError] = useState('');
     const [loading, setLoading] = useState(false);
     const [mobileOpen, setMobileOpen] = useState(false);
+    const [onlineAgents, setOnlineAgents] = useState({});
 
     // Fetch active sessions
     useEffect(() => {
@@ -37,7 +38,7 @@ const AgentDashboard = ({ agentId = 'agent_001', clientId = 'client_123' }) => {
             setLoading(true);
             try {
                 const response = await axios.get(`http://localhost:8000/chat/session`, {
-                    params: { agentId, clientId },
+                    params: { agentId, clientId, recentMessages: 100 },
                 });
                 setSessions(response.data.sessions || []);
                 setError('');
@@ -75,6 +76,10 @@ const AgentDashboard = ({ agentId = 'agent_001', clientId = 'client_123' }) => {
 
         websocket.onmessage = (event) => {
             const data = JSON.parse(event.data);
+            if (data.type === 'ping') {
+                websocket.send(JSON.stringify({ type: 'pong' }));
+                return;
+            }
             console.log("data", data);
             if (data.sessionId && data.message) {
                 console.log("data.sessionId", data.sessionId, data.message);
@@ -120,6 +125,38 @@ const AgentDashboard = ({ agentId = 'agent_001', clientId = 'client_123' }) => {
         };
     }, [agentId]); // Removed selectedSession from dependencies
 
+    // Live presence of this site's agents (pushed by the server, no polling)
+    useEffect(() => {
+        const presence = new WebSocket(`ws://localhost:8000/ws/presence/${clientId}`);
+        presence.onmessage = (event) => {
+            const data = JSON.parse(event.data);
+            if (data.type === 'ping') {
+                presence.send(JSON.stringify({ type: 'pong' }));
+                return;
+            }
+            if (data.agents) {
+                setOnlineAgents(Object.fromEntries(data.agents.map((agent) => [agent.agentId, agent])));
+            } else if (data.agent) {
+                setOnlineAgents((prev) => {
+                    const next = { ...prev };
+                    if (data.agent.status === 'online') {
+                        next[data.agent.agentId] = data.agent;
+                    } else {
+                        delete next[data.agent.agentId];
+                    }
+                    return next;
+                });
+                // The server may have expired this agent (missed heartbeats)
+                if (data.agent.agentId === agentId) {
+                    setAgentStatus(data.agent.status);
+                }
+            }
+        };
+        return () => {
+            presence.close();
+        };
+    }, [agentId, clientId]);
+
     // Close chat session
     const closeChat = async () => {
         if (!selectedSession) return;
@@ -274,6 +311,7 @@ const AgentDashboard = ({ agentId = 'agent_001', clientId = 'client_123' }) => {
                         </Typography>
                     </Box>
                     <Box sx={{ display: 'flex', alignItems: 'center', gap: 1 }}>
+                        <Chip label={`${Object.keys(onlineAgents).length} agents online`} size="small" variant="outlined" />
                         <Chip
                             label={agentStatus}
                             color={agentStatus === 'online' ? 'success' : 'default'}
@@ -147,6 +147,10 @@ const ChatWidget = ({ clientId = "client_123", successRedirectUrl = "/order-conf
 
         websocket.onmessage = (event) => {
             const data = JSON.parse(event.data);
+            if (data.type === 'ping') {
+                websocket.send(JSON.stringify({ type: 'pong' }));
+                return;
+            }
             console.log('WebSocket message received:', data); // Debug log
             if (data.message) {
                 setMessages((prev) => [...prev, data.message]);
@@ -157,6 +157,10 @@ const ChatWidget = ({ clientId = "client_123", successRedirectUrl = "/api/order-
 
         websocket.onmessage = (event) => {
             const data = JSON.parse(event.data);
+            if (data.type === 'ping') {
+                websocket.send(JSON.stringify({ type: 'pong' }));
+                return;
+            }
             console.log('WebSocket message received:', data); // Debug log
             if (data.message) {
                 setMessages((prev) => [...prev, data.message]);
@@ -383,6 +387,7 @@ const ChatWidget = ({ clientId = "client_123", successRedirectUrl = "/api/order-
                 },
                 body: JSON.stringify({
                     text: query,
+                    clientId,
                 }),
             });
 
@@ -14,12 +14,16 @@ const ChatWidget = ({ clientId = "client_123", successRedirectUrl = "/api/order-
     const [messages, setMessages] = useState([]);
     const [input, setInput] = useState("");
     const [agents, setAgents] = useState([]);
-    const [chains, setChains] = useState([]);
     const [loading, setLoading] = useState(false);
     const [size, setSize] = useState({ width: 600, height: 600 });
     const [isCollapsed, setIsCollapsed] = useState(false);
     const [pendingOrder, setPendingOrder] = useState(null);
     const [userDetails, setUserDetails] = useState({ customer_name: "", address: "" });
+    // Read from the socket handler, which would otherwise see the first render's details
+    const userDetailsRef = useRef(userDetails);
+    useEffect(() => {
+        userDetailsRef.current = userDetails;
+    }, [userDetails]);
     const [userId, setUserId] = useState(null);
     const websiteId = "site123";
     const marketplaceApiUrl = "http://localhost:8082";
@@ -101,45 +105,59 @@ const ChatWidget = ({ clientId = "client_123", successRedirectUrl = "/api/order-
 
     fetchIntent();
   }, []);
-    // Fetch settings on mount
+    // Settings, agents and the chat session in one round-trip; parts the server reports
+    // as not modified (matching ETag) are reused from the local copy
     useEffect(() => {
-        const fetchSettings = async () => {
+        if (!userId) return;
+        const cacheKey = `chatwidget-bootstrap:${clientId}:${websiteId}`;
+        const bootstrap = async () => {
+            let cached = {};
             try {
-                const response = await axios.get(`http://localhost:8000/widget/${clientId}`);
-                setSettings(response.data.widgetSettings);
-                setIsCollapsed(response.data.isCollapsed);
-                setSize({
-                    width: response.data.defaultWidth,
-                    height: response.data.defaultHeight,
-                });
-                console.log("Fetched settings:", response.data.widgetSettings); // 👈 log it
-                console.log("new settings", settings)
-                // Add welcome message if messages are empty
-                if (messages.length === 0 && response.data.welcomeMessage) {
-                    setMessages([{ sender: 'bot', text: response.data.welcomeMessage }]);
-                }
-            } catch (error) {
-                console.error('Error fetching settings:', error);
+                cached = JSON.parse(localStorage.getItem(cacheKey)) || {};
+            } catch {
+                cached = {};
             }
-        };
-        const createSession = async () => {
-            if (!userId) return;
             try {
-                const response = await axios.post('http://localhost:8000/chat/session', {
-                    sessionId: `session_${userId}_${Date.now()}`,
-                    clientId,
+                const response = await axios.post(`http://localhost:8000/widget/${clientId}/bootstrap`, {
                     userId,
-                    status: 'pending',
-                    messages: [],
+                    sessionId: `session_${userId}_${Date.now()}`,
+                    websiteId,
+                    fields: ['settings', 'agents', 'session'],
+                    etags: cached.etags || {},
                 });
-                setSessionId(response.data.sessionId);
+                const data = response.data;
+                const parts = {};
+                for (const name of ['settings', 'agents']) {
+                    parts[name] = data.notModified.includes(name) ? cached[name] : data[name];
+                }
+                localStorage.setItem(cacheKey, JSON.stringify({ etags: data.etags, ...parts }));
+
+                const widget = parts.settings;
+                if (widget) {
+                    setSettings(widget.widgetSettings);
+                    setIsCollapsed(widget.isCollapsed);
+                    setSize({
+                        width: widget.defaultWidth,
+                        height: widget.defaultHeight,
+                    });
+                    // Add welcome message if messages are empty
+                    if (messages.length === 0 && widget.welcomeMessage) {
+                        setMessages([{ sender: 'bot', text: widget.welcomeMessage }]);
+                    }
+                }
+                setAgents(Array.isArray(parts.agents) ? parts.agents : []);
+                setSessionId(data.session.sessionId);
             } catch (error) {
-                console.error('Error creating session:', error);
+                console.error('Error loading widget:', error);
+                localStorage.removeItem(cacheKey);
+                setMessages((prev) => [
+                    ...prev,
+                    { sender: "bot", text: "Error loading the chat. Please try again later." },
+                ]);
             }
         };
 
-        fetchSettings();
-        if (userId) createSession();
+        bootstrap();
     }, [clientId, userId]);
     axios.defaults.withCredentials = true;
 
@@ -156,14 +174,39 @@ const ChatWidget = ({ clientId = "client_123", successRedirectUrl = "/api/order-
 
         websocket.onmessage = (event) => {
             const data = JSON.parse(event.data);
+            if (data.type === 'ping') {
+                websocket.send(JSON.stringify({ type: 'pong' }));
+                return;
+            }
             console.log('WebSocket message received:', data); // Debug log
+            if (data.pendingOrder) {
+                // The chain reached place_order: collect the order details as before
+                const details = userDetailsRef.current;
+                const order = { ...data.pendingOrder };
+                if (details.customer_name) order.customer_name = details.customer_name;
+                if (details.address) order.address = details.address;
+                setPendingOrder(order);
+                const prompt = !details.customer_name
+                    ? "Please enter your name."
+                    : !details.address
+                    ? "Please enter your address."
+                    : "Please enter the quantity.";
+                setMessages((prev) => [...prev, { sender: "bot", text: prompt }]);
+                return;
+            }
+            if (data.chain?.done) {
+                setLoading(false);
+                return;
+            }
             if (data.message) {
+                if (!data.chain) setLoading(false);
                 setMessages((prev) => [...prev, data.message]);
                 if (data.message.text === 'Live chat ended.') {
                     setIsLiveChat(false);
                     setSessionId(null);
                 }
             } else if (data.error) {
+                setLoading(false);
                 setMessages((prev) => [...prev, { sender: 'bot', text: data.error }]);
             } else if (data.agentAssigned) {
                 setIsLiveChat(true);
@@ -313,27 +356,6 @@ const ChatWidget = ({ clientId = "client_123", successRedirectUrl = "/api/order-
         saveData();
     }, [messages, userDetails, userId]);
 
-    // Fetch agents and chains
-    useEffect(() => {
-        console.log("Loading agents and chains")
-        const fetchData = async () => {
-            try {
-                const [agentsResponse, chainsResponse] = await Promise.all([
-                    axios.get("http://localhost:8000/agents", { params: { websiteId } }),
-                    axios.get("http://localhost:8000/chains", { params: { websiteId } }),
-                ]);
-                setAgents(Array.isArray(agentsResponse.data.agents) ? agentsResponse.data.agents : []);
-                setChains(Array.isArray(chainsResponse.data.chains) ? chainsResponse.data.chains : []);
-            } catch (error) {
-                console.error("Error fetching data:", error);
-                setMessages((prev) => [
-                    ...prev,
-                    { sender: "bot", text: "Error loading agents or chains. Please try again later." },
-                ]);
-            }
-        };
-        fetchData();
-    }, []);
 
     // Handle resizing
     useEffect(() => {
@@ -372,43 +394,6 @@ const ChatWidget = ({ clientId = "client_123", successRedirectUrl = "/api/order-
             resizeHandle.removeEventListener("mousedown", handleMouseDown);
         };
     }, []); // Empty dependency array to ensure stable event listeners
-    // Async version of processQuery using WebLLM
-    const processQuery = (query) => {
-        // const doc = nlp(query.toLowerCase());
-        // const isCheapest = doc.has("cheapest");
-        // const brand = "Sony";
-        // const categoryMatch = doc.match("#Noun").text();
-        // const category = categoryMatch ? categoryMatch.split(" ").pop() : "headphone";
-        // return {
-        //     intent: "search_product",
-        //     params: {
-        //         brand,
-        //         category,
-        //         sort: isCheapest ? "price_asc" : "price_desc",
-        //     },
-        // };
-        const fetchIntent = async () => {
-      try {
-        const response = await fetch("http://localhost:8001/classify-intent", {
-          method: "POST",
-          headers: {
-            "Content-Type": "application/json",
-          },
-          body: JSON.stringify({
-            text: query, // Replace with any input text
-          }),
-        });
-
-        const data = await response.json();
-        console.log("Intent classification result:", data);
-      } catch (error) {
-        console.error("Error fetching intent classification:", error);
-      }
-    };
-
-    fetchIntent();
-    };
-
     // Execute a single agent
     const executeAgent = async (agent, params, intent) => {
         const normalizedIntent = intent.replace(/^[a-z]+_/, '');
@@ -603,100 +588,16 @@ const ChatWidget = ({ clientId = "client_123", successRedirectUrl = "/api/order-
             }
         }
 
-        setLoading(true);
-        try {
-            const result = await processQuery(input);
-            if (!result) return; // guard for errors
-
-            const { intent, params } = result;
-            console.log("intent", intent);
-            const chain = chains.find((c) => c.agentSequence[0] === intent);
-            console.log("chain", chain)
-            if (chain) {
-                console.log("running chain")
-                let currentParams = { ...params };
-                for (const agentIntent of chain.agentSequence) {
-                    const agent = agents.find((a) => a.intent === agentIntent);
-                    if (!agent) {
-                        newMessages.push({ sender: "bot", text: `No agent found for intent: ${agentIntent}` });
-                        break;
-                    }
-                    let mappedParams = { ...currentParams };
-                    if (agentIntent === "recommend_product") {
-                        mappedParams = { product: currentParams.id };
-                    } else if (agentIntent === "place_order") {
-                        const newPendingOrder = { product_id: currentParams.id };
-                        if (userDetails.customer_name) {
-                            newPendingOrder.customer_name = userDetails.customer_name;
-                        }
-                        if (userDetails.address) {
-                            newPendingOrder.address = userDetails.address;
-                        }
-                        setPendingOrder(newPendingOrder);
-                        if (!userDetails.customer_name) {
-                            newMessages.push({ sender: "bot", text: "Please enter your name." });
-                        } else if (!userDetails.address) {
-                            newMessages.push({ sender: "bot", text: "Please enter your address." });
-                        } else {
-                            newMessages.push({ sender: "bot", text: "Please enter the quantity." });
-                        }
-                        setMessages((prev) => [...prev, ...newMessages]);
-                        setInput("");
-                        setLoading(false);
-                        return;
-                    }
-                    const { result, error, params: newParams } = await executeAgent(agent, mappedParams, agentIntent);
-                    if (error) {
-                        newMessages.push({ sender: "bot", text: error });
-                        break;
-                    }
-                    console.log("pushing message", result)
-                    newMessages.push({ sender: "bot", text: result });
-                    currentParams = newParams;
-                }
-            } else {
-                const agent = agents.find((a) => a.intent === intent);
-                if (!agent) {
-                    newMessages.push({ sender: "bot", text: "No agent found for this query." });
-                } else {
-                    const { result, error, params: responseParams } = await executeAgent(agent, params, intent);
-                    console.log("execute agent", result, responseParams)
-                    // Handle response
-                    if (error) {
-                        newMessages.push({ sender: 'bot', text: error });
-                    } else if (responseParams?.products?.length) {
-                        console.log("responseParams.products", responseParams.products)
-                        // Push message with result and products for product cards
-                        newMessages.push({ sender: 'bot', result, products: responseParams.products });
-                        console.log("newMessages", newMessages)
-
-                    } else if (responseParams?.order_id) {
-                        // Order details
-                        newMessages.push({ sender: 'bot', order_details: responseParams });
-                    } else if (responseParams?.estimated_delivery) {
-                        // Order confirmation
-                        newMessages.push({ sender: 'bot', order_confirmation: responseParams });
-                    } else {
-                        // Fallback to text message
-                        newMessages.push({ sender: 'bot', text: result });
-                    }
-
-                }
-            }
-
-            setMessages((prev) => [...prev, ...newMessages]);
-            console.log("newmsg", messages)
-        } catch (error) {
-            console.error("Error processing query:", error);
-            setMessages((prev) => [
-                ...prev,
-                ...newMessages,
-                { sender: "bot", text: "Sorry, something went wrong. Please try again." },
-            ]);
-        } finally {
-            setLoading(false);
+        // Chains run on the server; each stage's result streams back over the chat socket
+        if (!ws || ws.readyState !== WebSocket.OPEN || !sessionId) {
+            setMessages((prev) => [...prev, newMessage, { sender: "bot", text: "Still connecting. Please try again in a moment." }]);
             setInput("");
+            return;
         }
+        setLoading(true);
+        ws.send(JSON.stringify({ sessionId, message: newMessage }));
+        setMessages((prev) => [...prev, newMessage]);
+        setInput("");
     };
 
     // Toggle collapse/expand